@@ -0,0 +1,287 @@
+"""
+Micro-benchmark cho các handler của main.py, không cần database
+
+Chạy app FastAPI ngay trong process (gọi thẳng ASGI) với một data layer giả
+lưu trong bộ nhớ, rồi đo CPU time và lượng cấp phát bộ nhớ (tracemalloc)
+cho từng endpoint và từng bước xử lý thuần Python.
+
+    python bench_handlers.py --devices 5000 --iterations 200
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import datetime
+import tracemalloc
+import contextlib
+
+import main
+from fingerprint import device_fingerprint
+from fastapi.encoders import jsonable_encoder
+
+
+# ==== FAKE DATA LAYER ====
+
+_TABLE_RE = re.compile(r"\b(?:from|into|update)\s+`?(\w+)`?", re.IGNORECASE)
+
+
+class FakeCursor:
+    def __init__(self, store, dictionary=False):
+        self._store = store
+        self._dictionary = dictionary
+        self._rows = []
+        self.rowcount = 0
+        self.lastrowid = None
+        self.column_names = ()
+
+    def _select(self, table, sql, params):
+        rows = self._store.tables.get(table, [])
+        lowered = sql.lower()
+        if "where id = %s" in lowered:
+            row = self._store.by_id.get(table, {}).get(params[0])
+            return [row] if row else []
+        if "where fingerprint = %s" in lowered:
+            row = self._store.by_fingerprint.get(params[0])
+            return [row] if row else []
+        if "where key_code = %s" in lowered:
+            row = self._store.by_key.get(params[0])
+            return [row] if row else []
+        if "where user_id = %s" in lowered:
+            return [row for row in rows if row["user_id"] == params[0]]
+        return rows
+
+    def execute(self, sql, params=None):
+        params = params or []
+        match = _TABLE_RE.search(sql)
+        table = match.group(1).lower() if match else None
+        if sql.lstrip().upper().startswith("SELECT"):
+            rows = self._select(table, sql, params)
+            # Bản sao: fetchone() lấy dần từ danh sách, không được làm mất dòng của bảng giả
+            self._rows = list(rows) if self._dictionary else [tuple(row.values()) for row in rows]
+            self.column_names = tuple(rows[0].keys()) if rows else ()
+            self.rowcount = len(rows)
+        else:
+            # Ghi dữ liệu: không thay đổi dữ liệu giả để các lần đo giống nhau
+            self._rows = []
+            self.rowcount = 1
+            self.lastrowid = self._store.next_id
+
+    def executemany(self, sql, seq_params):
+        self.rowcount = len(seq_params)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, store):
+        self._store = store
+
+    def is_connected(self):
+        return True
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(self._store, dictionary=dictionary)
+
+    def start_transaction(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeBackend:
+    name = "fake"
+    label = "Fake"
+
+    def __init__(self, device_count=1000, log_count=1000):
+        base = datetime.datetime(2024, 1, 1, 8, 0, 0)
+        devices = []
+        for i in range(1, device_count + 1):
+            devices.append({
+                "id": i,
+                "mac": "00:11:22:%02x:%02x:%02x" % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF),
+                "hostname": f"DESKTOP-{i:06d}",
+                "key_code": f"KEY{i:013d}",
+                "active": i % 2,
+                "added_by": 1,
+                "created_at": base + datetime.timedelta(minutes=i),
+                "activated_at": base + datetime.timedelta(minutes=i + 5) if i % 2 else None,
+                "expires_at": base + datetime.timedelta(days=365),
+            })
+            devices[-1]["fingerprint"] = device_fingerprint(devices[-1]["mac"], devices[-1]["hostname"])
+        logs = [{
+            "id": i,
+            "mac": devices[i % device_count]["mac"],
+            "hostname": devices[i % device_count]["hostname"],
+            "action": ("activate", "generate_key", "reset")[i % 3],
+            "performed_by": 1,
+            "timestamp": base + datetime.timedelta(seconds=i),
+        } for i in range(1, log_count + 1)]
+        users = [
+            {"id": 1, "username": "admin", "password_hash": "x", "role": "admin", "created_at": base},
+            {"id": 2, "username": "staff", "password_hash": "x", "role": "staff", "created_at": base},
+        ]
+        self.tables = {"devices": devices, "logs": logs, "users": users, "user_permissions": []}
+        self.by_id = {name: {row["id"]: row for row in rows} for name, rows in self.tables.items()}
+        self.by_fingerprint = {row["fingerprint"]: row for row in devices}
+        self.by_key = {row["key_code"]: row for row in devices}
+        self.next_id = device_count + 1
+
+    def describe(self):
+        return {"devices": len(self.tables["devices"]), "logs": len(self.tables["logs"])}
+
+    def connect(self):
+        return FakeConnection(self)
+
+    def init_schema(self):
+        pass
+
+    # Upsert (phiên bản bảng table_versions, log_rollups): câu INSERT thường, cursor giả không ghi gì
+    def upsert_increment_sql(self, table, columns, key_columns, counter, replace=()):
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+
+
+# ==== ĐO ĐẠC ====
+
+# Gọi thẳng app ASGI, không qua socket hay HTTP client
+async def asgi_request(app, method, path, body=None, query=""):
+    payload = json.dumps(body).encode() if body is not None else b""
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "scheme": "http",
+        "server": ("bench", 80),
+        "client": ("127.0.0.1", 50000),
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+    }
+    messages = [{"type": "http.request", "body": payload, "more_body": False}]
+    status = {"bytes": 0}
+    # Client không ngắt kết nối: đọc hết body rồi chờ mãi, nếu trả http.disconnect thì
+    # StreamingResponse (RowSetResponse) bị hủy trước khi gửi dòng nào
+    connected = asyncio.Event()
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await connected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status["code"] = message["status"]
+        elif message["type"] == "http.response.body":
+            status["bytes"] += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status
+
+
+# Đo CPU time khi không bật tracemalloc, sau đó đo riêng bộ nhớ cấp phát cho mỗi lần gọi
+def measure(name, fn, iterations):
+    response = fn()  # warm-up
+    cpu_start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    cpu = time.process_time() - cpu_start
+
+    alloc_runs = max(1, min(iterations, 10))
+    tracemalloc.start()
+    peak_total = 0
+    retained_total = 0
+    for _ in range(alloc_runs):
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        fn()
+        after, peak = tracemalloc.get_traced_memory()
+        peak_total += peak - before
+        retained_total += max(0, after - before)
+    tracemalloc.stop()
+    return {
+        "name": name,
+        "status": response.get("code", "-") if isinstance(response, dict) else "-",
+        "body_kib": response["bytes"] / 1024 if isinstance(response, dict) else None,
+        "cpu_ms": cpu * 1000 / iterations,
+        "peak_kib": peak_total / alloc_runs / 1024,
+        "retained_kib": retained_total / alloc_runs / 1024,
+    }
+
+
+def build_cases(backend):
+    loop = asyncio.new_event_loop()
+    device = backend.tables["devices"][0]
+
+    def endpoint(method, path, body=None, query=""):
+        return lambda: loop.run_until_complete(asgi_request(main.app, method, path, body, query))
+
+    rows = backend.tables["devices"]
+    description = [(column,) for column in rows[0]]
+    tuples = [tuple(row.values()) for row in rows]
+
+    return [
+        ("POST /api/devices/check", endpoint("POST", "/api/devices/check", {"mac": device["mac"], "hostname": device["hostname"]})),
+        ("GET /api/devices", endpoint("GET", "/api/devices")),
+        ("GET /api/devices/{id}", endpoint("GET", f"/api/devices/{device['id']}")),
+        ("GET /api/logs", endpoint("GET", "/api/logs")),
+        ("GET /api/users", endpoint("GET", "/api/users")),
+        ("POST /api/devices/{id}/generate-key", endpoint("POST", f"/api/devices/{device['id']}/generate-key", query="user_id=1")),
+        ("POST /api/devices/activate", endpoint("POST", "/api/devices/activate", {"mac": device["mac"], "hostname": device["hostname"], "key_code": device["key_code"]})),
+        ("validate DeviceCheck", lambda: main.DeviceCheck.model_validate({"mac": device["mac"], "hostname": device["hostname"]})),
+        ("validate DeviceCreate", lambda: main.DeviceCreate.model_validate({"mac": device["mac"], "hostname": device["hostname"], "key_code": device["key_code"], "expires_at": "2025-01-01T00:00:00Z"})),
+        ("build dict rows", lambda: [dict(zip([d[0] for d in description], row)) for row in tuples]),
+        ("serialize device list", lambda: json.dumps(jsonable_encoder({"success": True, "data": rows}))),
+        ("convert_iso_to_mysql_date", lambda: main.convert_iso_to_mysql_date("2025-01-01T10:20:30.000Z")),
+    ]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark handler không cần database")
+    parser.add_argument("--devices", type=int, default=2000, help="Số thiết bị trong data layer giả")
+    parser.add_argument("--logs", type=int, default=2000, help="Số log trong data layer giả")
+    parser.add_argument("--iterations", type=int, default=100, help="Số lần lặp cho mỗi case")
+    parser.add_argument("--filter", default="", help="Chỉ chạy các case có tên chứa chuỗi này")
+    args = parser.parse_args()
+
+    backend = FakeBackend(args.devices, args.logs)
+    main.storage_backend = backend
+    # Các case gọi lặp lại cùng MAC/IP: tắt rate limit để đo handler chứ không đo nhánh trả 429
+    main.RATE_LIMIT_ENABLED = False
+
+    results = []
+    # Handler in rất nhiều log, chuyển sang devnull để không đo thời gian ghi terminal
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, fn in build_cases(backend):
+            if args.filter and args.filter not in name:
+                continue
+            results.append(measure(name, fn, args.iterations))
+
+    print(f"Fake data layer: {backend.describe()}, iterations={args.iterations}")
+    print(f"{'case':<40} {'status':>6} {'body KiB':>9} {'cpu ms/op':>10} {'peak KiB':>10} {'retained KiB':>13}")
+    for result in results:
+        body = f"{result['body_kib']:.1f}" if result["body_kib"] is not None else "-"
+        print(f"{result['name']:<40} {result['status']:>6} {body:>9} {result['cpu_ms']:>10.3f} {result['peak_kib']:>10.1f} {result['retained_kib']:>13.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,69 @@
+"""
+Benchmark serialize JSON cho danh sách thiết bị lớn
+
+So sánh đường xử lý mặc định của FastAPI (jsonable_encoder + json) với
+FastJSONResponse trả trực tiếp, trên danh sách thiết bị giả (mặc định 100k dòng).
+
+    python bench_json.py --rows 100000 --repeat 5
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import contextlib
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+import main
+import fast_json
+from fast_json import FastJSONResponse
+from bench_handlers import FakeBackend, asgi_request
+
+
+def best_of(fn, repeat):
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000, size
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark serialize danh sách thiết bị")
+    parser.add_argument("--rows", type=int, default=100000, help="Số dòng thiết bị")
+    parser.add_argument("--repeat", type=int, default=5, help="Số lần chạy, lấy lần nhanh nhất")
+    args = parser.parse_args()
+
+    backend = FakeBackend(args.rows, 1)
+    rows = backend.tables["devices"]
+    payload = {"success": True, "data": rows}
+
+    cases = [
+        ("jsonable_encoder + JSONResponse (cũ)", lambda: len(JSONResponse(jsonable_encoder(payload)).body)),
+        ("jsonable_encoder + FastJSONResponse", lambda: len(FastJSONResponse(jsonable_encoder(payload)).body)),
+        ("FastJSONResponse trực tiếp", lambda: len(FastJSONResponse(payload).body)),
+    ]
+
+    # Đo cả endpoint GET /api/devices chạy trong process với data layer giả
+    main.storage_backend = backend
+    loop = asyncio.new_event_loop()
+    cases.append(("GET /api/devices (end-to-end)", lambda: loop.run_until_complete(asgi_request(main.app, "GET", "/api/devices"))))
+
+    engine = "orjson" if fast_json.orjson is not None else "json (không có orjson)"
+    print(f"Rows: {args.rows}, repeat: {args.repeat}, fast_json engine: {engine}")
+    baseline = None
+    with open(os.devnull, "w") as devnull:
+        for name, fn in cases:
+            with contextlib.redirect_stdout(devnull):
+                elapsed, size = best_of(fn, args.repeat)
+            baseline = baseline or elapsed
+            size_text = f"{size / 1024 / 1024:.1f} MiB" if size and size > 1000 else "-"
+            print(f"{name:<40} {elapsed:>10.1f} ms {baseline / elapsed:>6.2f}x {size_text:>10}")
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,110 @@
+"""
+Benchmark bộ nhớ khi đọc toàn bộ bảng logs: dict mỗi dòng so với RowSet (tuple + header)
+
+Tạo một database SQLite tạm với N log rồi đo peak memory (tracemalloc) và thời
+gian cho từng cách đọc + serialize, gồm cả GET /api/logs chạy trong process.
+
+    python bench_rows.py --rows 200000
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import contextlib
+
+import main
+import storage
+from fast_json import FastJSONResponse
+from compact_rows import iter_json
+from bench_handlers import asgi_request
+
+LOGS_SQL = "SELECT * FROM logs ORDER BY timestamp DESC"
+
+
+def create_database(path, rows):
+    backend = storage.SQLiteBackend(path)
+    backend.init_schema()
+    connection = backend.connect()
+    cursor = connection.cursor()
+    base = datetime.datetime(2024, 1, 1, 8, 0, 0)
+    batch = []
+    for i in range(1, rows + 1):
+        batch.append((
+            "00:11:22:%02X:%02X:%02X" % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF),
+            f"DESKTOP-{i:06d}",
+            ("activate", "generate_key", "reset")[i % 3],
+            1,
+            (base + datetime.timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S"),
+        ))
+        if len(batch) == 10000:
+            cursor.executemany("INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES (%s, %s, %s, %s, %s)", batch)
+            batch = []
+    if batch:
+        cursor.executemany("INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES (%s, %s, %s, %s, %s)", batch)
+    connection.commit()
+    connection.close()
+    return backend
+
+
+# Mô phỏng gửi response: chỉ đếm số byte, không giữ lại
+def drain(chunks):
+    return sum(len(chunk) for chunk in chunks)
+
+
+def dict_rows():
+    rows = main.execute_query(LOGS_SQL, fetch=True, many=True)
+    return len(FastJSONResponse({"success": True, "data": rows}).body)
+
+
+def rowset_objects():
+    return drain(iter_json(main.execute_rows(LOGS_SQL), {"success": True}))
+
+
+def rowset_compact():
+    return drain(iter_json(main.execute_rows(LOGS_SQL), {"success": True}, compact=True))
+
+
+def measure(fn):
+    started = time.perf_counter()
+    size = fn()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed * 1000, peak, size
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark bộ nhớ đọc toàn bộ logs")
+    parser.add_argument("--rows", type=int, default=200000, help="Số dòng log")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            main.storage_backend = create_database(os.path.join(directory, "bench.db"), args.rows)
+        loop = asyncio.new_event_loop()
+        cases = [
+            ("dict mỗi dòng + FastJSONResponse (cũ)", dict_rows),
+            ("RowSet + stream objects", rowset_objects),
+            ("RowSet + stream compact", rowset_compact),
+            ("GET /api/logs (end-to-end)", lambda: loop.run_until_complete(asgi_request(main.app, "GET", "/api/logs"))),
+        ]
+
+        print(f"Rows: {args.rows}")
+        baseline = None
+        for name, fn in cases:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                elapsed, peak, size = measure(fn)
+            baseline = baseline or peak
+            size_text = f"{size / 1024 / 1024:.1f} MiB" if size and size > 1000 else "-"
+            print(f"{name:<40} {elapsed:>9.1f} ms  peak {peak / 1024 / 1024:>7.1f} MiB ({peak / baseline:>5.0%})  {size_text:>10}")
+        loop.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
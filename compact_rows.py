@@ -0,0 +1,66 @@
+"""
+Kết quả truy vấn dạng gọn cho các endpoint đọc nhiều dòng
+
+RowSet giữ mỗi dòng là một tuple và dùng chung một header tên cột, thay vì
+một dict (lặp lại các key) cho mỗi dòng như cursor(dictionary=True).
+RowSetResponse serialize trực tiếp từ RowSet theo từng lô và stream ra client:
+
+- format "objects" (mặc định): {"success": true, "data": [{...}, ...]} giống response cũ,
+  dict chỉ được tạo cho từng lô đang serialize rồi bỏ đi;
+- format "compact": {"success": true, "columns": [...], "rows": [[...], ...]}.
+"""
+from starlette.responses import StreamingResponse
+
+from fast_json import dumps
+
+FORMATS = ("objects", "compact")
+
+
+class RowSet:
+    __slots__ = ("columns", "rows")
+
+    def __init__(self, columns, rows):
+        self.columns = tuple(columns)
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def dicts(self):
+        columns = self.columns
+        return [dict(zip(columns, row)) for row in self.rows]
+
+
+def _inner(encoded):
+    # Bỏ dấu [ ] ngoài cùng của một mảng JSON đã encode
+    return encoded[1:-1]
+
+
+def iter_json(rowset, extra=None, compact=False, chunk_size=1000):
+    head = dict(extra or {})
+    if compact:
+        head["columns"] = list(rowset.columns)
+        key = b"rows"
+    else:
+        key = b"data"
+    # Mở object và mảng dữ liệu: {"success":true,...,"data":[
+    yield dumps(head)[:-1] + (b"," if head else b"") + b'"' + key + b'":['
+
+    columns = rowset.columns
+    rows = rowset.rows
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        if not compact:
+            chunk = [dict(zip(columns, row)) for row in chunk]
+        encoded = _inner(dumps(chunk))
+        yield encoded if start == 0 else b"," + encoded
+    yield b"]}"
+
+
+class RowSetResponse(StreamingResponse):
+    def __init__(self, rowset, extra=None, compact=False, headers=None, chunk_size=1000):
+        super().__init__(
+            iter_json(rowset, extra, compact, chunk_size),
+            media_type="application/json",
+            headers=headers,
+        )
@@ -0,0 +1,93 @@
+"""
+Đọc và kiểm tra file import thiết bị (CSV hoặc NDJSON) theo luồng
+
+File được đọc từng dòng, không nạp toàn bộ vào bộ nhớ. Mỗi dòng trả về
+(số dòng, dữ liệu đã chuẩn hóa, lỗi); dòng lỗi không làm dừng cả file.
+CSV cần header có ít nhất cột mac và hostname. MAC phải là địa chỉ 48-bit hợp lệ
+và được chuẩn hóa như /api/devices/check (AA:BB:CC:DD:EE:FF).
+"""
+import io
+import csv
+import json
+import datetime
+
+from fingerprint import is_valid_mac, normalize_mac, normalize_hostname
+
+FORMATS = ("csv", "ndjson")
+FIELDS = ("mac", "hostname", "key_code", "expires_at")
+MAX_LENGTHS = {"mac": 50, "hostname": 255, "key_code": 64}
+
+
+# Đoán định dạng từ tham số, tên file rồi content-type
+def detect_format(requested, filename, content_type):
+    if requested:
+        return requested.lower() if requested.lower() in FORMATS else None
+    name = (filename or "").lower()
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl", ".json")):
+        return "ndjson"
+    content_type = (content_type or "").lower()
+    if "csv" in content_type:
+        return "csv"
+    if "json" in content_type:
+        return "ndjson"
+    return None
+
+
+def _normalize(raw):
+    if not isinstance(raw, dict):
+        return None, "Row must be an object"
+    row = {}
+    for field in FIELDS:
+        value = raw.get(field)
+        if value is None:
+            row[field] = None
+            continue
+        value = str(value).strip()
+        row[field] = value or None
+    for field in ("mac", "hostname"):
+        if not row[field]:
+            return None, f"Missing {field}"
+    for field, max_length in MAX_LENGTHS.items():
+        if row[field] and len(row[field]) > max_length:
+            return None, f"{field} longer than {max_length} characters"
+    if not is_valid_mac(row["mac"]):
+        return None, f"Invalid MAC address: {row['mac']}"
+    row["mac"] = normalize_mac(row["mac"])
+    row["hostname"] = normalize_hostname(row["hostname"])
+    if row["expires_at"]:
+        try:
+            row["expires_at"] = datetime.datetime.fromisoformat(row["expires_at"]).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None, f"Invalid expires_at: {row['expires_at']}"
+    return row, None
+
+
+# Sinh (số dòng, row, lỗi) cho từng dòng dữ liệu của file nhị phân
+def iter_rows(binary_file, file_format):
+    text = io.TextIOWrapper(binary_file, encoding="utf-8-sig", errors="replace", newline="")
+    try:
+        if file_format == "csv":
+            reader = csv.DictReader(text)
+            header = [name.strip().lower() for name in reader.fieldnames or ()]
+            missing = [field for field in ("mac", "hostname") if field not in header]
+            if missing:
+                raise ValueError(f"CSV header missing column(s): {', '.join(missing)}")
+            reader.fieldnames = header
+            for raw in reader:
+                row, error = _normalize(raw)
+                yield reader.line_num, row, error
+        else:
+            for line_number, line in enumerate(text, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    raw = json.loads(line)
+                except ValueError as e:
+                    yield line_number, None, f"Invalid JSON: {e}"
+                    continue
+                row, error = _normalize(raw)
+                yield line_number, row, error
+    finally:
+        text.detach()  # không đóng file gốc của UploadFile
@@ -0,0 +1,156 @@
+"""
+Phát sự kiện thay đổi (thiết bị, log) tới các dashboard qua Server-Sent Events
+
+Mỗi sự kiện được encode một lần rồi đẩy vào hàng đợi có giới hạn của từng
+subscriber. Subscriber đọc chậm làm đầy hàng đợi sẽ bị ngắt kết nối thay vì
+để bộ nhớ tăng mãi; client kết nối lại với Last-Event-ID để lấy phần bị thiếu
+từ bộ đệm replay.
+"""
+import asyncio
+import threading
+from collections import deque
+
+from fast_json import dumps
+
+
+class Subscriber:
+    __slots__ = ("queue", "types", "dropped")
+
+    def __init__(self, buffer_size, types=None):
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.types = types
+        self.dropped = False
+
+
+class EventBroker:
+    def __init__(self, buffer_size=256, replay_size=512, max_subscribers=1000):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._replay = deque(maxlen=replay_size)  # (id, type, message)
+        self._seq = 0
+        self._loop = None
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped_subscribers = 0
+
+    def subscribe(self, types=None):
+        if len(self._subscribers) >= self.max_subscribers:
+            return None
+        self._loop = asyncio.get_running_loop()
+        subscriber = Subscriber(self.buffer_size, types)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    # Có thể gọi từ bất kỳ thread nào; việc đẩy vào hàng đợi luôn chạy trên event loop
+    def publish(self, event_type, data):
+        with self._lock:
+            self._seq += 1
+            event_id = self._seq
+            message = b"id: %d\nevent: %s\ndata: %s\n\n" % (event_id, event_type.encode(), dumps(data))
+            self._replay.append((event_id, event_type, message))
+            self.published += 1
+        if not self._subscribers:
+            return event_id
+
+        loop = self._loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._fanout(event_type, message)
+        elif loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._fanout, event_type, message)
+        return event_id
+
+    def _fanout(self, event_type, message):
+        for subscriber in list(self._subscribers):
+            if subscriber.types and event_type not in subscriber.types:
+                continue
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Consumer chậm: ngắt kết nối, client sẽ reconnect và replay
+                subscriber.dropped = True
+                self._subscribers.discard(subscriber)
+                self.dropped_subscribers += 1
+
+    # Các sự kiện sau last_id còn trong bộ đệm replay; None nếu đã bị đẩy ra khỏi bộ đệm
+    def replay(self, last_id, types=None):
+        with self._lock:
+            events = list(self._replay)
+        if events and last_id < events[0][0] - 1:
+            return None
+        return [message for event_id, event_type, message in events
+                if event_id > last_id and (not types or event_type in types)]
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "dropped_subscribers": self.dropped_subscribers,
+            "last_event_id": self._seq,
+            "buffer_size": self.buffer_size,
+        }
+
+
+class ChangeWaiters:
+    """Các client long-poll đang chờ một thiết bị đổi trạng thái, đánh thức bằng notify()"""
+
+    def __init__(self, max_waiters=10000):
+        self.max_waiters = max_waiters
+        self._waiters = {}  # key -> set(asyncio.Event)
+        self._count = 0
+        self._loop = None
+        self.notified = 0
+
+    # Đăng ký chờ theo một hoặc nhiều key (ví dụ ("device", mac, hostname) và ("id", device_id))
+    def register(self, *keys, event=None):
+        if event is None:
+            if self._count >= self.max_waiters:
+                return None
+            self._loop = asyncio.get_running_loop()
+            event = asyncio.Event()
+            self._count += 1
+        for key in keys:
+            self._waiters.setdefault(key, set()).add(event)
+        return event
+
+    def unregister(self, event, *keys):
+        self._count -= 1
+        for key in keys:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[key]
+
+    # Có thể gọi từ bất kỳ thread nào
+    def notify(self, *keys):
+        if not self._waiters:
+            return
+        loop = self._loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._wake(keys)
+        elif loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake, keys)
+
+    def _wake(self, keys):
+        events = set()
+        for key in keys:
+            events.update(self._waiters.pop(key, ()))
+        for event in events:
+            if not event.is_set():
+                event.set()
+                self.notified += 1
+
+    def stats(self):
+        return {"waiting": self._count, "keys": len(self._waiters), "notified": self.notified}
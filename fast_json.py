@@ -0,0 +1,55 @@
+"""
+Serializer JSON nhanh cho các response trả về danh sách dòng từ database
+
+Dùng orjson nếu có cài (xử lý datetime trực tiếp trong C), nếu không thì
+quay về json của thư viện chuẩn. Định dạng đầu ra giống jsonable_encoder:
+datetime -> ISO 8601, Decimal -> số, bytes -> chuỗi UTF-8.
+"""
+import json
+import decimal
+import datetime
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn
+    orjson = None
+
+
+# Các kiểu mysql.connector trả về mà JSON không hỗ trợ sẵn
+def _default(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8", errors="replace")
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(content):
+        return orjson.dumps(content, default=_default, option=_ORJSON_OPTIONS)
+else:
+    def dumps(content):
+        return json.dumps(
+            content,
+            default=_default,
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(",", ":"),
+        ).encode("utf-8")
+
+
+# Response class mặc định của API. Handler trả thẳng FastJSONResponse(...) để bỏ qua jsonable_encoder
+class FastJSONResponse(JSONResponse):
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
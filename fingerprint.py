@@ -0,0 +1,47 @@
+"""
+Chuẩn hóa MAC và fingerprint cố định cho tra cứu thiết bị
+
+Client gửi cùng một MAC với nhiều dạng (aa-bb-cc..., AABB.CCDD.EEFF, chữ
+thường/hoa). normalize_mac() đưa về dạng AA:BB:CC:DD:EE:FF. Fingerprint là
+chuỗi hex 28 ký tự: 12 ký tự là MAC 48-bit, 16 ký tự là hash 64-bit của
+hostname (không phân biệt hoa thường), lưu trong cột devices.fingerprint có index.
+"""
+import re
+import hashlib
+
+FINGERPRINT_LENGTH = 28
+
+_SEPARATORS_RE = re.compile(r"[\s:.\-]")
+_HEX12_RE = re.compile(r"^[0-9a-fA-F]{12}$")
+
+
+def _hash_hex(text, digest_size):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=digest_size).hexdigest()
+
+
+# Dạng chuẩn AA:BB:CC:DD:EE:FF; chuỗi không phải MAC hợp lệ được giữ nguyên (bỏ khoảng trắng)
+def normalize_mac(mac):
+    mac = (mac or "").strip()
+    digits = _SEPARATORS_RE.sub("", mac)
+    if not _HEX12_RE.match(digits):
+        return mac
+    digits = digits.upper()
+    return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+def is_valid_mac(mac):
+    return bool(_HEX12_RE.match(_SEPARATORS_RE.sub("", (mac or "").strip())))
+
+
+def normalize_hostname(hostname):
+    return (hostname or "").strip()
+
+
+def device_fingerprint(mac, hostname):
+    digits = _SEPARATORS_RE.sub("", (mac or "").strip())
+    if _HEX12_RE.match(digits):
+        mac_part = digits.lower()
+    else:
+        # MAC không hợp lệ vẫn cho fingerprint cố định độ dài
+        mac_part = _hash_hex("mac:" + (mac or "").strip(), 6)
+    return mac_part + _hash_hex(normalize_hostname(hostname).lower(), 8)
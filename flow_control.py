@@ -0,0 +1,271 @@
+"""
+Các cơ chế điều tiết luồng request dùng chung cho API
+"""
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+
+class SingleFlight:
+    """Gộp các lời gọi đồng thời cùng key thành một lần chạy (chạy trong threadpool)
+
+    Request đến sau khi một lời gọi cùng key đang chạy sẽ chờ và dùng chung kết quả
+    (hoặc lỗi) của lời gọi đó thay vì chạy thêm một truy vấn database nữa.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def do(self, key, fn, *args):
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            # Chạy trong task riêng để request đầu tiên bị hủy không làm hủy các request đang chờ chung
+            task = asyncio.ensure_future(run_in_threadpool(fn, *args))
+            self._calls[key] = task
+            self.executed += 1
+            task.add_done_callback(lambda done, key=key: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # đánh dấu lỗi đã được xử lý nếu không còn ai chờ
+
+    def stats(self):
+        calls = self.executed + self.shared
+        return {
+            "in_flight": len(self._calls),
+            "executed": self.executed,
+            "shared": self.shared,
+            "shared_ratio": round(self.shared / calls, 4) if calls else 0.0,
+        }
+
+
+class RateLimiter:
+    """Token bucket theo key (IP, MAC...): rate token/giây, tối đa burst token
+
+    Chỉ giữ tối đa max_keys bucket gần nhất (LRU) để bộ nhớ không tăng theo số client.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, last_refill]
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    # Trả về 0 nếu được phép, ngược lại là số giây cần chờ trước khi thử lại
+    def acquire(self, key, cost=1.0):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            self.rejected += 1
+            return (cost - bucket[0]) / self.rate if self.rate > 0 else 60.0
+
+    def stats(self):
+        return {"rate": self.rate, "burst": self.burst, "tracked_keys": len(self._buckets), "rejected": self.rejected}
+
+
+class ConcurrencyLimiter:
+    """Giới hạn số request đang xử lý cùng lúc; vượt quá thì từ chối ngay thay vì xếp hàng"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.in_flight >= self.limit:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {"limit": self.limit, "in_flight": self.in_flight, "peak": self.peak, "rejected": self.rejected}
+
+
+class CircuitBreaker:
+    """Ngắt mạch tới một database: sau failure_threshold lỗi liên tiếp thì chuyển sang open
+
+    Khi open, mọi lời gọi bị từ chối ngay trong reset_timeout giây thay vì chờ hết timeout
+    kết nối. Hết thời gian đó breaker sang half_open và chỉ cho một lời gọi thử: thành công
+    thì đóng lại (closed), lỗi thì mở lại thêm reset_timeout giây.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = float(reset_timeout)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.opened = 0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    self.rejected += 1
+                    return False
+                self._probing = True
+            return True
+
+    # Số giây tới lần thử lại tiếp theo (cho header Retry-After)
+    def retry_after(self):
+        with self._lock:
+            if self.state != self.OPEN:
+                return 1.0
+            return max(1.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                "open_for": round(time.monotonic() - self.opened_at, 3) if self.state == self.OPEN else None,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+
+class IdempotencyConflict(Exception):
+    """Idempotency-Key đã được dùng cho một request có nội dung khác"""
+
+
+class _IdempotentCall:
+    __slots__ = ("fingerprint", "task", "expires_at")
+
+    def __init__(self, fingerprint, task):
+        self.fingerprint = fingerprint
+        self.task = task
+        self.expires_at = None  # đặt khi lời gọi chạy xong
+
+
+class IdempotencyStore:
+    """Lưu kết quả theo Idempotency-Key để request gửi lại nhận đúng kết quả lần đầu
+
+    - Kết quả thành công được giữ ttl giây kể từ khi chạy xong, tối đa max_keys key
+      (bỏ key cũ nhất khi đầy).
+    - Request trùng key đến khi lần đầu còn đang chạy sẽ chờ và dùng chung kết quả (hoặc lỗi).
+    - Lần đầu lỗi thì key được bỏ, request gửi lại sau đó được chạy lại.
+    - Cùng key nhưng fingerprint (nội dung request) khác: IdempotencyConflict.
+    Chỉ dùng trong event loop, không cần khóa.
+    """
+
+    def __init__(self, ttl=86400.0, max_keys=10000):
+        self.ttl = float(ttl)
+        self.max_keys = max_keys
+        self._calls = OrderedDict()  # key -> _IdempotentCall, theo thứ tự bắt đầu
+        self.executed = 0
+        self.replayed = 0
+        self.conflicts = 0
+
+    # Chạy fn() (coroutine function) một lần cho mỗi key; trả về (kết quả, có phải kết quả lưu sẵn)
+    async def run(self, key, fingerprint, fn):
+        now = self._expire()
+        call = self._calls.get(key)
+        if call is not None and call.expires_at is not None and call.expires_at <= now:
+            del self._calls[key]
+            call = None
+        if call is not None:
+            if call.fingerprint != fingerprint:
+                self.conflicts += 1
+                raise IdempotencyConflict(key)
+            self.replayed += 1
+            return await asyncio.shield(call.task), True
+        
+        # Chạy trong task riêng để request đầu tiên bị hủy (client ngắt kết nối) không làm hủy lời gọi
+        call = _IdempotentCall(fingerprint, asyncio.ensure_future(fn()))
+        self._calls[key] = call
+        if len(self._calls) > self.max_keys:
+            self._calls.popitem(last=False)
+        self.executed += 1
+        call.task.add_done_callback(lambda done, key=key, call=call: self._finish(key, call, done))
+        return await asyncio.shield(call.task), False
+
+    def _finish(self, key, call, task):
+        if not task.cancelled() and task.exception() is None:
+            call.expires_at = time.monotonic() + self.ttl
+        elif self._calls.get(key) is call:
+            del self._calls[key]
+
+    # Bỏ các key hết hạn ở đầu hàng; key đang chạy chặn lại (TTL tính từ lúc xong nên thứ tự gần đúng)
+    def _expire(self):
+        now = time.monotonic()
+        while self._calls:
+            call = next(iter(self._calls.values()))
+            if call.expires_at is None or call.expires_at > now:
+                break
+            self._calls.popitem(last=False)
+        return now
+
+    def stats(self):
+        return {
+            "keys": len(self._calls),
+            "in_flight": sum(1 for call in self._calls.values() if call.expires_at is None),
+            "max_keys": self.max_keys,
+            "ttl": self.ttl,
+            "executed": self.executed,
+            "replayed": self.replayed,
+            "conflicts": self.conflicts,
+        }
@@ -0,0 +1,157 @@
+"""
+Lưu trữ log đã dọn (retention) vào các segment nén, chỉ ghi nối thêm
+
+Mỗi lần archive ghi một block = một gzip member chứa các dòng NDJSON, nối vào
+cuối segment hiện tại (gzip cho phép nhiều member liên tiếp trong một file).
+Mỗi block có một dòng trong index.jsonl (segment, offset, length, khoảng thời
+gian, khoảng id, số dòng). Index này là sparse time index: truy vấn theo thời
+gian chỉ đọc và giải nén các block có khoảng thời gian giao với khoảng cần tìm.
+
+Block được ghi (và fsync) trước dòng index; nếu crash ở giữa, phần byte thừa
+trong segment không được index trỏ tới nên không bao giờ bị đọc.
+
+Block được archive trước khi DELETE commit, nên một lô bị rollback có thể được
+archive lại ở lần chạy sau; query bỏ các dòng trùng id.
+"""
+import os
+import json
+import gzip
+import heapq
+import datetime
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khóa trong process
+    fcntl = None
+
+from fast_json import dumps
+
+INDEX_FILE = "index.jsonl"
+LOCK_FILE = ".lock"
+
+
+def _timestamp_text(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+
+class LogArchive:
+    def __init__(self, directory, segment_max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = threading.Lock()
+        self._blocks = []
+        self._index_offset = 0
+        self.archived_rows = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    # Đọc thêm các dòng index mới (có thể do process khác ghi)
+    def _refresh_index(self):
+        path = self._path(INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as index_file:
+            index_file.seek(self._index_offset)
+            for line in index_file:
+                if not line.endswith(b"\n"):
+                    break  # dòng đang ghi dở
+                self._blocks.append(json.loads(line))
+                self._index_offset += len(line)
+
+    def _current_segment(self):
+        if self._blocks:
+            last = self._blocks[-1]["segment"]
+            if os.path.getsize(self._path(last)) < self.segment_max_bytes:
+                return last
+        return "logs-%s.ndjson.gz" % datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+    # Ghi một block chứa các dòng log (dict có id, timestamp...), trả về metadata của block
+    def append(self, rows):
+        if not rows:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        payload = gzip.compress(b"".join(dumps(row) + b"\n" for row in rows))
+        timestamps = [_timestamp_text(row["timestamp"]) for row in rows]
+        ids = [row["id"] for row in rows]
+
+        with self._lock, open(self._path(LOCK_FILE), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh_index()
+            segment = self._current_segment()
+            with open(self._path(segment), "ab") as segment_file:
+                offset = segment_file.tell()
+                segment_file.write(payload)
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            block = {
+                "segment": segment,
+                "offset": offset,
+                "length": len(payload),
+                "first_ts": min(timestamps),
+                "last_ts": max(timestamps),
+                "first_id": min(ids),
+                "last_id": max(ids),
+                "count": len(rows),
+            }
+            line = json.dumps(block, separators=(",", ":")).encode() + b"\n"
+            with open(self._path(INDEX_FILE), "ab") as index_file:
+                index_file.write(line)
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            self._blocks.append(block)
+            self._index_offset += len(line)
+            self.archived_rows += len(rows)
+        return block
+
+    def _read_block(self, block):
+        with open(self._path(block["segment"]), "rb") as segment_file:
+            segment_file.seek(block["offset"])
+            payload = segment_file.read(block["length"])
+        return [json.loads(line) for line in gzip.decompress(payload).splitlines() if line]
+
+    # Các log trong [start, end) (chuỗi "YYYY-MM-DD HH:MM:SS"), lọc thêm theo filters (cột -> giá trị)
+    # Đọc block theo thứ tự first_ts, dừng khi đã đủ limit dòng và các block còn lại đều bắt đầu muộn hơn
+    def query(self, start, end, filters=None, limit=1000):
+        with self._lock:
+            self._refresh_index()
+            blocks = [block for block in self._blocks if block["last_ts"] >= start and block["first_ts"] < end]
+        blocks.sort(key=lambda block: block["first_ts"])
+        rows = []
+        seen = set()
+        blocks_read = 0
+        for block in blocks:
+            if len(rows) >= limit and block["first_ts"] > rows[-1][0][0]:
+                break
+            blocks_read += 1
+            for row in self._read_block(block):
+                timestamp = row["timestamp"].replace("T", " ")
+                if not start <= timestamp < end:
+                    continue
+                if filters and any(row.get(column) != value for column, value in filters.items()):
+                    continue
+                if row["id"] in seen:
+                    continue  # block ghi lại sau khi DELETE bị rollback có thể trùng id
+                seen.add(row["id"])
+                rows.append(((timestamp, row["id"]), row))
+            if len(rows) >= limit:
+                rows = heapq.nsmallest(limit, rows, key=lambda item: item[0])
+        rows.sort(key=lambda item: item[0])
+        return [row for _, row in rows[:limit]], blocks_read
+
+    def stats(self):
+        with self._lock:
+            self._refresh_index()
+            blocks = list(self._blocks)
+        return {
+            "directory": self.directory,
+            "segments": len({block["segment"] for block in blocks}),
+            "blocks": len(blocks),
+            "rows": sum(block["count"] for block in blocks),
+            "compressed_bytes": sum(block["length"] for block in blocks),
+            "oldest": min(block["first_ts"] for block in blocks) if blocks else None,
+        }
@@ -1,15 +1,43 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, Query
+from fastapi import FastAPI, HTTPException, Depends, Request, Query, File, UploadFile, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
+from fastapi.exception_handlers import http_exception_handler
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any, Union
 import os
 import datetime
 import mysql.connector
 from mysql.connector import Error
+import storage
+from query_cache import QueryCache, TableVersions, write_table, normalize_sql, read_tables
+from fast_json import FastJSONResponse
+from compact_rows import RowSet, RowSetResponse
+import compact_rows
+from events import EventBroker, ChangeWaiters
+from flow_control import SingleFlight, RateLimiter, ConcurrencyLimiter, CircuitBreaker, IdempotencyStore, IdempotencyConflict
+from stats import SummaryCounters
+import rollups
+import device_import
+from fingerprint import normalize_mac, normalize_hostname, device_fingerprint
+from log_archive import LogArchive
+import replicas
+from replicas import Replica, ReplicaSet, ReadYourWritesMiddleware
+import shards
+from shards import Shard, ShardMap, ScatterPlan, UnsupportedScatter
+from concurrent.futures import ThreadPoolExecutor
+from starlette.concurrency import run_in_threadpool
 import random
 from dotenv import load_dotenv
 import json
+import time
+import asyncio
+import email.utils
+import hashlib
+import zlib
 import uvicorn
+import threading
+from collections import deque
 import random
 import string
 
@@ -22,7 +50,8 @@ def generate_random_key():
     chars = string.ascii_uppercase + string.digits
     return "".join(random.choice(chars) for _ in range(key_length))
 
-app = FastAPI(title="Key Management Colony API")
+# FastJSONResponse (orjson) là response mặc định; các endpoint trả danh sách lớn trả thẳng instance để bỏ qua jsonable_encoder
+app = FastAPI(title="Key Management Colony API", default_response_class=FastJSONResponse)
 
 # Cấu hình CORS - đơn giản hóa để chỉ cho phép nguồn local truy cập API
 app.add_middleware(
@@ -37,8 +66,51 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified", "Idempotent-Replayed"],
 )
 
+# Nén gzip các response lớn (mặc định từ 1KB), trừ các stream SSE cần đẩy ngay từng sự kiện
+class StreamingAwareGZipMiddleware(GZipMiddleware):
+    no_gzip_paths = ("/api/events",)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.no_gzip_paths):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(StreamingAwareGZipMiddleware, minimum_size=int(os.getenv("GZIP_MIN_SIZE", "1024")))
+
+
+# Khởi tạo schema cho backend lưu trữ khi server khởi động
+@app.on_event("startup")
+async def init_storage():
+    try:
+        storage_backend.init_schema()
+        print(f"[Server] Schema {storage_backend.label} da duoc kiem tra/tao")
+    except Exception as e:
+        print(f"[Server Warning] Khong the khoi tao schema {storage_backend.label}: {e}")
+
+
+# Các tác vụ nền chạy định kỳ trong server (hết hạn thiết bị, ...)
+background_tasks = {}
+
+def start_periodic_task(name, interval, fn):
+    async def runner():
+        while True:
+            try:
+                await run_in_threadpool(fn)
+            except Exception as e:
+                print(f"[Background Error] Tác vụ {name} lỗi: {e}")
+            await asyncio.sleep(interval)
+    background_tasks[name] = asyncio.create_task(runner())
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks.values():
+        task.cancel()
+    background_tasks.clear()
+
 
 # OPTIONS route for CORS preflight requests
 @app.options("/{path:path}")
@@ -51,80 +123,606 @@ db_config = {
     "user": os.getenv("DB_USER", "KingAutoColony"),
     "password": os.getenv("DB_PASSWORD", "StrongPass123"),
     "database": os.getenv("DB_NAME", "license_system"),
+    # Không để request chờ hết timeout mặc định của connector khi MySQL không phản hồi
+    "connection_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "5")),
 }
 
-# Function để lấy kết nối database
-def get_db_connection():
+# Đọc biến môi trường dạng bật/tắt (1/true/yes/on)
+def env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# Backend lưu trữ: MySQL (mặc định) hoặc SQLite nhúng, chọn bằng DB_BACKEND
+storage_backend = storage.create_backend(db_config)
+
+# Read replica (DB_REPLICAS): SELECT của request chưa ghi được chuyển sang replica khỏe, lag <= DB_REPLICA_MAX_LAG_SECONDS
+DB_REPLICA_CHECK_SECONDS = float(os.getenv("DB_REPLICA_CHECK_SECONDS", "5"))
+replica_set = ReplicaSet(
+    [Replica(name, backend) for name, backend in storage.create_replica_backends(db_config)],
+    max_lag=float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5")),
+    stale_after=DB_REPLICA_CHECK_SECONDS * 3,
+)
+
+@app.on_event("startup")
+async def start_replica_checks():
+    if replica_set:
+        print(f"[Replica] {len(replica_set.replicas)} replica: {', '.join(replica.name for replica in replica_set.replicas)}")
+        start_periodic_task("replicas", DB_REPLICA_CHECK_SECONDS, replica_set.check)
+
+# Chia shard devices/logs (DB_SHARDS, xem shards.py); rỗng = mọi bảng trên một database
+shard_map = ShardMap(Shard(index, name, backend) for index, (name, backend) in enumerate(storage.create_shard_backends(db_config)))
+# Scatter-gather chạy song song trên các shard
+shard_executor = ThreadPoolExecutor(max_workers=max(4, 2 * len(shard_map)), thread_name_prefix="shard") if shard_map else None
+
+# Các shard chứa devices/logs; [None] = database chính khi không chia shard
+def data_shards():
+    return shard_map.shards if shard_map else [None]
+
+@app.on_event("startup")
+async def init_shards():
+    for shard in shard_map.shards:
+        try:
+            shard.backend.init_schema()
+            print(f"[Shard] Schema shard {shard.index} ({shard.name}) da duoc kiem tra/tao")
+        except Exception as e:
+            print(f"[Shard Warning] Khong the khoi tao schema shard {shard.index} ({shard.name}): {e}")
+
+# Circuit breaker cho database chính và từng shard: lỗi kết nối liên tiếp thì trả 503 ngay thay vì chờ timeout
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "5"))
+DB_BREAKER_RESET_SECONDS = float(os.getenv("DB_BREAKER_RESET_SECONDS", "10"))
+db_breaker = CircuitBreaker(DB_BREAKER_FAILURES, DB_BREAKER_RESET_SECONDS)
+shard_breakers = {shard.index: CircuitBreaker(DB_BREAKER_FAILURES, DB_BREAKER_RESET_SECONDS) for shard in shard_map.shards}
+
+# SELECT gặp lỗi tạm thời được chạy lại tối đa DB_READ_RETRIES lần, chờ ngẫu nhiên (full jitter) giữa các lần
+DB_READ_RETRIES = int(os.getenv("DB_READ_RETRIES", "2"))
+DB_RETRY_BASE_MS = float(os.getenv("DB_RETRY_BASE_MS", "50"))
+DB_RETRY_MAX_MS = float(os.getenv("DB_RETRY_MAX_MS", "1000"))
+db_retry_stats = {"retries": 0, "recovered": 0, "exhausted": 0}
+db_retry_lock = threading.Lock()
+
+def breaker_for(shard):
+    return shard_breakers[shard.index] if shard else db_breaker
+
+# Thử kết nối lại database có breaker đang mở, để phát hiện phục hồi mà không cần chờ request tới
+def probe_databases():
+    for shard in [None] + shard_map.shards:
+        if breaker_for(shard).state == CircuitBreaker.CLOSED:
+            continue
+        try:
+            get_db_connection(shard).close()
+        except Exception as e:
+            print(f"[DB Probe] Database {shard.name if shard else 'chính'} chưa phục hồi: {e}")
+
+@app.on_event("startup")
+async def start_db_probe():
+    start_periodic_task("db-probe", DB_BREAKER_RESET_SECONDS, probe_databases)
+
+# Cache kết quả SELECT của /api/query (tắt mặc định)
+query_cache = QueryCache(
+    enabled=env_flag("QUERY_CACHE_ENABLED"),
+    max_bytes=int(float(os.getenv("QUERY_CACHE_MAX_MB", "64")) * 1024 * 1024),
+    ttl=float(os.getenv("QUERY_CACHE_TTL", "60")),
+)
+
+# Broker Server-Sent Events: mỗi dashboard có hàng đợi giới hạn SSE_BUFFER_SIZE sự kiện
+event_broker = EventBroker(
+    buffer_size=int(os.getenv("SSE_BUFFER_SIZE", "256")),
+    replay_size=int(os.getenv("SSE_REPLAY_SIZE", "512")),
+    max_subscribers=int(os.getenv("SSE_MAX_SUBSCRIBERS", "1000")),
+)
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+
+# Các client đang long-poll chờ thiết bị được cấp key/kích hoạt
+activation_waiters = ChangeWaiters(max_waiters=int(os.getenv("LONG_POLL_MAX_WAITERS", "10000")))
+LONG_POLL_MAX_SECONDS = float(os.getenv("LONG_POLL_MAX_SECONDS", "60"))
+
+# Gộp các lượt tra cứu thiết bị giống nhau đang chạy đồng thời (single-flight)
+SINGLE_FLIGHT_ENABLED = env_flag("SINGLE_FLIGHT_ENABLED", True)
+device_lookups = SingleFlight()
+
+# Idempotency-Key cho các thao tác hay bị gửi lại (client cài đặt retry kích hoạt, admin bấm tạo key hai lần):
+# request lặp lại trong IDEMPOTENCY_TTL_SECONDS nhận lại response lần đầu, không chạy lại truy vấn
+idempotency_store = IdempotencyStore(
+    ttl=float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400")),
+    max_keys=int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000")),
+)
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# Chạy handler fn một lần cho mỗi Idempotency-Key; không có header thì chạy bình thường.
+# Fingerprint gồm method, path, query và body để cùng key với request khác bị từ chối (422)
+async def run_idempotent(request, key, body, fn):
+    if key is None:
+        return await fn()
+    key = key.strip()
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+    
+    fingerprint = hashlib.blake2b(
+        f"{request.method} {request.url.path}?{request.url.query}\n{json.dumps(body, sort_keys=True, default=str)}".encode(),
+        digest_size=16
+    ).hexdigest()
+    try:
+        result, replayed = await idempotency_store.run(key, fingerprint, fn)
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+    if replayed:
+        print(f"[Idempotency] Trả lại response đã lưu cho key {key}")
+        return FastJSONResponse(result, headers={"Idempotent-Replayed": "true"})
+    return result
+
+# Admission control cho các endpoint public của client: token bucket theo IP và MAC, giới hạn đồng thời toàn cục
+RATE_LIMIT_ENABLED = env_flag("RATE_LIMIT_ENABLED", True)
+TRUST_PROXY_HEADERS = env_flag("TRUST_PROXY_HEADERS")
+PUBLIC_DEVICE_PATHS = ("/api/devices/check", "/api/devices/activate", "/api/devices/wait")
+# Long-poll giữ kết nối lâu nhưng gần như không tốn tài nguyên, không tính vào giới hạn đồng thời và giới hạn IP
+UNBOUNDED_PUBLIC_PATHS = ("/api/devices/wait",)
+# Nhiều thiết bị sau cùng một NAT dùng chung IP: giới hạn IP phải cao hơn nhiều so với giới hạn mỗi MAC
+# để cả site khởi động cùng lúc không bị chặn; giới hạn chính cho từng máy là theo MAC
+ip_rate_limiter = RateLimiter(
+    rate=float(os.getenv("RATE_LIMIT_IP_PER_SEC", "50")),
+    burst=float(os.getenv("RATE_LIMIT_IP_BURST", "500")),
+)
+mac_rate_limiter = RateLimiter(
+    rate=float(os.getenv("RATE_LIMIT_MAC_PER_SEC", "1")),
+    burst=float(os.getenv("RATE_LIMIT_MAC_BURST", "5")),
+)
+public_concurrency = ConcurrencyLimiter(int(os.getenv("PUBLIC_MAX_CONCURRENCY", "64")))
+
+def client_ip(scope):
+    if TRUST_PROXY_HEADERS:
+        for name, value in scope.get("headers", []):
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+def retry_after_header(seconds):
+    return {"Retry-After": str(max(1, int(seconds + 0.999)))}
+
+# Database không phục vụ được: 503 + Retry-After. rejected = breaker đang mở từ chối, không thử kết nối
+class DatabaseUnavailable(HTTPException):
+    def __init__(self, detail, retry_after=1.0, rejected=False):
+        super().__init__(status_code=503, detail=detail, headers=retry_after_header(retry_after))
+        self.rejected = rejected
+
+# Handler bọc mọi lỗi thành 500; nếu nguyên nhân là database không phục vụ được thì trả 503 để client thử lại sau
+@app.exception_handler(HTTPException)
+async def database_unavailable_handler(request: Request, exc: HTTPException):
+    cause = exc
+    while cause is not None and not isinstance(cause, DatabaseUnavailable):
+        cause = cause.__cause__ or cause.__context__
+    return await http_exception_handler(request, cause or exc)
+
+# Giới hạn theo MAC, gọi trong handler sau khi đã đọc body
+def enforce_mac_rate_limit(mac):
+    if not RATE_LIMIT_ENABLED:
+        return
+    wait = mac_rate_limiter.acquire(normalize_mac(mac))
+    if wait:
+        raise HTTPException(status_code=429, detail="Too many requests for this device", headers=retry_after_header(wait))
+
+class PublicAdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not RATE_LIMIT_ENABLED or scope["type"] != "http" or scope["path"] not in PUBLIC_DEVICE_PATHS \
+                or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        
+        # Long-poll: mỗi thiết bị chỉ giữ một request chờ, giới hạn theo MAC trong handler, không tốn token của IP
+        if scope["path"] in UNBOUNDED_PUBLIC_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        wait = ip_rate_limiter.acquire(client_ip(scope))
+        if wait:
+            response = FastJSONResponse({"detail": "Too many requests"}, status_code=429, headers=retry_after_header(wait))
+            await response(scope, receive, send)
+            return
+        
+        # Hết chỗ: từ chối ngay với 503 thay vì để request xếp hàng chờ database
+        if not public_concurrency.try_acquire():
+            response = FastJSONResponse({"detail": "Server is busy, please retry"}, status_code=503, headers=retry_after_header(1))
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            public_concurrency.release()
+
+app.add_middleware(PublicAdmissionMiddleware)
+# POST /api/query chạy một câu lệnh: SELECT đọc được trên replica, câu lệnh ghi tự chuyển request sang primary
+app.add_middleware(ReadYourWritesMiddleware, read_only_paths=("/api/query",))
+
+# Phiên bản theo bảng trong process (guard đọc replica)
+table_versions = TableVersions()
+# Bảng có ETag/Last-Modified: phiên bản lưu ở bảng table_versions (database chính và từng shard) để mọi
+# worker/process cùng thấy; "*" là câu lệnh ghi không xác định được bảng
+VERSIONED_TABLES = ("devices", "logs", "users", "log_rollups")
+ANY_TABLE = "*"
+# Phiên bản đọc từ database được giữ trong process tối đa ngần này giây (ghi của chính process xóa ngay)
+ETAG_VERSIONS_TTL_SECONDS = float(os.getenv("ETAG_VERSIONS_TTL_SECONDS", "1"))
+shared_versions_cache = {"at": 0.0, "versions": {}, "generation": 0}
+
+# Tăng phiên bản của các bảng vừa ghi trên cursor của chính transaction ghi, ngay trước commit:
+# tăng lỗi thì cả lần ghi lỗi/rollback; thứ tự cố định để hai transaction không khóa chéo nhau
+def bump_shared_versions(cursor, tables, shard=None):
+    backend = shard.backend if shard else storage_backend
+    names = {ANY_TABLE if table is None else table for table in tables}
+    for name in sorted(names):
+        if name == ANY_TABLE or name in VERSIONED_TABLES:
+            storage.bump_table_version(backend, cursor, name)
+
+# Gọi sau mỗi câu lệnh ghi (đã commit) để xóa cache và tăng phiên bản trong process của bảng bị thay đổi
+def notify_table_write(sql=None, table=None):
+    replicas.mark_written()
+    table = table or (write_table(sql) if sql else None)
+    query_cache.invalidate(table)
+    table_versions.bump(table)
+    shared_versions_cache["generation"] += 1
+    shared_versions_cache["at"] = 0.0
+
+# Phiên bản dùng chung {bảng: (version, modified_at)}, cộng dồn trên database chính và các shard;
+# đọc trên primary vì replica có thể trễ, giữ trong process ETAG_VERSIONS_TTL_SECONDS giây
+def shared_versions():
+    now = time.time()
+    if now - shared_versions_cache["at"] < ETAG_VERSIONS_TTL_SECONDS:
+        return shared_versions_cache["versions"]
+    generation = shared_versions_cache["generation"]
+    versions = {}
+    for shard in [None] + list(shard_map.shards):
+        connection = get_db_connection(shard)
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT name, version, modified_at FROM table_versions")
+            for name, version, modified_at in cursor.fetchall():
+                total, latest = versions.get(name, (0, 0.0))
+                versions[name] = (total + version, max(latest, float(modified_at)))
+        finally:
+            cursor.close()
+            connection.close()
+    # Có lần ghi xen giữa lúc đọc: không cache kết quả có thể đã cũ
+    if generation == shared_versions_cache["generation"]:
+        shared_versions_cache["versions"] = versions
+        shared_versions_cache["at"] = now
+    return versions
+
+# Conditional GET: trả 304 nếu client đã có bản mới nhất, không cần chạy truy vấn
+# variant: phần khác nhau của cùng một URL (ví dụ danh sách cột của fields=) để ETag không trùng giữa các biểu diễn
+def check_not_modified(request, tables, variant=None):
+    try:
+        versions = shared_versions()
+    except Exception as e:
+        # Không đọc được phiên bản: không trả validator, luôn trả dữ liệu đầy đủ
+        print(f"[ETag Warning] Không đọc được phiên bản bảng: {e}")
+        return {}, None
+    etag = 'W/"' + "-".join(f"{name}.{versions.get(name, (0, 0))[0]}" for name in [ANY_TABLE] + list(tables)) + '"'
+    if variant:
+        etag = f'{etag[:-1]}-{zlib.crc32(variant.encode()):08x}"'
+    modified_at = int(max([table_versions.last_modified(tables)] + [versions[name][1] for name in [ANY_TABLE] + list(tables) if name in versions]))
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    # Last-Modified chỉ chính xác tới giây: chỉ gửi khi giây đó đã trôi qua, để ghi sau đó trong cùng giây không bị bỏ sót
+    if int(time.time()) > modified_at:
+        headers["Last-Modified"] = email.utils.formatdate(modified_at, usegmt=True)
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        if etag in candidates or "*" in candidates:
+            return headers, Response(status_code=304, headers=headers)
+        return headers, None
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            if "Last-Modified" in headers and modified_at <= since:
+                return headers, Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    return headers, None
+
+# Replica cho một câu SELECT, None = chạy trên primary. Bảng vừa được ghi trong khoảng lag cho phép
+# cũng đọc trên primary để replica chưa kịp cập nhật không trả dữ liệu cũ kèm ETag/phiên bản mới
+def pick_read_replica(sql):
+    if not replica_set or not replicas.replica_allowed() or not replicas.is_read_only(sql):
+        return None
+    tables = read_tables(sql)
+    if not tables or time.time() - table_versions.last_modified(tables) <= replica_set.max_lag + 1:
+        return None
+    return replica_set.choose()
+
+def get_replica_connection(replica):
+    print(f"[Replica] Đọc trên replica {replica.name}")
+    return replica.backend.connect()
+
+# Function để lấy kết nối database (shard: một shard dữ liệu, mặc định là database chính/global)
+def get_db_connection(shard=None):
+    backend = shard.backend if shard else storage_backend
+    label = f"{backend.label} shard {shard.index}" if shard else backend.label
+    breaker = breaker_for(shard)
+    if not breaker.allow():
+        raise DatabaseUnavailable(f"Database {label} tạm thời không khả dụng", breaker.retry_after(), rejected=True)
     try:
-        print(f"[MySQL] Đang kết nối với database... Config: {db_config}")
-        connection = mysql.connector.connect(**db_config)
+        print(f"[{label}] Đang kết nối với database... Config: {backend.describe()}")
+        connection = backend.connect()
         if connection.is_connected():
-            print(f"[MySQL] Kết nối thành công với database {db_config['database']}")
+            breaker.record_success()
+            print(f"[{label}] Kết nối thành công với database {backend.name}")
             return connection
         else:
-            print(f"[MySQL] Không thể kết nối với database mặc dù không có lỗi")
+            breaker.record_failure()
+            print(f"[{label}] Không thể kết nối với database mặc dù không có lỗi")
             raise HTTPException(status_code=500, detail="Không thể kết nối với database")
-    except Error as e:
-        print(f"[MySQL Error] Lỗi kết nối MySQL: {e}")
-        raise HTTPException(status_code=500, detail=f"Lỗi kết nối MySQL: {e}")
+    except storage.DatabaseError as e:
+        breaker.record_failure()
+        print(f"[{label} Error] Lỗi kết nối {label}: {e}")
+        raise DatabaseUnavailable(f"Lỗi kết nối {label}: {e}", breaker.retry_after()) from e
 
-# Hàm thực thi truy vấn và chuyển đổi kết quả sang dict
-def execute_query(sql, params=None, fetch=True, many=False):
+# Lỗi đáng chạy lại: lỗi tạm thời của database hoặc không kết nối được (breaker đang mở thì không)
+def is_retryable(error):
+    if isinstance(error, DatabaseUnavailable):
+        return not error.rejected
+    return storage.is_transient_error(error)
+
+# Chạy fn() (một câu lệnh trên kết nối mới). Mất kết nối giữa chừng được tính vào breaker; SELECT (idempotent)
+# gặp lỗi tạm thời được chạy lại với backoff ngẫu nhiên, không vượt quá hạn của một câu lệnh
+def run_with_retries(fn, sql, shard=None):
+    started = time.monotonic()
+    budget = storage.statement_timeout_ms() / 1000 or float("inf")
+    attempt = 0
+    while True:
+        try:
+            result = fn()
+            if attempt:
+                with db_retry_lock:
+                    db_retry_stats["recovered"] += 1
+            return result
+        except (Exception, Error) as e:
+            if storage.is_connection_error(e):
+                breaker_for(shard).record_failure()
+            if not replicas.is_read_only(sql) or not is_retryable(e):
+                raise
+            delay = random.uniform(0, min(DB_RETRY_MAX_MS, DB_RETRY_BASE_MS * 2 ** attempt)) / 1000
+            if attempt >= DB_READ_RETRIES or time.monotonic() - started + delay > budget:
+                with db_retry_lock:
+                    db_retry_stats["exhausted"] += 1
+                raise
+            attempt += 1
+            with db_retry_lock:
+                db_retry_stats["retries"] += 1
+            print(f"[SQL Retry] Lỗi tạm thời, chạy lại lần {attempt} sau {delay * 1000:.0f}ms: {e}")
+            time.sleep(delay)
+
+# Slow-query log: câu lệnh chạy lâu hơn SLOW_QUERY_MS được lưu kèm EXPLAIN (âm = tắt)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+slow_query_log = deque(maxlen=int(os.getenv("SLOW_QUERY_LOG_SIZE", "200")))
+slow_query_lock = threading.Lock()
+_EXPLAINABLE = ("select", "insert", "update", "delete", "replace")
+
+# Ghi lại câu lệnh chậm cùng kế hoạch thực thi, chạy EXPLAIN trên chính kết nối đó
+def record_slow_query(connection, sql, params, duration_ms, result):
+    if SLOW_QUERY_MS < 0 or duration_ms < SLOW_QUERY_MS:
+        return
+    
+    if isinstance(result, list):
+        row_count = len(result)
+    elif isinstance(result, dict) and "affected_rows" in result:
+        row_count = result["affected_rows"]
+    else:
+        row_count = 1 if result else 0
+    
+    explain = None
+    if sql.lstrip().lower().startswith(_EXPLAINABLE):
+        try:
+            explain_cursor = connection.cursor(dictionary=True)
+            explain_cursor.execute(getattr(storage_backend, "explain_prefix", "EXPLAIN ") + sql, params)
+            explain = explain_cursor.fetchall()
+            explain_cursor.close()
+        except Exception as e:
+            explain = f"EXPLAIN failed: {e}"
+    
+    entry = {
+        "sql": normalize_sql(sql),
+        "params_shape": [type(param).__name__ for param in (params or [])],
+        "duration_ms": round(duration_ms, 3),
+        "rows": row_count,
+        "explain": explain,
+        "recorded_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    with slow_query_lock:
+        slow_query_log.append(entry)
+    print(f"[Slow Query] {duration_ms:.1f}ms: {entry['sql']}")
+
+# Chạy một câu lệnh trên cursor có sẵn (chưa commit), trả về kết quả như execute_query
+def run_statement(cursor, sql, params=None, fetch=True, many=False):
+    print(f"[SQL Query] Thực thi: {sql}")
+    if params:
+        print(f"[SQL Params] {params}")
+    
+    cursor.execute(sql, params)
+    result = None
+    
+    # Các truy vấn thay đổi dữ liệu (INSERT, UPDATE, DELETE)
+    if not fetch:
+        affected_rows = cursor.rowcount
+        print(f"[SQL Result] So dong anh huong: {affected_rows}")
+        
+        # Lấy ID của bản ghi vừa chèn nếu là INSERT
+        last_insert_id = None
+        if sql.strip().upper().startswith("INSERT"):
+            last_insert_id = cursor.lastrowid
+            print(f"[SQL Result] Last Insert ID: {last_insert_id}")
+        
+        result = {
+            "affected_rows": affected_rows,
+            "last_insert_id": last_insert_id
+        }
+    # Các truy vấn lấy dữ liệu (SELECT)
+    else:
+        if many:
+            result = cursor.fetchall()
+            print(f"[SQL Result] Lấy nhiều dòng: {len(result)} kết quả")
+        else:
+            # Đối với truy vấn có thể trả về nhiều dòng nhưng chỉ muốn lấy một dòng
+            # Ta vẫn phải đọc hết tất cả các dòng để tránh lỗi "Unread result found"
+            one_result = cursor.fetchone()
+            # Đọc hết các dòng còn lại (nếu có) để tránh lỗi
+            remaining = cursor.fetchall()
+            if remaining:
+                print(f"[SQL Warning] Còn {len(remaining)} dòng kết quả chưa đọc, đã đọc hết để tránh lỗi")
+            result = one_result
+            print(f"[SQL Result] Lấy một dòng: {result}")
+    
+    return result
+
+# Chạy một câu lệnh trên một shard, commit ngay nếu là câu lệnh ghi
+def query_shard(shard, sql, params=None, fetch=True, many=False):
+    return run_with_retries(lambda: run_query(sql, params, fetch, many, shard), sql, shard)
+
+# Chạy một câu lệnh trên kết nối mới tới database chính, một shard hoặc một replica; commit nếu là câu lệnh ghi
+def run_query(sql, params=None, fetch=True, many=False, shard=None, replica=None):
+    connection = get_replica_connection(replica) if replica else get_db_connection(shard)
+    cursor = connection.cursor(dictionary=True)
     try:
-        print(f"[SQL Query] Thực thi: {sql}")
-        if params:
-            print(f"[SQL Params] {params}")
-            
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        
-        cursor.execute(sql, params)
-        result = None
-        
-        # Các truy vấn thay đổi dữ liệu (INSERT, UPDATE, DELETE)
+        started = time.perf_counter()
+        result = run_statement(cursor, sql, params, fetch=fetch, many=many)
+        record_slow_query(connection, sql, params, (time.perf_counter() - started) * 1000, result)
         if not fetch:
+            bump_shared_versions(cursor, [write_table(sql)], shard)
             connection.commit()
-            affected_rows = cursor.rowcount
-            print(f"[SQL Result] So dong anh huong: {affected_rows}")
-            
-            # Lấy ID của bản ghi vừa chèn nếu là INSERT
-            last_insert_id = None
-            if sql.strip().upper().startswith("INSERT"):
-                last_insert_id = cursor.lastrowid
-                print(f"[SQL Result] Last Insert ID: {last_insert_id}")
-            
-            result = {
-                "affected_rows": affected_rows,
-                "last_insert_id": last_insert_id
-            }
-        # Các truy vấn lấy dữ liệu (SELECT)
-        else:
-            if many:
-                result = cursor.fetchall()
-                print(f"[SQL Result] Lấy nhiều dòng: {len(result)} kết quả")
-            else:
-                # Đối với truy vấn có thể trả về nhiều dòng nhưng chỉ muốn lấy một dòng
-                # Ta vẫn phải đọc hết tất cả các dòng để tránh lỗi "Unread result found"
-                one_result = cursor.fetchone()
-                # Đọc hết các dòng còn lại (nếu có) để tránh lỗi
-                remaining = cursor.fetchall()
-                if remaining:
-                    print(f"[SQL Warning] Còn {len(remaining)} dòng kết quả chưa đọc, đã đọc hết để tránh lỗi")
-                result = one_result
-                print(f"[SQL Result] Lấy một dòng: {result}")
-            
+        return result
+    finally:
         cursor.close()
         connection.close()
+
+# Câu lệnh trên bảng đã chia shard: chạy trên shard chỉ định hoặc shard theo khóa định tuyến;
+# không có khóa thì SELECT được scatter-gather, UPDATE/DELETE chạy trên mọi shard
+def execute_sharded(sql, params, fetch, many, shard=None):
+    targets = shard_map.shards
+    if shard is None:
+        shard, by_id = shard_map.route(sql, params)
+    else:
+        by_id = False
+    if shard is not None:
+        result = query_shard(shard, sql, params, fetch, many)
+        missed = not result if fetch else result["affected_rows"] == 0
+        # ID không nằm trên shard suy ra từ ID (dữ liệu có từ trước khi chia shard): tìm trên các shard còn lại
+        if not (by_id and missed):
+            return result
+        targets = [target for target in shard_map.shards if target is not shard]
+    elif sql.lstrip().lower().startswith(("insert", "replace")):
+        raise ValueError("INSERT vào bảng đã chia shard phải có mac/hostname hoặc fingerprint")
+    
+    if not fetch:
+        results = list(shard_executor.map(lambda target: query_shard(target, sql, params, False), targets))
+        return {"affected_rows": sum(result["affected_rows"] for result in results), "last_insert_id": None}
+    
+    plan = ScatterPlan(sql, params)
+    results = list(shard_executor.map(lambda target: query_shard(target, plan.sql, plan.params, True, many), targets))
+    if many:
+        return plan.merge(results)
+    rows = plan.merge([[row] for row in results if row])
+    return rows[0] if rows else None
+
+# Hàm thực thi truy vấn và chuyển đổi kết quả sang dict
+# shard: chạy trên một shard dữ liệu cụ thể (tác vụ duyệt từng shard), mặc định định tuyến theo câu lệnh
+def execute_query(sql, params=None, fetch=True, many=False, shard=None):
+    if shard is not None or (shard_map and shards.is_sharded(sql)):
+        try:
+            if not fetch:
+                replicas.mark_written()
+            result = execute_sharded(sql, params, fetch, many, shard)
+            if not fetch:
+                notify_table_write(sql)
+            return result
+        except (DatabaseUnavailable, UnsupportedScatter):
+            raise
+        except (Exception, Error) as e:
+            print(f"[SQL Error] Lỗi thực thi truy vấn: {e}")
+            raise Exception(f"Lỗi thực thi truy vấn: {e}")
+    
+    replica = pick_read_replica(sql) if fetch else None
+    try:
+        if not fetch:
+            replicas.mark_written()
+        if replica:
+            result = run_query(sql, params, fetch, many, replica=replica)
+        else:
+            result = run_with_retries(lambda: run_query(sql, params, fetch, many), sql)
+        
+        if not fetch:
+            notify_table_write(sql)
         return result
+    except DatabaseUnavailable:
+        raise
+    except (Exception, Error) as e:
+        if replica is not None:
+            # Replica lỗi: loại khỏi vòng chọn và đọc lại (replica khác hoặc primary)
+            replica_set.mark_failed(replica, e)
+            print(f"[Replica Warning] {replica.name} lỗi, đọc lại: {e}")
+            return execute_query(sql, params, fetch, many)
+        print(f"[SQL Error] Lỗi thực thi truy vấn: {e}")
+        raise Exception(f"Lỗi thực thi truy vấn: {e}")
+
+# Đọc nhiều dòng dạng tuple + header dùng chung (RowSet) thay vì một dict mỗi dòng, cho các endpoint trả danh sách lớn
+def execute_rows(sql, params=None, shard=None):
+    if shard is None and shard_map and shards.is_sharded(sql):
+        plan = ScatterPlan(sql, params)
+        results = list(shard_executor.map(lambda target: execute_rows(plan.sql, plan.params, target), shard_map.shards))
+        columns = results[0].columns
+        return RowSet(plan.output_columns(columns), plan.merge([result.rows for result in results], columns))
+    
+    replica = pick_read_replica(sql) if shard is None else None
+    
+    def read_rows():
+        connection = get_replica_connection(replica) if replica else get_db_connection(shard)
+        cursor = connection.cursor()
+        try:
+            print(f"[SQL Query] Thực thi: {sql}")
+            if params:
+                print(f"[SQL Params] {params}")
+            started = time.perf_counter()
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            record_slow_query(connection, sql, params, (time.perf_counter() - started) * 1000, rows)
+            print(f"[SQL Result] Lấy nhiều dòng: {len(rows)} kết quả")
+            return RowSet(cursor.column_names, rows)
+        finally:
+            cursor.close()
+            connection.close()
+    
+    try:
+        return read_rows() if replica else run_with_retries(read_rows, sql, shard)
+    except DatabaseUnavailable:
+        raise
     except (Exception, Error) as e:
+        if replica is not None:
+            replica_set.mark_failed(replica, e)
+            print(f"[Replica Warning] {replica.name} lỗi, đọc lại: {e}")
+            return execute_rows(sql, params, shard)
         print(f"[SQL Error] Lỗi thực thi truy vấn: {e}")
         raise Exception(f"Lỗi thực thi truy vấn: {e}")
 
+def check_row_format(format):
+    if format not in compact_rows.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(compact_rows.FORMATS)}")
+    return format == "compact"
+
 # Model cho tất cả các thao tác
 class QueryRequest(BaseModel):
     sql: str
     params: Optional[List[Any]] = None
 
+# Model cho batch nhiều câu lệnh chạy trên cùng một kết nối
+class QueryBatchRequest(BaseModel):
+    queries: List[QueryRequest]
+    transaction: bool = False
+
 # Model cho User
 class UserCreate(BaseModel):
     username: str
@@ -136,6 +734,14 @@ class DeviceCheck(BaseModel):
     mac: str
     hostname: str
 
+# Model cho long-poll chờ kích hoạt: trạng thái client đang biết, chờ tới khi khác đi
+class DeviceWait(BaseModel):
+    mac: str
+    hostname: str
+    active: Optional[bool] = None
+    key_code: Optional[str] = None
+    timeout: Optional[float] = 30
+
 # Model cho Device
 class DeviceCreate(BaseModel):
     mac: str
@@ -166,6 +772,23 @@ class DeviceActivateWithKey(BaseModel):
     mac: str
     hostname: str
     key_code: str
+
+# Điều kiện chọn thiết bị cho thao tác hàng loạt (mac/hostname: khớp tiền tố)
+class DeviceBulkFilter(BaseModel):
+    active: Optional[bool] = None
+    mac: Optional[str] = None
+    hostname: Optional[str] = None
+    added_by: Optional[int] = None
+    has_key: Optional[bool] = None
+    expires_before: Optional[str] = None
+    expires_after: Optional[str] = None
+
+# Model cho thao tác hàng loạt: reset, delete, extend, activate, deactivate theo danh sách ID hoặc filter
+class DeviceBulkRequest(BaseModel):
+    operation: str
+    ids: Optional[List[int]] = None
+    filter: Optional[DeviceBulkFilter] = None
+    days: Optional[int] = None  # Số ngày gia hạn cho extend
     
 # Model cho Log
 class LogCreate(BaseModel):
@@ -186,6 +809,29 @@ class Permissions:
     MANAGE_USERS = 'manage_users'         # Quản lý người dùng
     GRANT_PERMISSIONS = 'grant_permissions' # Cấp quyền cho người dùng khác
 
+# Kiểm tra người dùng tồn tại và có quyền (admin luôn được phép), trả về thông tin người dùng
+def require_permission(user_id, permission, detail):
+    users = execute_query(
+        "SELECT id, role FROM users WHERE id = %s",
+        [user_id],
+        fetch=True,
+        many=True
+    )
+    if not users:
+        raise HTTPException(status_code=403, detail="Người dùng không tồn tại")
+    
+    user = users[0]
+    if user["role"] != "admin":
+        permissions = execute_query(
+            "SELECT id FROM user_permissions WHERE user_id = %s AND permission = %s",
+            [user_id, permission],
+            fetch=True,
+            many=True
+        )
+        if not permissions:
+            raise HTTPException(status_code=403, detail=detail)
+    return user
+
 # Models
 class PermissionRequest(BaseModel):
     user_id: int
@@ -216,10 +862,10 @@ async def test_insert():
 @app.get("/api/test-insert-mysql")
 async def test_insert_mysql():
     try:
-        # 1. Kết nối trực tiếp MySQL
-        connection = mysql.connector.connect(**db_config)
+        # 1. Kết nối trực tiếp database
+        connection = get_db_connection()
         if not connection.is_connected():
-            return {"success": False, "message": "Không thể kết nối MySQL"}
+            return {"success": False, "message": "Không thể kết nối database"}
         
         cursor = connection.cursor()
         
@@ -231,104 +877,1087 @@ async def test_insert_mysql():
         
         # 3. Thực hiện truy vấn INSERT
         cursor.execute(
-            "INSERT INTO users (username, password_hash, role, created_at) VALUES (%s, %s, %s, NOW())",
-            [test_username, test_password, "user"]
+            "INSERT INTO users (username, password_hash, role, created_at) VALUES (%s, %s, %s, NOW())",
+            [test_username, test_password, "user"]
+        )
+        
+        # 4. Commit thay đổi (lấy ID trước khi tăng phiên bản bảng trên cùng cursor)
+        last_id = cursor.lastrowid
+        bump_shared_versions(cursor, ["users"])
+        connection.commit()
+        notify_table_write(table="users")
+        
+        cursor.close()
+        connection.close()
+        
+        return {
+            "success": True, 
+            "message": "Test INSERT thành công", 
+            "username": test_username,
+            "id": last_id
+        }
+    except Exception as e:
+        print(f"[TEST INSERT ERROR] {str(e)}")
+        return {"success": False, "message": f"Lỗi: {str(e)}"}
+
+# Test kết nối
+@app.get("/api/test-connection")
+async def test_connection():
+    try:
+        connection = get_db_connection()
+        connection.close()
+        return {"success": True, "message": "Database connection successful"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Security check - Prevent certain dangerous operations
+def is_forbidden_query(sql):
+    sql_lower = sql.lower()
+    return "drop table" in sql_lower or "truncate table" in sql_lower
+
+# Generic query endpoint
+@app.post("/api/query")
+async def execute_generic_query(request: QueryRequest):
+    # Security check - Prevent certain dangerous operations
+    sql_lower = request.sql.lower()
+    if is_forbidden_query(request.sql):
+        raise HTTPException(
+            status_code=403, 
+            detail="Operation not allowed"
+        )
+    
+    try:
+        # Determine if we need to fetch results
+        is_select = sql_lower.startswith("select")
+        
+        # SELECT lặp lại được trả từ cache nếu bật QUERY_CACHE_ENABLED
+        cache_key = None
+        if is_select and query_cache.enabled and QueryCache.cacheable(request.sql):
+            cache_key = QueryCache.make_key(request.sql, request.params)
+            cached = query_cache.get(cache_key)
+            if cached is not None:
+                return FastJSONResponse({"success": True, "data": cached})
+            cache_generation = query_cache.generation
+        
+        result = execute_query(request.sql, request.params, fetch=is_select, many=is_select)
+        
+        if cache_key is not None:
+            query_cache.put(cache_key, request.sql, result, cache_generation)
+        
+        return FastJSONResponse({"success": True, "data": result})
+    except UnsupportedScatter as e:
+        # Không trả kết quả gộp sai/thiếu từ các shard
+        raise HTTPException(status_code=400, detail=f"Query not supported on sharded tables: {str(e)}")
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Query execution failed: {str(e)}"
+        )
+
+# Batch query endpoint - chạy nhiều câu lệnh theo thứ tự trên một kết nối
+@app.post("/api/query/batch")
+async def execute_batch_query(request: QueryBatchRequest):
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="No queries provided")
+    
+    # Kiểm tra toàn bộ batch trước khi chạy câu lệnh nào
+    for index, query in enumerate(request.queries):
+        if is_forbidden_query(query.sql):
+            raise HTTPException(
+                status_code=403,
+                detail=f"Operation not allowed (statement {index})"
+            )
+        # Batch chạy trên một kết nối tới database global, không với tới các shard
+        if shard_map and shards.is_sharded(query.sql):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Statement {index} uses a sharded table; use /api/query instead"
+            )
+    
+    connection = get_db_connection()
+    cursor = connection.cursor(dictionary=True)
+    results = []
+    written_sql = []
+    try:
+        if request.transaction:
+            connection.start_transaction()
+        
+        for index, query in enumerate(request.queries):
+            is_select = query.sql.lower().startswith("select")
+            try:
+                started = time.perf_counter()
+                data = run_statement(cursor, query.sql, query.params, fetch=is_select, many=is_select)
+                record_slow_query(connection, query.sql, query.params, (time.perf_counter() - started) * 1000, data)
+                if not is_select:
+                    written_sql.append(query.sql)
+                    # Ngoài transaction, mỗi câu lệnh ghi được commit ngay
+                    if not request.transaction:
+                        bump_shared_versions(cursor, [write_table(query.sql)])
+                        connection.commit()
+                        notify_table_write(query.sql)
+                results.append({"index": index, "success": True, "data": data})
+            except Exception as e:
+                print(f"[SQL Error] Lỗi câu lệnh {index} trong batch: {e}")
+                if request.transaction:
+                    connection.rollback()
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"Query execution failed at statement {index}, transaction rolled back: {str(e)}"
+                    )
+                results.append({"index": index, "success": False, "error": str(e)})
+        
+        if request.transaction:
+            bump_shared_versions(cursor, [write_table(sql) for sql in written_sql])
+            connection.commit()
+            for sql in written_sql:
+                notify_table_write(sql)
+        
+        return FastJSONResponse({
+            "success": all(result["success"] for result in results),
+            "transaction": request.transaction,
+            "results": results
+        })
+    finally:
+        cursor.close()
+        connection.close()
+
+# Metrics nội bộ của server
+@app.get("/api/metrics")
+async def get_metrics():
+    return {
+        "success": True,
+        "query_cache": query_cache.stats(),
+        "events": event_broker.stats(),
+        "long_poll": activation_waiters.stats(),
+        "single_flight": device_lookups.stats(),
+        "idempotency": idempotency_store.stats(),
+        "expiry": {"enabled": EXPIRY_ENGINE_ENABLED, **expiry_stats},
+        "rollups": {"enabled": ROLLUP_ENABLED, **rollup_stats},
+        "retention": {"retention_days": LOG_RETENTION_DAYS, **retention_stats, "archive": log_archive.stats() if LOG_ARCHIVE_ENABLED else None},
+        "replicas": replica_set.stats() if replica_set else None,
+        "shards": [{"index": shard.index, "name": shard.name} for shard in shard_map.shards] if shard_map else None,
+        "database": {
+            "breaker": db_breaker.stats(),
+            "shard_breakers": {shard.index: shard_breakers[shard.index].stats() for shard in shard_map.shards} if shard_map else None,
+            "read_retries": {"max": DB_READ_RETRIES, **db_retry_stats},
+            "statement_timeout_ms": storage.statement_timeout_ms(),
+            "connect_timeout": db_config["connection_timeout"],
+        },
+        "summary": {"updates": summary_counters.updates, "dirty": summary_counters.dirty, "reconciled_at": summary_counters.reconciled_at},
+        "admission": {
+            "enabled": RATE_LIMIT_ENABLED,
+            "ip_rate_limit": ip_rate_limiter.stats(),
+            "mac_rate_limit": mac_rate_limiter.stats(),
+            "concurrency": public_concurrency.stats()
+        }
+    }
+
+# Slow-query log: các câu lệnh chậm gần nhất kèm EXPLAIN
+@app.get("/api/admin/slow-queries")
+async def get_slow_queries(limit: int = Query(50, ge=1, le=1000)):
+    with slow_query_lock:
+        entries = list(slow_query_log)
+    entries.reverse()
+    return {
+        "success": True,
+        "threshold_ms": SLOW_QUERY_MS,
+        "capacity": slow_query_log.maxlen,
+        "total": len(entries),
+        "data": entries[:limit]
+    }
+
+# Xóa slow-query log
+@app.delete("/api/admin/slow-queries")
+async def clear_slow_queries():
+    with slow_query_lock:
+        count = len(slow_query_log)
+        slow_query_log.clear()
+    return {"success": True, "count": count}
+
+# ==== CHANGE TRACKING ====
+
+# Ghi nhận thay đổi của một dòng devices/logs vào change_log cho API delta-sync
+# op: "upsert" (thêm/sửa), "delete" (tombstone), "reset" (xóa toàn bộ bảng, row_id = None)
+def record_change(table, row_id, op="upsert"):
+    try:
+        execute_query(
+            "INSERT INTO change_log (table_name, row_id, op, changed_at) VALUES (%s, %s, %s, NOW())",
+            [table, row_id, op],
+            fetch=False
+        )
+    except Exception as e:
+        print(f"[Change Log Warning] Không ghi được thay đổi {table}#{row_id}: {e}")
+
+CHANGE_LOG_INSERT = "INSERT INTO change_log (table_name, row_id, op, changed_at) VALUES (%s, %s, %s, %s)"
+
+# change_log cho các dòng thay đổi trong một transaction trên devices/logs. change_log nằm ở database global:
+# không chia shard thì ghi luôn trong transaction; có shard thì trả lại để ghi sau khi shard commit (flush_change_rows)
+def stage_change_rows(cursor, shard, rows):
+    if shard is None:
+        if rows:
+            cursor.executemany(CHANGE_LOG_INSERT, rows)
+        return []
+    return rows
+
+def flush_change_rows(rows):
+    if not rows:
+        return
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        cursor.executemany(CHANGE_LOG_INSERT, rows)
+        connection.commit()
+        cursor.close()
+        connection.close()
+    except Exception as e:
+        print(f"[Change Log Warning] Không ghi được {len(rows)} thay đổi: {e}")
+
+# Thay đổi thiết bị: ghi change_log và đẩy sự kiện "device" tới các dashboard đang kết nối
+def device_changed(device_id, op="upsert", **fields):
+    record_change("devices", device_id, op)
+    event_broker.publish("device", {"id": device_id, "op": op, **fields})
+    keys = [("id", device_id)]
+    if "mac" in fields and "hostname" in fields:
+        keys.append(device_waiter_key(fields["mac"], fields["hostname"]))
+    activation_waiters.notify(*keys)
+
+# Thêm một dòng log hoạt động, ghi nhận thay đổi và đẩy sự kiện "log", trả về ID của log
+def write_log(mac, hostname, action, performed_by):
+    result = execute_query(
+        "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES (%s, %s, %s, %s, NOW())",
+        [mac, hostname, action, performed_by],
+        fetch=False
+    )
+    log_id = result["last_insert_id"]
+    record_change("logs", log_id)
+    summary_counters.log_added(action)
+    event_broker.publish("log", {
+        "id": log_id,
+        "mac": mac,
+        "hostname": hostname,
+        "action": action,
+        "performed_by": performed_by,
+        "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    })
+    return log_id
+
+SYNC_TABLES = ("devices", "logs")
+
+# Các cột client được chọn qua fields= trên các endpoint đọc (whitelist, không đưa chuỗi của client vào SQL)
+READ_COLUMNS = {
+    "devices": ("id", "mac", "hostname", "key_code", "active", "added_by", "created_at", "activated_at", "expires_at", "fingerprint"),
+    "logs": ("id", "mac", "hostname", "action", "performed_by", "timestamp"),
+    "users": ("id", "username", "role", "created_at"),
+}
+
+# Danh sách cột cho SELECT từ tham số fields (ví dụ "id,mac,active"); không có fields thì trả mặc định
+def select_columns(table, fields, required=(), default="*"):
+    if not fields:
+        return default
+    columns = list(required)
+    for name in fields.split(","):
+        name = name.strip().lower()
+        if not name or name in columns:
+            continue
+        if name not in READ_COLUMNS[table]:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown field '{name}' for {table}, allowed: {', '.join(READ_COLUMNS[table])}"
+            )
+        columns.append(name)
+    if not columns:
+        raise HTTPException(status_code=400, detail="fields must contain at least one column")
+    return ", ".join(columns)
+
+# Delta sync: trả về các dòng thay đổi/bị xóa kể từ cursor (phiên bản change_log)
+@app.get("/api/sync/{table}")
+async def sync_changes(
+    table: str,
+    since: int = Query(0, ge=0, description="Cursor trả về từ lần sync trước, 0 = lấy toàn bộ"),
+    since_time: Optional[str] = Query(None, description="Thay cho cursor: lấy thay đổi từ thời điểm này"),
+    limit: int = Query(1000, ge=1, le=10000),
+    fields: Optional[str] = Query(None, description="Các cột cần lấy, phân tách bằng dấu phẩy (luôn có id)")
+):
+    if table not in SYNC_TABLES:
+        raise HTTPException(status_code=404, detail="Sync is only supported for devices and logs")
+    
+    try:
+        select_sql = f"SELECT {select_columns(table, fields, required=('id',))} FROM {table}"
+        bounds = execute_query(
+            "SELECT COALESCE(MIN(id), 1) AS oldest, COALESCE(MAX(id), 0) AS latest FROM change_log WHERE table_name = %s",
+            [table]
+        )
+        
+        if since_time:
+            since_row = execute_query(
+                "SELECT COALESCE(MAX(id), 0) AS version FROM change_log WHERE table_name = %s AND changed_at < %s",
+                [table, since_time.replace("T", " ").rstrip("Z")[:19]]
+            )
+            since = since_row["version"]
+        
+        # Lần sync đầu tiên hoặc cursor quá cũ (change_log đã bị dọn): trả về toàn bộ bảng
+        if since == 0 or since < bounds["oldest"] - 1:
+            rows = execute_query(f"{select_sql} ORDER BY id", fetch=True, many=True)
+            return FastJSONResponse({
+                "success": True,
+                "table": table,
+                "full": True,
+                "reset": False,
+                "cursor": bounds["latest"],
+                "has_more": False,
+                "upserts": rows,
+                "deletes": []
+            })
+        
+        changes = execute_query(
+            "SELECT id, row_id, op FROM change_log WHERE table_name = %s AND id > %s ORDER BY id LIMIT %s",
+            [table, since, limit],
+            fetch=True,
+            many=True
+        )
+        
+        # Gộp theo dòng: thao tác cuối cùng thắng
+        reset = False
+        latest_op = {}
+        for change in changes:
+            if change["op"] == "reset":
+                reset = True
+                latest_op.clear()
+            else:
+                latest_op[change["row_id"]] = change["op"]
+        
+        upsert_ids = [row_id for row_id, op in latest_op.items() if op == "upsert"]
+        deletes = [row_id for row_id, op in latest_op.items() if op == "delete"]
+        upserts = []
+        if upsert_ids:
+            placeholders = ", ".join(["%s"] * len(upsert_ids))
+            upserts = execute_query(
+                f"{select_sql} WHERE id IN ({placeholders}) ORDER BY id",
+                upsert_ids,
+                fetch=True,
+                many=True
+            )
+            # Dòng đã bị xóa sau khi thay đổi được ghi nhận cũng là tombstone
+            found = {row["id"] for row in upserts}
+            deletes.extend(row_id for row_id in upsert_ids if row_id not in found)
+        
+        return FastJSONResponse({
+            "success": True,
+            "table": table,
+            "full": False,
+            "reset": reset,
+            "cursor": changes[-1]["id"] if changes else since,
+            "has_more": len(changes) == limit,
+            "upserts": upserts,
+            "deletes": sorted(deletes)
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error syncing {table}: {str(e)}"
+        )
+
+# ==== EVENTS (SSE) ====
+
+# Stream sự kiện thay đổi thiết bị/log cho dashboard (Server-Sent Events)
+@app.get("/api/events/stream")
+async def stream_events(
+    request: Request,
+    types: Optional[str] = Query(None, description="Lọc loại sự kiện, ví dụ: device,log")
+):
+    event_types = {name.strip() for name in types.split(",") if name.strip()} if types else None
+    subscriber = event_broker.subscribe(event_types)
+    if subscriber is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many event stream subscribers",
+            headers={"Retry-After": "5"}
+        )
+    
+    # Client kết nối lại gửi Last-Event-ID để nhận các sự kiện bị lỡ
+    backlog = []
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        backlog = event_broker.replay(int(last_event_id), event_types)
+        if backlog is None:
+            backlog = [b"event: resync\ndata: {}\n\n"]
+    
+    async def event_stream():
+        try:
+            yield b"retry: 3000\n\n"
+            for message in backlog:
+                yield message
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if subscriber.dropped:
+                        break
+                    yield b": ping\n\n"
+                    continue
+                yield message
+                if subscriber.dropped and subscriber.queue.empty():
+                    break
+        finally:
+            event_broker.unsubscribe(subscriber)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ==== EXPIRY ENGINE ====
+
+EXPIRY_ENGINE_ENABLED = env_flag("EXPIRY_ENGINE_ENABLED", True)
+EXPIRY_SWEEP_SECONDS = float(os.getenv("EXPIRY_SWEEP_SECONDS", "60"))
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "500"))
+EXPIRY_MAX_BATCHES = int(os.getenv("EXPIRY_MAX_BATCHES", "20"))
+expiry_stats = {"runs": 0, "expired_total": 0, "last_run": None, "last_expired": 0}
+
+# expires_at có thể là datetime, date (cột DATE) hoặc chuỗi (SQLite, dữ liệu cũ)
+def is_expired(expires_at, now=None):
+    if not expires_at:
+        return False
+    if isinstance(expires_at, str):
+        try:
+            expires_at = datetime.datetime.fromisoformat(expires_at)
+        except ValueError:
+            return False
+    if not isinstance(expires_at, datetime.datetime):
+        expires_at = datetime.datetime.combine(expires_at, datetime.time.min)
+    return expires_at <= (now or datetime.datetime.now())
+
+# Hủy kích hoạt một lô thiết bị đã hết hạn trong một transaction, ghi log và change_log (devices + logs); trả về (thiết bị, log)
+def expire_device_batch(now_str, batch_size, shard=None):
+    connection = get_db_connection(shard)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        connection.start_transaction()
+        cursor.execute(
+            "SELECT id, mac, hostname FROM devices WHERE active = 1 AND expires_at IS NOT NULL AND expires_at <= %s "
+            "ORDER BY expires_at LIMIT %s" + storage_backend.lock_rows_suffix,
+            [now_str, batch_size]
+        )
+        expired = cursor.fetchall()
+        if not expired:
+            connection.rollback()
+            return [], []
+        
+        ids = [device["id"] for device in expired]
+        placeholders = ", ".join(["%s"] * len(ids))
+        cursor.execute(f"UPDATE devices SET active = 0 WHERE id IN ({placeholders})", ids)
+        cursor.execute(
+            "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES "
+            + ", ".join(["(%s, %s, %s, %s, %s)"] * len(expired)),
+            [value for device in expired for value in (device["mac"], device["hostname"], "expire", 1, now_str)]
+        )
+        # Lấy lại ID log bằng một SELECT: ID của INSERT nhiều dòng không chắc liên tiếp trên MySQL
+        cursor.execute(
+            f"SELECT id, mac, hostname, action, performed_by, timestamp FROM logs WHERE action = %s AND timestamp = %s "
+            f"AND mac IN ({', '.join(['%s'] * len(expired))}) ORDER BY id",
+            ["expire", now_str] + [device["mac"] for device in expired]
+        )
+        pairs = {(device["mac"], device["hostname"]) for device in expired}
+        logs = [
+            {**log, "timestamp": now_str}
+            for log in cursor.fetchall() if (log["mac"], log["hostname"]) in pairs
+        ]
+        changes = stage_change_rows(
+            cursor, shard,
+            [("devices", device_id, "upsert", now_str) for device_id in ids]
+            + [("logs", log["id"], "upsert", now_str) for log in logs]
+        )
+        bump_shared_versions(cursor, ["devices", "logs"], shard)
+        connection.commit()
+        flush_change_rows(changes)
+        return expired, logs
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+# Một lượt quét: xử lý tối đa EXPIRY_MAX_BATCHES lô, mỗi lô EXPIRY_BATCH_SIZE thiết bị
+def run_expiry_sweep():
+    now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    total = 0
+    for shard in data_shards():
+        for _ in range(EXPIRY_MAX_BATCHES):
+            expired, logs = expire_device_batch(now_str, EXPIRY_BATCH_SIZE, shard)
+            if not expired:
+                break
+            total += len(expired)
+            summary_counters.apply(devices_active=-len(expired), devices_inactive=len(expired))
+            summary_counters.log_added("expire", len(expired))
+            
+            # Xóa cache/ETag và báo cho dashboard, client long-poll
+            notify_table_write(table="devices")
+            notify_table_write(table="logs")
+            notify_table_write(table="change_log")
+            for device in expired:
+                event_broker.publish("device", {"id": device["id"], "op": "upsert", "mac": device["mac"], "hostname": device["hostname"], "active": False, "expired": True})
+                activation_waiters.notify(("id", device["id"]), device_waiter_key(device["mac"], device["hostname"]))
+            for log in logs:
+                event_broker.publish("log", log)
+            
+            if len(expired) < EXPIRY_BATCH_SIZE:
+                break
+    
+    expiry_stats["runs"] += 1
+    expiry_stats["expired_total"] += total
+    expiry_stats["last_expired"] = total
+    expiry_stats["last_run"] = now_str
+    if total:
+        print(f"[Expiry] Đã hủy kích hoạt {total} thiết bị hết hạn")
+    return total
+
+@app.on_event("startup")
+async def start_expiry_engine():
+    if EXPIRY_ENGINE_ENABLED:
+        start_periodic_task("expiry", EXPIRY_SWEEP_SECONDS, run_expiry_sweep)
+
+# Chạy ngay một lượt quét hết hạn (admin)
+@app.post("/api/admin/expiry/run")
+async def trigger_expiry_sweep():
+    try:
+        expired = await run_in_threadpool(run_expiry_sweep)
+        return {"success": True, "expired": expired, "stats": expiry_stats}
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error running expiry sweep: {str(e)}"
+        )
+
+# ==== DASHBOARD SUMMARY ====
+
+STATS_RECONCILE_SECONDS = float(os.getenv("STATS_RECONCILE_SECONDS", "300"))
+STATS_EXPIRING_SOON_DAYS = int(os.getenv("STATS_EXPIRING_SOON_DAYS", "30"))
+summary_counters = SummaryCounters()
+
+# Đếm lại toàn bộ từ database để sửa sai lệch của bộ đếm trong bộ nhớ
+def reconcile_summary_counters():
+    now = datetime.datetime.now()
+    soon = now + datetime.timedelta(days=STATS_EXPIRING_SOON_DAYS)
+    devices = execute_query(
+        "SELECT COUNT(*) AS devices_total, "
+        "COALESCE(SUM(CASE WHEN active = 1 THEN 1 ELSE 0 END), 0) AS devices_active, "
+        "COALESCE(SUM(CASE WHEN active = 1 THEN 0 ELSE 1 END), 0) AS devices_inactive, "
+        "COALESCE(SUM(CASE WHEN key_code IS NOT NULL AND key_code <> '' THEN 1 ELSE 0 END), 0) AS keys_issued, "
+        "COALESCE(SUM(CASE WHEN active = 1 AND expires_at > %s AND expires_at <= %s THEN 1 ELSE 0 END), 0) AS expiring_soon "
+        "FROM devices",
+        [now.strftime("%Y-%m-%d %H:%M:%S"), soon.strftime("%Y-%m-%d %H:%M:%S")]
+    )
+    actions = execute_query(
+        "SELECT action, COUNT(*) AS total FROM logs GROUP BY action",
+        fetch=True,
+        many=True
+    )
+    summary_counters.reconcile(devices or {}, {row["action"]: row["total"] for row in actions})
+
+def maybe_reconcile_summary():
+    if summary_counters.needs_reconcile(STATS_RECONCILE_SECONDS):
+        reconcile_summary_counters()
+
+@app.on_event("startup")
+async def start_summary_reconciler():
+    # Kiểm tra thường xuyên để bộ đếm bị đánh dấu dirty được sửa trong vài giây
+    start_periodic_task("summary", min(10.0, STATS_RECONCILE_SECONDS), maybe_reconcile_summary)
+
+# Tổng hợp cho dashboard, đọc từ bộ đếm trong bộ nhớ (O(1), không truy vấn database)
+@app.get("/api/stats/summary")
+async def get_stats_summary():
+    summary = summary_counters.snapshot()
+    reconciled_at = summary_counters.reconciled_at
+    return {
+        "success": True,
+        "data": summary,
+        "expiring_soon_days": STATS_EXPIRING_SOON_DAYS,
+        "reconciled_at": datetime.datetime.fromtimestamp(reconciled_at).strftime("%Y-%m-%d %H:%M:%S") if reconciled_at else None,
+        "pending_reconcile": summary_counters.dirty
+    }
+
+# ==== LOG ROLLUPS ====
+
+ROLLUP_ENABLED = env_flag("ROLLUP_ENABLED", True)
+ROLLUP_INTERVAL_SECONDS = float(os.getenv("ROLLUP_INTERVAL_SECONDS", "10"))
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "5000"))
+ROLLUP_MAX_BATCHES = int(os.getenv("ROLLUP_MAX_BATCHES", "20"))
+# Chỉ tổng hợp log cũ hơn số giây này, để log của transaction commit muộn (id nhỏ hơn) không bị bỏ qua
+ROLLUP_SETTLE_SECONDS = float(os.getenv("ROLLUP_SETTLE_SECONDS", "2"))
+ROLLUP_MAX_BUCKETS = int(os.getenv("ROLLUP_MAX_BUCKETS", "5000"))
+rollup_stats = {"runs": 0, "rolled_up_total": 0, "last_rolled_up": 0, "last_run": None, "last_id": 0}
+
+# log_rollups và watermark nằm cùng shard với logs, mỗi shard tổng hợp riêng
+def ensure_rollup_state():
+    for shard in data_shards():
+        state = execute_query(
+            "SELECT last_id FROM rollup_state WHERE name = %s",
+            [rollups.ROLLUP_STATE_NAME],
+            shard=shard
+        )
+        if state is None:
+            try:
+                execute_query(
+                    "INSERT INTO rollup_state (name, last_id, updated_at) VALUES (%s, 0, NOW())",
+                    [rollups.ROLLUP_STATE_NAME],
+                    fetch=False,
+                    shard=shard
+                )
+            except Exception:
+                pass  # worker khác vừa tạo
+
+# Tổng hợp một lô log mới (id > watermark) vào log_rollups, cùng transaction với việc nâng watermark
+def rollup_log_batch(batch_size, shard=None):
+    connection = get_db_connection(shard)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        connection.start_transaction()
+        cursor.execute(
+            "SELECT last_id FROM rollup_state WHERE name = %s" + storage_backend.lock_rows_suffix,
+            [rollups.ROLLUP_STATE_NAME]
+        )
+        state = cursor.fetchone()
+        if state is None:
+            # Worker khác đang giữ khóa watermark
+            connection.rollback()
+            return 0
+        
+        cursor.execute(
+            "SELECT id, action, performed_by, timestamp FROM logs WHERE id > %s ORDER BY id LIMIT %s",
+            [state["last_id"], batch_size]
+        )
+        logs = cursor.fetchall()
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=ROLLUP_SETTLE_SECONDS)
+        for index, log in enumerate(logs):
+            timestamp = log["timestamp"]
+            if isinstance(timestamp, datetime.datetime) and timestamp > cutoff:
+                logs = logs[:index]
+                break
+        if not logs:
+            connection.rollback()
+            return 0
+        
+        counts = rollups.aggregate(logs)
+        cursor.executemany(
+            storage_backend.upsert_increment_sql("log_rollups", rollups.UPSERT_COLUMNS, rollups.UPSERT_KEY, "count"),
+            [key + (count,) for key, count in counts.items()]
+        )
+        last_id = logs[-1]["id"]
+        cursor.execute(
+            "UPDATE rollup_state SET last_id = %s, updated_at = NOW() WHERE name = %s",
+            [last_id, rollups.ROLLUP_STATE_NAME]
+        )
+        bump_shared_versions(cursor, ["log_rollups"], shard)
+        connection.commit()
+        rollup_stats["last_id"] = last_id
+        return len(logs)
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+# Chạy tối đa max_batches lô (None = tới khi hết log mới, dùng cho backfill)
+def run_log_rollups(max_batches=ROLLUP_MAX_BATCHES):
+    total = 0
+    for shard in data_shards():
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            rolled_up = rollup_log_batch(ROLLUP_BATCH_SIZE, shard)
+            batches += 1
+            total += rolled_up
+            if rolled_up < ROLLUP_BATCH_SIZE:
+                break
+    if total:
+        notify_table_write(table="log_rollups")
+    rollup_stats["runs"] += 1
+    rollup_stats["rolled_up_total"] += total
+    rollup_stats["last_rolled_up"] = total
+    rollup_stats["last_run"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return total
+
+@app.on_event("startup")
+async def start_rollup_engine():
+    if not ROLLUP_ENABLED:
+        return
+    try:
+        await run_in_threadpool(ensure_rollup_state)
+    except Exception as e:
+        print(f"[Rollup Warning] Khong the khoi tao rollup_state: {e}")
+    start_periodic_task("rollup", ROLLUP_INTERVAL_SECONDS, run_log_rollups)
+
+# Backfill: tổng hợp toàn bộ log chưa được tổng hợp. rebuild=true xóa rollup cũ và tính lại từ bảng logs
+# (số liệu của log đã bị xóa/dọn sẽ mất)
+@app.post("/api/admin/rollups/backfill")
+async def backfill_log_rollups(rebuild: bool = Query(False, description="Xóa rollup hiện có và tổng hợp lại từ đầu")):
+    try:
+        await run_in_threadpool(ensure_rollup_state)
+        if rebuild:
+            execute_query("DELETE FROM log_rollups", fetch=False)
+            execute_query(
+                "UPDATE rollup_state SET last_id = 0, updated_at = NOW() WHERE name = %s",
+                [rollups.ROLLUP_STATE_NAME],
+                fetch=False
+            )
+        rolled_up = await run_in_threadpool(run_log_rollups, None)
+        return {"success": True, "rolled_up": rolled_up, "stats": rollup_stats}
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error backfilling log rollups: {str(e)}"
+        )
+
+def parse_range_time(value, name):
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: {value}")
+
+# Số log theo giờ/ngày, action và người thực hiện trong khoảng [start, end), chỉ đọc log_rollups
+@app.get("/api/stats/activity")
+async def get_activity_rollups(
+    request: Request,
+    granularity: str = Query("hour", description="hour hoặc day"),
+    start: Optional[str] = Query(None, description="Thời điểm bắt đầu (ISO 8601), mặc định 24 giờ/30 ngày trước"),
+    end: Optional[str] = Query(None, description="Thời điểm kết thúc (ISO 8601, không bao gồm), mặc định hiện tại"),
+    action: Optional[str] = Query(None),
+    performed_by: Optional[int] = Query(None),
+    group_by: str = Query("action,performed_by", description="Các chiều nhóm: action, performed_by (rỗng = chỉ theo thời gian)")
+):
+    try:
+        if granularity not in rollups.GRANULARITIES:
+            raise HTTPException(status_code=400, detail=f"granularity must be one of: {', '.join(rollups.GRANULARITIES)}")
+        group_fields = [field.strip() for field in group_by.split(",") if field.strip()]
+        unknown = [field for field in group_fields if field not in rollups.GROUP_BY_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown group_by field: {', '.join(unknown)}")
+        
+        end_time = parse_range_time(end, "end") if end else datetime.datetime.now()
+        if start:
+            start_time = parse_range_time(start, "start")
+        else:
+            start_time = end_time - (datetime.timedelta(hours=24) if granularity == "hour" else datetime.timedelta(days=30))
+        start_time = rollups.bucket_start(start_time, granularity)
+        if end_time <= start_time:
+            raise HTTPException(status_code=400, detail="end must be after start")
+        if rollups.bucket_count(start_time, end_time, granularity) > ROLLUP_MAX_BUCKETS:
+            raise HTTPException(status_code=400, detail=f"Range too large: at most {ROLLUP_MAX_BUCKETS} buckets")
+        
+        headers, not_modified = check_not_modified(request, ["log_rollups"])
+        if not_modified:
+            return not_modified
+        
+        conditions = ["granularity = %s", "bucket_start >= %s", "bucket_start < %s"]
+        params = [granularity, start_time.strftime("%Y-%m-%d %H:%M:%S"), end_time.strftime("%Y-%m-%d %H:%M:%S")]
+        if action is not None:
+            conditions.append("action = %s")
+            params.append(action)
+        if performed_by is not None:
+            conditions.append("performed_by = %s")
+            params.append(performed_by)
+        columns = ", ".join(["bucket_start"] + group_fields)
+        rows = execute_query(
+            f"SELECT {columns}, SUM(count) AS count FROM log_rollups WHERE {' AND '.join(conditions)} "
+            f"GROUP BY {columns} ORDER BY {columns}",
+            params,
+            fetch=True,
+            many=True
+        )
+        return FastJSONResponse({
+            "success": True,
+            "granularity": granularity,
+            "start": start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "end": end_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "total": sum(int(row["count"]) for row in rows),
+            "data": rows
+        }, headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error fetching activity rollups: {str(e)}"
+        )
+
+# ==== LOG RETENTION ====
+
+# Số ngày giữ log trong database, 0 = không tự động dọn
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "0"))
+LOG_RETENTION_INTERVAL_SECONDS = float(os.getenv("LOG_RETENTION_INTERVAL_SECONDS", "3600"))
+LOG_PURGE_CHUNK_SIZE = int(os.getenv("LOG_PURGE_CHUNK_SIZE", "1000"))
+# Nghỉ giữa các lô xóa để nhường khóa cho các thao tác ghi khác
+LOG_PURGE_PAUSE_SECONDS = float(os.getenv("LOG_PURGE_PAUSE_SECONDS", "0.05"))
+LOG_PURGE_MAX_CHUNKS = int(os.getenv("LOG_PURGE_MAX_CHUNKS", "1000"))
+LOG_ARCHIVE_ENABLED = env_flag("LOG_ARCHIVE_ENABLED", True)
+log_archive = LogArchive(
+    os.getenv("LOG_ARCHIVE_DIR", "log_archive"),
+    segment_max_bytes=int(os.getenv("LOG_ARCHIVE_SEGMENT_MB", "64")) * 1024 * 1024
+)
+retention_stats = {"runs": 0, "purged_total": 0, "last_purged": 0, "last_run": None, "last_cutoff": None}
+
+# Xóa một lô log (cũ hơn before và/hoặc id <= max_id) trong một transaction, archive trước khi commit
+# Ghi archive lỗi thì hủy cả lô; DELETE bị rollback sau khi đã archive thì lần sau ghi trùng, LogArchive.query bỏ trùng theo id
+# wait_locked=True: chờ các dòng đang bị khóa (FOR UPDATE) thay vì bỏ qua (SKIP LOCKED)
+def purge_log_chunk(before=None, max_id=None, chunk_size=LOG_PURGE_CHUNK_SIZE, record_changes=True, shard=None, archive=True, wait_locked=False):
+    conditions = []
+    params = []
+    if before is not None:
+        conditions.append("timestamp < %s")
+        params.append(before)
+    if max_id is not None:
+        conditions.append("id <= %s")
+        params.append(max_id)
+    order = "timestamp, id" if before is not None else "id"
+    backend = shard.backend if shard else storage_backend
+    lock_suffix = backend.lock_rows_wait_suffix if wait_locked else backend.lock_rows_suffix
+    
+    connection = get_db_connection(shard)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        connection.start_transaction()
+        cursor.execute(
+            f"SELECT id, mac, hostname, action, performed_by, timestamp FROM logs WHERE {' AND '.join(conditions)} "
+            f"ORDER BY {order} LIMIT %s" + lock_suffix,
+            params + [chunk_size]
         )
-        
-        # 4. Commit thay đổi
+        rows = cursor.fetchall()
+        if not rows:
+            connection.rollback()
+            return 0
+        
+        if archive and LOG_ARCHIVE_ENABLED:
+            log_archive.append(rows)
+        ids = [row["id"] for row in rows]
+        placeholders = ", ".join(["%s"] * len(ids))
+        cursor.execute(f"DELETE FROM logs WHERE id IN ({placeholders})", ids)
+        changes = []
+        if record_changes:
+            now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            changes = stage_change_rows(cursor, shard, [("logs", log_id, "delete", now_str) for log_id in ids])
+        bump_shared_versions(cursor, ["logs"], shard)
         connection.commit()
-        last_id = cursor.lastrowid
-        
+        flush_change_rows(changes)
+        return len(rows)
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
         cursor.close()
         connection.close()
-        
-        return {
-            "success": True, 
-            "message": "Test INSERT thành công", 
-            "username": test_username,
-            "id": last_id
-        }
-    except Exception as e:
-        print(f"[TEST INSERT ERROR] {str(e)}")
-        return {"success": False, "message": f"Lỗi: {str(e)}"}
 
-# Test kết nối
-@app.get("/api/test-connection")
-async def test_connection():
+# Xóa theo từng lô nhỏ có nghỉ giữa các lô thay vì một câu DELETE khóa cả bảng
+# shards: các shard cần dọn, mặc định tất cả; archive=False: xóa hẳn, không lưu vào archive
+# Chỉ dừng khi một lô trả về 0 dòng (lô ngắn chưa chắc đã hết, có thể do dòng bị khóa)
+def purge_logs(before=None, max_id=None, max_chunks=LOG_PURGE_MAX_CHUNKS, record_changes=True, shards=None, archive=True, wait_locked=False):
+    total = 0
     try:
-        connection = get_db_connection()
-        connection.close()
-        return {"success": True, "message": "Database connection successful"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        for shard in shards or data_shards():
+            chunks = 0
+            while max_chunks is None or chunks < max_chunks:
+                purged = purge_log_chunk(before, max_id, LOG_PURGE_CHUNK_SIZE, record_changes, shard, archive, wait_locked)
+                chunks += 1
+                total += purged
+                if not purged:
+                    break
+                time.sleep(LOG_PURGE_PAUSE_SECONDS)
+    finally:
+        if total:
+            notify_table_write(table="logs")
+            notify_table_write(table="change_log")
+            summary_counters.mark_dirty()
+    return total
 
-# Generic query endpoint
-@app.post("/api/query")
-async def execute_generic_query(request: QueryRequest):
-    # Security check - Prevent certain dangerous operations
-    sql_lower = request.sql.lower()
-    if "drop table" in sql_lower or "truncate table" in sql_lower:
+# Một lượt retention: dọn log cũ hơn LOG_RETENTION_DAYS ngày
+def run_log_retention():
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=LOG_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    purged = 0
+    for shard in data_shards():
+        # Không dọn log chưa được tổng hợp vào log_rollups (watermark riêng của từng shard)
+        max_id = None
+        if ROLLUP_ENABLED:
+            state = execute_query("SELECT last_id FROM rollup_state WHERE name = %s", [rollups.ROLLUP_STATE_NAME], shard=shard)
+            max_id = state["last_id"] if state else 0
+        purged += purge_logs(before=cutoff, max_id=max_id, shards=[shard])
+    
+    retention_stats["runs"] += 1
+    retention_stats["purged_total"] += purged
+    retention_stats["last_purged"] = purged
+    retention_stats["last_cutoff"] = cutoff
+    retention_stats["last_run"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if purged:
+        print(f"[Retention] Đã dọn {purged} log cũ hơn {cutoff}")
+    return purged
+
+@app.on_event("startup")
+async def start_log_retention():
+    if LOG_RETENTION_DAYS > 0:
+        start_periodic_task("retention", LOG_RETENTION_INTERVAL_SECONDS, run_log_retention)
+
+# Chạy ngay một lượt retention (admin)
+@app.post("/api/admin/retention/run")
+async def trigger_log_retention():
+    if LOG_RETENTION_DAYS <= 0:
+        raise HTTPException(status_code=400, detail="Log retention is disabled (LOG_RETENTION_DAYS=0)")
+    try:
+        purged = await run_in_threadpool(run_log_retention)
+        return {"success": True, "purged": purged, "stats": retention_stats}
+    except Exception as e:
         raise HTTPException(
-            status_code=403, 
-            detail="Operation not allowed"
+            status_code=500,
+            detail=f"Error running log retention: {str(e)}"
         )
-    
+
+# Truy vấn log đã archive theo khoảng thời gian [start, end)
+@app.get("/api/logs/archive")
+async def query_archived_logs(
+    start: str = Query(..., description="Thời điểm bắt đầu (ISO 8601)"),
+    end: Optional[str] = Query(None, description="Thời điểm kết thúc (ISO 8601, không bao gồm), mặc định hiện tại"),
+    action: Optional[str] = Query(None),
+    mac: Optional[str] = Query(None),
+    performed_by: Optional[int] = Query(None),
+    limit: int = Query(1000, ge=1, le=10000)
+):
     try:
-        # Determine if we need to fetch results
-        is_select = sql_lower.startswith("select")
-        result = execute_query(request.sql, request.params, fetch=is_select, many=is_select)
-        
-        return {"success": True, "data": result}
+        start_time = parse_range_time(start, "start")
+        end_time = parse_range_time(end, "end") if end else datetime.datetime.now()
+        filters = {column: value for column, value in (("action", action), ("mac", mac), ("performed_by", performed_by)) if value is not None}
+        rows, blocks_read = await run_in_threadpool(
+            log_archive.query,
+            start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            end_time.strftime("%Y-%m-%d %H:%M:%S"),
+            filters,
+            limit
+        )
+        return FastJSONResponse({"success": True, "data": rows, "count": len(rows), "blocks_read": blocks_read})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
-            detail=f"Query execution failed: {str(e)}"
+            detail=f"Error querying log archive: {str(e)}"
         )
 
 # ==== DEVICES ENDPOINTS ====
 
+# Còn thiết bị chưa có fingerprint (chưa chạy migrate_fingerprints.py): tra cứu thêm theo mac/hostname gốc
+fingerprint_backfill_pending = True
+
+@app.on_event("startup")
+async def check_fingerprint_backfill():
+    global fingerprint_backfill_pending
+    try:
+        pending = execute_query("SELECT id FROM devices WHERE fingerprint IS NULL LIMIT 1")
+        fingerprint_backfill_pending = pending is not None
+        if fingerprint_backfill_pending:
+            print("[Server Warning] Con thiet bi chua co fingerprint, hay chay migrate_fingerprints.py")
+    except Exception as e:
+        print(f"[Server Warning] Khong the kiem tra fingerprint: {e}")
+
+# Key chờ long-poll theo thiết bị, không phụ thuộc định dạng MAC client gửi
+def device_waiter_key(mac, hostname):
+    return ("device", device_fingerprint(mac, hostname))
+
+# Tìm thiết bị theo fingerprint (cột có index); dòng cũ chưa back-fill thì tìm theo mac/hostname và gán fingerprint luôn
+def find_device(mac, hostname, columns="id"):
+    # Kết quả quyết định có đăng ký/kích hoạt thiết bị hay không: không đọc từ replica đang trễ
+    replicas.use_primary()
+    fingerprint = device_fingerprint(mac, hostname)
+    device = execute_query(
+        f"SELECT {columns} FROM devices WHERE fingerprint = %s ORDER BY id LIMIT 1",
+        [fingerprint]
+    )
+    if device is None and fingerprint_backfill_pending:
+        device = execute_query(
+            f"SELECT {columns} FROM devices WHERE mac IN (%s, %s) AND hostname = %s ORDER BY id LIMIT 1",
+            [mac, normalize_mac(mac), hostname]
+        )
+        if device is not None:
+            try:
+                execute_query(
+                    "UPDATE devices SET fingerprint = %s WHERE id = %s",
+                    [fingerprint, device["id"]],
+                    fetch=False
+                )
+            except Exception as e:
+                if not storage.is_duplicate_key_error(e):
+                    raise
+                # Dòng khác đã mang fingerprint này (index UNIQUE): dùng dòng đó
+                device = execute_query(f"SELECT {columns} FROM devices WHERE fingerprint = %s ORDER BY id LIMIT 1", [fingerprint])
+    return device
+
+def found_device_response(existing_device):
+    # Thiết bị đã quá hạn nhưng engine hết hạn chưa chạy tới vẫn được coi là chưa kích hoạt
+    return {
+        "status": "success",
+        "active": bool(existing_device['active']) and not is_expired(existing_device['expires_at']),
+        "message": "Device found",
+        "device_id": existing_device['id'],
+        "key_code": existing_device['key_code'] if existing_device['key_code'] else None
+    }
+
+# Tra cứu thiết bị theo (mac, hostname), tự đăng ký nếu chưa có. Chạy trong threadpool qua single-flight
+def lookup_or_register_device(mac, hostname):
+    columns = "id, mac, hostname, key_code, active, expires_at"
+    # Kiểm tra thiết bị có tồn tại trong database không
+    existing_device = find_device(mac, hostname, columns)
+    
+    if existing_device:
+        return found_device_response(existing_device)
+    
+    # Tự động tạo thiết bị mới khi chưa tồn tại
+    print(f"[API] Thiết bị chưa tồn tại, thêm mới: MAC={mac}, Hostname={hostname}")
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    # Chưa tạo key, để admin tạo sau
+    mac = normalize_mac(mac)
+    hostname = normalize_hostname(hostname)
+    try:
+        new_device = execute_query(
+            "INSERT INTO devices (mac, hostname, fingerprint, active, created_at) VALUES (%s, %s, %s, %s, %s)",
+            [mac, hostname, device_fingerprint(mac, hostname), 0, now],
+            fetch=False
+        )
+    except Exception as e:
+        if not storage.is_duplicate_key_error(e):
+            raise
+        # Worker khác vừa đăng ký cùng thiết bị (single-flight chỉ gộp trong một process): trả về dòng đã có
+        existing_device = find_device(mac, hostname, columns)
+        if existing_device is None:
+            raise
+        return found_device_response(existing_device)
+    
+    device_id = new_device["last_insert_id"]
+    summary_counters.apply(devices_total=1, devices_inactive=1)
+    device_changed(device_id, mac=mac, hostname=hostname, active=False)
+    
+    return {
+        "status": "success",
+        "active": False,
+        "message": "New device registered",
+        "device_id": device_id,
+        "key_code": None
+    }
+
 # Check device activation status
 @app.post("/api/devices/check")
 async def check_device_status(device: DeviceCheck):
     try:
         print(f"[API] Kiểm tra thiết bị: MAC={device.mac}, Hostname={device.hostname}")
-        # Kiểm tra thiết bị có tồn tại trong database không
-        existing_device = execute_query(
-            "SELECT id, mac, hostname, key_code, active FROM devices WHERE mac = %s AND hostname = %s",
-            [device.mac, device.hostname],
-            fetch=True,
-            many=False
-        )
-        
-        if existing_device:
-            return {
-                "status": "success",
-                "active": bool(existing_device['active']),
-                "message": "Device found",
-                "device_id": existing_device['id'],
-                "key_code": existing_device['key_code'] if existing_device['key_code'] else None
-            }
-        else:
-            # Tự động tạo thiết bị mới khi chưa tồn tại
-            print(f"[API] Thiết bị chưa tồn tại, thêm mới: MAC={device.mac}, Hostname={device.hostname}")
-            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # Chưa tạo key, để admin tạo sau
-            new_device = execute_query(
-                "INSERT INTO devices (mac, hostname, active, created_at) VALUES (%s, %s, %s, %s)",
-                [device.mac, device.hostname, 0, now],
-                fetch=False
+        enforce_mac_rate_limit(device.mac)
+        # Các request trùng (mac, hostname) đến cùng lúc dùng chung một lần tra cứu/đăng ký
+        if SINGLE_FLIGHT_ENABLED:
+            return await device_lookups.do(
+                ("check", device_fingerprint(device.mac, device.hostname)),
+                lookup_or_register_device, device.mac, device.hostname
             )
-            
-            device_id = new_device["last_insert_id"]
-            
-            return {
-                "status": "success",
-                "active": False,
-                "message": "New device registered",
-                "device_id": device_id,
-                "key_code": None
-            }
+        return lookup_or_register_device(device.mac, device.hostname)
+    except HTTPException:
+        raise
     except Exception as e:
         error_msg = f"Error checking device: {str(e)}"
         print(f"[API Error] {error_msg}")
@@ -337,12 +1966,83 @@ async def check_device_status(device: DeviceCheck):
             detail=error_msg
         )
 
+# Long-poll: client chờ tới khi thiết bị (mac, hostname) được cấp key/kích hoạt/reset hoặc hết timeout
+@app.post("/api/devices/wait")
+async def wait_device_status(device: DeviceWait):
+    enforce_mac_rate_limit(device.mac)
+    timeout = max(0.0, min(device.timeout or 0, LONG_POLL_MAX_SECONDS))
+    device_key = device_waiter_key(device.mac, device.hostname)
+    
+    # Đăng ký trước khi đọc trạng thái để không lỡ thay đổi xảy ra trong lúc truy vấn
+    waiter = activation_waiters.register(device_key)
+    if waiter is None:
+        raise HTTPException(status_code=503, detail="Too many waiting clients", headers={"Retry-After": "5"})
+    keys = [device_key]
+    
+    # find_device đọc (và có thể UPDATE) database đồng bộ: chạy trong threadpool, không chặn event loop
+    async def read_state():
+        return await run_in_threadpool(find_device, device.mac, device.hostname, "id, key_code, active, expires_at")
+    
+    # Hết hạn (expires_at đã qua) coi như chưa kích hoạt, giống /api/devices/check
+    def is_active(state):
+        return bool(state["active"]) and not is_expired(state["expires_at"])
+    
+    def state_response(state, changed):
+        return {
+            "status": "success",
+            "changed": changed,
+            "found": state is not None,
+            "device_id": state["id"] if state else None,
+            "active": is_active(state) if state else False,
+            "key_code": state["key_code"] if state else None,
+            "expires_at": state["expires_at"] if state else None
+        }
+    
+    try:
+        state = await read_state()
+        if state:
+            keys.append(("id", state["id"]))
+            activation_waiters.register(keys[-1], event=waiter)
+            
+            # Trạng thái đã khác với trạng thái client đang biết: trả về ngay
+            if (device.active is not None and is_active(state) != device.active) or \
+                    (device.key_code != state["key_code"] and (device.key_code is not None or device.active is not None)):
+                return state_response(state, True)
+        
+        try:
+            await asyncio.wait_for(waiter.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return state_response(state, False)
+        
+        return state_response(await read_state(), True)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error waiting for device: {str(e)}"
+        )
+    finally:
+        activation_waiters.unregister(waiter, *keys)
+
 # Get all devices
 @app.get("/api/devices")
-async def get_all_devices():
+async def get_all_devices(
+    request: Request,
+    fields: Optional[str] = Query(None, description="Các cột cần lấy, ví dụ id,mac,hostname,active"),
+    format: str = Query("objects", description="objects (mảng object) hoặc compact (columns + rows dạng mảng)")
+):
     try:
-        devices = execute_query("SELECT * FROM devices ORDER BY id DESC", fetch=True, many=True)
-        return {"success": True, "data": devices}
+        compact = check_row_format(format)
+        columns = select_columns("devices", fields)
+        headers, not_modified = check_not_modified(request, ["devices"], variant=f"{columns}|{format}")
+        if not_modified:
+            return not_modified
+        
+        devices = await run_in_threadpool(execute_rows, f"SELECT {columns} FROM devices ORDER BY id DESC")
+        return RowSetResponse(devices, {"success": True}, compact=compact, headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -351,9 +2051,16 @@ async def get_all_devices():
 
 # Get device by ID
 @app.get("/api/devices/{device_id}")
-async def get_device(device_id: int):
+async def get_device(device_id: int, fields: Optional[str] = Query(None, description="Các cột cần lấy, ví dụ id,active,expires_at")):
     try:
-        device = execute_query("SELECT * FROM devices WHERE id = %s", [device_id], fetch=True, many=False)
+        select_sql = f"SELECT {select_columns('devices', fields)} FROM devices WHERE id = %s"
+        if SINGLE_FLIGHT_ENABLED:
+            device = await device_lookups.do(
+                ("device", device_id, select_sql),
+                execute_query, select_sql, [device_id], True, False
+            )
+        else:
+            device = execute_query(select_sql, [device_id], fetch=True, many=False)
         
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
@@ -432,6 +2139,9 @@ async def update_device(device_id: int, update: DeviceUpdate):
         if result["affected_rows"] == 0:
             raise HTTPException(status_code=404, detail="Device not found")
         
+        summary_counters.mark_dirty()
+        device_changed(device_id, **{field: value for field, value in update.dict().items() if value is not None})
+        
         return {
             "success": True,
             "message": "Device updated successfully"
@@ -453,7 +2163,15 @@ def generate_random_key():
 
 # Generate key for device
 @app.post("/api/devices/{device_id}/generate-key")
-async def generate_key_for_device(device_id: int, user_id: int = Query(..., description="User ID performing the action")):
+async def generate_key_for_device(
+    request: Request,
+    device_id: int,
+    user_id: int = Query(..., description="User ID performing the action"),
+    idempotency_key: Optional[str] = Header(None),
+):
+    return await run_idempotent(request, idempotency_key, None, lambda: generate_device_key(device_id, user_id))
+
+async def generate_device_key(device_id, user_id):
     try:
         print(f"[API] Tạo key cho thiết bị ID={device_id} bởi người dùng ID={user_id}")
         
@@ -490,7 +2208,7 @@ async def generate_key_for_device(device_id: int, user_id: int = Query(..., desc
         # Kiểm tra thiết bị tồn tại
         print(f"[DEBUG] Kiểm tra thiết bị ID={device_id}")
         device = execute_query(
-            "SELECT * FROM devices WHERE id = %s",
+            "SELECT id, mac, hostname, key_code FROM devices WHERE id = %s",
             [device_id],
             fetch=True,
             many=False
@@ -519,15 +2237,15 @@ async def generate_key_for_device(device_id: int, user_id: int = Query(..., desc
         )
         
         print(f"[DEBUG] Kết quả cập nhật: {result}")
+        if not device.get("key_code"):
+            summary_counters.apply(keys_issued=1)
+        summary_counters.mark_dirty()  # expires_at đổi, expiring_soon cần tính lại
+        device_changed(device_id, mac=device["mac"], hostname=device["hostname"], key_code=key, expires_at=expiry_str)
         
         # Thêm log
         try:
             print(f"[DEBUG] Thêm log cho thao tác tạo key")
-            execute_query(
-                "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES (%s, %s, %s, %s, NOW())",
-                [device['mac'], device['hostname'], "generate_key", user_id],
-                fetch=False
-            )
+            write_log(device['mac'], device['hostname'], "generate_key", user_id)
         except Exception as log_error:
             print(f"[API Warning] Lỗi ghi log: {str(log_error)}")
         
@@ -547,24 +2265,221 @@ async def generate_key_for_device(device_id: int, user_id: int = Query(..., desc
             status_code=500,
             detail=f"Error generating key for device: {str(e)}"
         )
+
+# Create new device
+@app.post("/api/devices")
+async def create_device(device: DeviceCreate):
     try:
-        result = execute_query(
-            "INSERT INTO devices (mac, hostname, key_code, active, added_by, created_at) VALUES (%s, %s, %s, %s, %s, NOW())",
-            [device.mac, device.hostname, device.key_code, 0, device.added_by],
-            fetch=False
-        )
+        mac = normalize_mac(device.mac)
+        hostname = normalize_hostname(device.hostname)
+        if find_device(mac, hostname):
+            raise HTTPException(status_code=409, detail="Device already exists")
+        
+        try:
+            result = execute_query(
+                "INSERT INTO devices (mac, hostname, fingerprint, key_code, active, added_by, created_at, expires_at) VALUES (%s, %s, %s, %s, %s, %s, NOW(), %s)",
+                [mac, hostname, device_fingerprint(mac, hostname), device.key_code, 0, device.added_by, device.expires_at],
+                fetch=False
+            )
+        except Exception as e:
+            # Request khác vừa thêm cùng thiết bị giữa lúc kiểm tra và INSERT (index UNIQUE trên fingerprint)
+            if storage.is_duplicate_key_error(e) and find_device(mac, hostname):
+                raise HTTPException(status_code=409, detail="Device already exists")
+            raise
+        summary_counters.apply(devices_total=1, devices_inactive=1, keys_issued=1 if device.key_code else 0)
+        device_changed(result["last_insert_id"], mac=mac, hostname=hostname, active=False, key_code=device.key_code)
         
         return {
             "success": True,
             "message": "Device created successfully",
             "deviceId": result["last_insert_id"]
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Error creating device: {str(e)}"
         )
 
+# ==== BULK IMPORT ====
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "100000"))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "1000"))
+# Số lần chạy lại một lô bị deadlock/chờ khóa quá lâu
+IMPORT_CHUNK_RETRIES = 2
+
+# Thêm một lô thiết bị trong một transaction: kiểm tra trùng, INSERT nhiều dòng, ghi change_log và log hàng loạt
+def import_device_chunk(chunk, user_id, shard=None):
+    backend = shard.backend if shard else storage_backend
+    connection = get_db_connection(shard)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        connection.start_transaction()
+        # FOR UPDATE khóa cả khoảng index fingerprint chưa có dòng: import/đăng ký đồng thời cùng thiết bị
+        # phải chờ transaction này (MySQL; SQLite đã giữ khóa ghi từ BEGIN IMMEDIATE)
+        cursor.execute(
+            f"SELECT fingerprint FROM devices WHERE fingerprint IN ({', '.join(['%s'] * len(chunk))})"
+            + backend.lock_rows_wait_suffix,
+            [row["fingerprint"] for _, row in chunk]
+        )
+        existing = {device["fingerprint"] for device in cursor.fetchall()}
+        if fingerprint_backfill_pending:
+            # Dòng cũ chưa được back-fill fingerprint: so theo mac/hostname như find_device
+            hostnames = sorted({row["hostname"] for _, row in chunk})
+            cursor.execute(
+                f"SELECT mac, hostname FROM devices WHERE fingerprint IS NULL AND hostname IN ({', '.join(['%s'] * len(hostnames))})"
+                + backend.lock_rows_wait_suffix,
+                hostnames
+            )
+            existing.update(device_fingerprint(device["mac"], device["hostname"]) for device in cursor.fetchall())
+        errors = [(line, row, "Device already exists") for line, row in chunk if row["fingerprint"] in existing]
+        rows = [row for _, row in chunk if row["fingerprint"] not in existing]
+        if not rows:
+            connection.rollback()
+            return [], errors
+        
+        now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute(
+            "INSERT INTO devices (mac, hostname, fingerprint, key_code, active, added_by, created_at, expires_at) VALUES "
+            + ", ".join(["(%s, %s, %s, %s, 0, %s, %s, %s)"] * len(rows)),
+            [value for row in rows for value in (row["mac"], row["hostname"], row["fingerprint"], row["key_code"], user_id, now_str, row["expires_at"])]
+        )
+        # Lấy lại ID theo fingerprint: ID của INSERT nhiều dòng không chắc liên tiếp trên MySQL
+        cursor.execute(
+            f"SELECT id, mac, hostname, key_code FROM devices WHERE fingerprint IN ({', '.join(['%s'] * len(rows))})",
+            [row["fingerprint"] for row in rows]
+        )
+        inserted = cursor.fetchall()
+        changes = stage_change_rows(cursor, shard, [("devices", device["id"], "upsert", now_str) for device in inserted])
+        cursor.execute(
+            "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES "
+            + ", ".join(["(%s, %s, %s, %s, %s)"] * len(inserted)),
+            [value for device in inserted for value in (device["mac"], device["hostname"], "import", user_id, now_str)]
+        )
+        bump_shared_versions(cursor, ["devices", "logs"], shard)
+        connection.commit()
+        flush_change_rows(changes)
+        return inserted, errors
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+# Đọc file theo luồng, kiểm tra từng dòng và thêm theo lô IMPORT_CHUNK_SIZE dòng
+def run_device_import(binary_file, file_format, user_id, assign_keys, key_days):
+    report = {"total_rows": 0, "imported": 0, "failed": 0, "keys_assigned": 0, "truncated": False, "errors": []}
+    expiry_str = (datetime.datetime.now() + datetime.timedelta(days=key_days)).strftime("%Y-%m-%d %H:%M:%S")
+    seen = set()
+    chunk = []
+    
+    def add_error(line, row, message):
+        report["failed"] += 1
+        if len(report["errors"]) < IMPORT_MAX_ERRORS:
+            report["errors"].append({
+                "row": line,
+                "mac": row["mac"] if row else None,
+                "hostname": row["hostname"] if row else None,
+                "error": message
+            })
+    
+    def flush():
+        assigned = {(row["mac"], row["hostname"]) for _, row in chunk if row.get("key_assigned")}
+        groups = shard_map.group(chunk, lambda item: item[1]["fingerprint"]) if shard_map else [(None, chunk)]
+        inserted, errors = [], []
+        # Mỗi shard một transaction
+        for shard, rows in groups:
+            for attempt in range(IMPORT_CHUNK_RETRIES + 1):
+                try:
+                    shard_inserted, shard_errors = import_device_chunk(rows, user_id, shard)
+                    break
+                except Exception as e:
+                    # Deadlock/chờ khóa với import hoặc đăng ký đồng thời: chạy lại cả lô (transaction đã rollback)
+                    if attempt < IMPORT_CHUNK_RETRIES and storage.is_transient_error(e):
+                        continue
+                    shard_inserted, shard_errors = [], [(line, row, f"Insert failed: {str(e)}") for line, row in rows]
+            inserted.extend(shard_inserted)
+            errors.extend(shard_errors)
+        for line, row, message in errors:
+            add_error(line, row, message)
+        if inserted:
+            keys = sum(1 for device in inserted if device["key_code"])
+            report["imported"] += len(inserted)
+            report["keys_assigned"] += sum(1 for device in inserted if (device["mac"], device["hostname"]) in assigned)
+            summary_counters.apply(devices_total=len(inserted), devices_inactive=len(inserted), keys_issued=keys)
+            summary_counters.log_added("import", len(inserted))
+            # Một sự kiện cho cả lô thay vì một sự kiện mỗi thiết bị
+            event_broker.publish("device", {"op": "import", "ids": [device["id"] for device in inserted]})
+        chunk.clear()
+    
+    try:
+        for line, row, error in device_import.iter_rows(binary_file, file_format):
+            if report["total_rows"] >= IMPORT_MAX_ROWS:
+                report["truncated"] = True
+                break
+            report["total_rows"] += 1
+            if error:
+                add_error(line, row, error)
+                continue
+            row["fingerprint"] = device_fingerprint(row["mac"], row["hostname"])
+            if row["fingerprint"] in seen:
+                add_error(line, row, "Duplicate row in file")
+                continue
+            seen.add(row["fingerprint"])
+            if assign_keys and not row["key_code"]:
+                row["key_code"] = generate_random_key()
+                row["expires_at"] = row["expires_at"] or expiry_str
+                row["key_assigned"] = True
+            chunk.append((line, row))
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                flush()
+        if chunk:
+            flush()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        if report["imported"]:
+            notify_table_write(table="devices")
+            notify_table_write(table="logs")
+            notify_table_write(table="change_log")
+    report["errors_truncated"] = report["failed"] > len(report["errors"])
+    return report
+
+# Import thiết bị hàng loạt từ file CSV (header mac,hostname[,key_code,expires_at]) hoặc NDJSON
+@app.post("/api/devices/import")
+async def import_devices(
+    file: UploadFile = File(...),
+    user_id: int = Query(..., description="User ID performing the action"),
+    format: Optional[str] = Query(None, description="csv hoặc ndjson, mặc định đoán theo tên file"),
+    assign_keys: bool = Query(False, description="Sinh key cho các dòng không có key_code"),
+    key_days: int = Query(365, ge=1, le=3650, description="Số ngày hiệu lực của key được sinh")
+):
+    try:
+        require_permission(
+            user_id,
+            Permissions.MANAGE_DEVICES,
+            "Bạn không có quyền import thiết bị. Chỉ người có quyền 'Quản lý thiết bị' mới có thể thực hiện thao tác này."
+        )
+        file_format = device_import.detect_format(format, file.filename, file.content_type)
+        if file_format is None:
+            raise HTTPException(status_code=400, detail=f"Unsupported import format, use one of: {', '.join(device_import.FORMATS)}")
+        
+        report = await run_in_threadpool(run_device_import, file.file, file_format, user_id, assign_keys, key_days)
+        print(f"[Import] {report['imported']}/{report['total_rows']} thiết bị được import bởi người dùng ID={user_id}")
+        return {"success": True, "format": file_format, **report}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error importing devices: {str(e)}"
+        )
+    finally:
+        await file.close()
+
 # Delete a device
 @app.delete("/api/devices/{device_id}")
 async def delete_device(device_id: int):
@@ -578,6 +2493,10 @@ async def delete_device(device_id: int):
         if result["affected_rows"] == 0:
             raise HTTPException(status_code=404, detail="Device not found")
         
+        summary_counters.apply(devices_total=-1)
+        summary_counters.mark_dirty()  # không biết thiết bị bị xóa đang active hay không
+        device_changed(device_id, "delete")
+        
         return {"success": True, "message": "Device deleted successfully"}
     except HTTPException:
         raise
@@ -602,6 +2521,9 @@ async def activate_device_by_id(device_id: int, activate: DeviceActivate):
         if result["affected_rows"] == 0:
             raise HTTPException(status_code=404, detail="Device not found")
         
+        summary_counters.mark_dirty()
+        device_changed(device_id, active=bool(activate.active))
+        
         return {
             "success": True,
             "message": "Device activated successfully" if activate.active else "Device deactivated successfully"
@@ -616,28 +2538,34 @@ async def activate_device_by_id(device_id: int, activate: DeviceActivate):
 
 # Activate a device with key (for client app)
 @app.post("/api/devices/activate")
-async def activate_device_with_key(device: DeviceActivateWithKey):
+async def activate_device_with_key(device: DeviceActivateWithKey, request: Request, idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent(request, idempotency_key, device.dict(), lambda: activate_device(device))
+
+async def activate_device(device):
     try:
         print(f"[API] Nhận yêu cầu kích hoạt thiết bị: MAC={device.mac}, Hostname={device.hostname}, Key={device.key_code}")
+        enforce_mac_rate_limit(device.mac)
         
         # Kiểm tra xem thiết bị có tồn tại không
-        existing_device = execute_query(
-            "SELECT id FROM devices WHERE mac = %s AND hostname = %s",
-            [device.mac, device.hostname],
-            fetch=True, many=False
-        )
+        existing_device = find_device(device.mac, device.hostname, "id, active")
         
         if not existing_device:
             # Tạo mới thiết bị nếu chưa tồn tại
             print(f"[API] Thiết bị chưa tồn tại, thêm mới: MAC={device.mac}, Hostname={device.hostname}")
+            device.mac = normalize_mac(device.mac)
+            device.hostname = normalize_hostname(device.hostname)
             insert_result = execute_query(
-                "INSERT INTO devices (mac, hostname, key_code, active, created_at) VALUES (%s, %s, %s, %s, NOW())",
-                [device.mac, device.hostname, device.key_code, 0],
+                "INSERT INTO devices (mac, hostname, fingerprint, key_code, active, created_at) VALUES (%s, %s, %s, %s, %s, NOW())",
+                [device.mac, device.hostname, device_fingerprint(device.mac, device.hostname), device.key_code, 0],
                 fetch=False
             )
             device_id = insert_result["last_insert_id"]
+            summary_counters.apply(devices_total=1, devices_inactive=1, keys_issued=1 if device.key_code else 0)
+            device_changed(device_id, mac=device.mac, hostname=device.hostname, active=False)
+            was_active = False
         else:
             device_id = existing_device["id"]
+            was_active = bool(existing_device["active"])
         
         # Kiểm tra key
         valid_key = execute_query(
@@ -666,14 +2594,14 @@ async def activate_device_with_key(device: DeviceActivateWithKey):
                 "status": "error",
                 "message": "Không thể kích hoạt thiết bị"
             }
+        
+        if not was_active:
+            summary_counters.apply(devices_active=1, devices_inactive=-1)
+        device_changed(device_id, mac=device.mac, hostname=device.hostname, active=True)
             
         # Ghi log kích hoạt
         try:
-            execute_query(
-                "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES (%s, %s, %s, %s, NOW())",
-                [device.mac, device.hostname, "activate", 1],
-                fetch=False
-            )
+            write_log(device.mac, device.hostname, "activate", 1)
         except Exception as log_error:
             print(f"[API Warning] Lỗi ghi log: {str(log_error)}")
         
@@ -697,10 +2625,12 @@ async def create_simple_key(device_id: int):
     """Tạo key cho thiết bị với ID cụ thể (phiên bản đơn giản)"""
     try:
         print(f"[API] Tạo key đơn giản cho thiết bị ID={device_id}")
+        # GET nhưng ghi: thiết bị đọc ra quyết định key cũ/mới nên phải đọc trên primary
+        replicas.use_primary()
         
         # Kiểm tra thiết bị tồn tại
         device = execute_query(
-            "SELECT * FROM devices WHERE id = %s",
+            "SELECT id, mac, hostname, key_code FROM devices WHERE id = %s",
             [device_id],
             fetch=True,
             many=False
@@ -720,14 +2650,14 @@ async def create_simple_key(device_id: int):
             [key, expiry_str, device_id],
             fetch=False
         )
+        if not device.get("key_code"):
+            summary_counters.apply(keys_issued=1)
+        summary_counters.mark_dirty()  # expires_at đổi, expiring_soon cần tính lại
+        device_changed(device_id, mac=device["mac"], hostname=device["hostname"], key_code=key, expires_at=expiry_str)
         
         # Thêm log
         try:
-            execute_query(
-                "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES (%s, %s, %s, %s, NOW())",
-                [device['mac'], device['hostname'], 'generate_key', 1],
-                fetch=False
-            )
+            write_log(device['mac'], device['hostname'], 'generate_key', 1)
         except Exception as log_error:
             print(f"[API Warning] Lỗi ghi log: {str(log_error)}")
         
@@ -759,7 +2689,9 @@ async def reset_device(device_id: int, user_id: int = Query(..., description="Us
         # Kiểm tra quyền người dùng
         users = execute_query(
             "SELECT id, role FROM users WHERE id = %s",
-            [user_id]
+            [user_id],
+            fetch=True,
+            many=True
         )
         
         if not users:
@@ -771,7 +2703,9 @@ async def reset_device(device_id: int, user_id: int = Query(..., description="Us
         if user["role"] != "admin":
             permissions = execute_query(
                 "SELECT id FROM user_permissions WHERE user_id = %s AND permission = %s",
-                [user_id, Permissions.MANAGE_DEVICES]
+                [user_id, Permissions.MANAGE_DEVICES],
+                fetch=True,
+                many=True
             )
             
             if not permissions:
@@ -782,8 +2716,10 @@ async def reset_device(device_id: int, user_id: int = Query(..., description="Us
         
         # Kiểm tra thiết bị tồn tại
         device = execute_query(
-            "SELECT id, mac, hostname FROM devices WHERE id = %s",
-            [device_id]
+            "SELECT id, mac, hostname, active, key_code FROM devices WHERE id = %s",
+            [device_id],
+            fetch=True,
+            many=True
         )
         
         if not device:
@@ -795,13 +2731,19 @@ async def reset_device(device_id: int, user_id: int = Query(..., description="Us
             [device_id],
             fetch=False
         )
+        if device[0]["active"]:
+            summary_counters.apply(devices_active=-1, devices_inactive=1)
+        if device[0]["key_code"]:
+            summary_counters.apply(keys_issued=-1)
+        device_changed(device_id, mac=device[0]["mac"], hostname=device[0]["hostname"], active=False, key_code=None)
         
         # Thêm log
         try:
-            execute_query(
-                "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES (%s, %s, %s, %s, NOW())",
-                [device[0]['mac'] if 'mac' in device[0] else 'Unknown', device[0]['hostname'] if 'hostname' in device[0] else 'Unknown', "reset", user_id],
-                fetch=False
+            write_log(
+                device[0]['mac'] if 'mac' in device[0] else 'Unknown',
+                device[0]['hostname'] if 'hostname' in device[0] else 'Unknown',
+                "reset",
+                user_id
             )
         except Exception as log_error:
             print(f"[API Warning] Lỗi ghi log: {str(log_error)}")
@@ -818,18 +2760,223 @@ async def reset_device(device_id: int, user_id: int = Query(..., description="Us
             detail=f"Error resetting device: {str(e)}"
         )
 
+# ==== BULK DEVICE OPERATIONS ====
+
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+BULK_MAX_IDS = int(os.getenv("BULK_MAX_IDS", "10000"))
+
+# Thao tác -> (quyền cần có, action ghi log)
+BULK_OPERATIONS = {
+    "reset": (Permissions.MANAGE_DEVICES, "reset"),
+    "delete": (Permissions.MANAGE_DEVICES, "delete"),
+    "activate": (Permissions.MANAGE_DEVICES, "activate"),
+    "deactivate": (Permissions.MANAGE_DEVICES, "deactivate"),
+    "extend": (Permissions.MANAGE_KEYS, "extend"),
+}
+
+# Chuyển filter thành mệnh đề WHERE; filter rỗng bị từ chối để tránh thao tác trên toàn bộ bảng
+def bulk_filter_sql(device_filter):
+    conditions = []
+    params = []
+    if device_filter.active is not None:
+        conditions.append("active = %s")
+        params.append(1 if device_filter.active else 0)
+    if device_filter.mac:
+        conditions.append("mac LIKE %s")
+        params.append(device_filter.mac + "%")
+    if device_filter.hostname:
+        conditions.append("hostname LIKE %s")
+        params.append(device_filter.hostname + "%")
+    if device_filter.added_by is not None:
+        conditions.append("added_by = %s")
+        params.append(device_filter.added_by)
+    if device_filter.has_key is not None:
+        conditions.append("key_code IS NOT NULL" if device_filter.has_key else "key_code IS NULL")
+    if device_filter.expires_before:
+        conditions.append("expires_at < %s")
+        params.append(convert_iso_to_mysql_date(device_filter.expires_before))
+    if device_filter.expires_after:
+        conditions.append("expires_at >= %s")
+        params.append(convert_iso_to_mysql_date(device_filter.expires_after))
+    if not conditions:
+        raise HTTPException(status_code=400, detail="Filter must contain at least one condition")
+    return " AND ".join(conditions), params
+
+# Câu lệnh ghi (set-based) cho một lô ID
+def bulk_statement(operation, ids, now_str, days):
+    placeholders = ", ".join(["%s"] * len(ids))
+    if operation == "delete":
+        return f"DELETE FROM devices WHERE id IN ({placeholders})", ids
+    if operation == "reset":
+        return f"UPDATE devices SET active = 0, activated_at = NULL, key_code = NULL WHERE id IN ({placeholders})", ids
+    if operation == "activate":
+        return f"UPDATE devices SET active = 1, activated_at = %s WHERE id IN ({placeholders})", [now_str] + ids
+    if operation == "deactivate":
+        return f"UPDATE devices SET active = 0, activated_at = NULL WHERE id IN ({placeholders})", ids
+    # extend: key đã hết hạn (hoặc chưa có hạn) tính từ bây giờ, còn hạn thì cộng tiếp vào hạn hiện tại
+    renewed = (datetime.datetime.strptime(now_str, "%Y-%m-%d %H:%M:%S") + datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    return (
+        f"UPDATE devices SET expires_at = CASE WHEN expires_at IS NULL OR expires_at < %s THEN %s "
+        f"ELSE {storage_backend.add_days_sql('expires_at')} END WHERE id IN ({placeholders})",
+        [now_str, renewed, days] + ids
+    )
+
+# Một lô: khóa các dòng khớp điều kiện (id > after_id), cập nhật/xóa, ghi log và change_log hàng loạt, cùng một transaction
+def bulk_device_chunk(operation, where_sql, params, after_id, user_id, days, shard=None):
+    backend = shard.backend if shard else storage_backend
+    connection = get_db_connection(shard)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        connection.start_transaction()
+        # Chờ dòng đang bị transaction khác khóa thay vì SKIP LOCKED: phân trang theo id sẽ bỏ qua hẳn dòng bị bỏ qua
+        cursor.execute(
+            f"SELECT id, mac, hostname, active, key_code FROM devices WHERE ({where_sql}) AND id > %s "
+            f"ORDER BY id LIMIT %s" + backend.lock_rows_wait_suffix,
+            params + [after_id, BULK_CHUNK_SIZE]
+        )
+        devices = cursor.fetchall()
+        if not devices:
+            connection.rollback()
+            return []
+        
+        now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        sql, statement_params = bulk_statement(operation, [device["id"] for device in devices], now_str, days)
+        cursor.execute(sql, statement_params)
+        cursor.execute(
+            "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES "
+            + ", ".join(["(%s, %s, %s, %s, %s)"] * len(devices)),
+            [value for device in devices for value in (device["mac"], device["hostname"], BULK_OPERATIONS[operation][1], user_id, now_str)]
+        )
+        op = "delete" if operation == "delete" else "upsert"
+        changes = stage_change_rows(cursor, shard, [("devices", device["id"], op, now_str) for device in devices])
+        bump_shared_versions(cursor, ["devices", "logs"], shard)
+        connection.commit()
+        flush_change_rows(changes)
+        return devices
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+# Cập nhật bộ đếm tổng hợp theo trạng thái trước khi thao tác của các thiết bị trong lô
+def apply_bulk_counters(operation, devices):
+    active = sum(1 for device in devices if device["active"])
+    inactive = len(devices) - active
+    keys = sum(1 for device in devices if device["key_code"])
+    if operation == "delete":
+        summary_counters.apply(devices_total=-len(devices), devices_active=-active, devices_inactive=-inactive, keys_issued=-keys)
+    elif operation == "reset":
+        summary_counters.apply(devices_active=-active, devices_inactive=active, keys_issued=-keys)
+    elif operation == "activate":
+        summary_counters.apply(devices_active=inactive, devices_inactive=-inactive)
+    elif operation == "deactivate":
+        summary_counters.apply(devices_active=-active, devices_inactive=active)
+    if operation in ("delete", "reset", "extend"):
+        summary_counters.mark_dirty()  # expiring_soon phụ thuộc expires_at
+    summary_counters.log_added(BULK_OPERATIONS[operation][1], len(devices))
+
+def run_bulk_device_operation(operation, ids, where_sql, params, user_id, days):
+    # Danh sách ID được chia thành các lô cố định; filter thì duyệt keyset theo id
+    if ids is not None:
+        batches = [(f"id IN ({', '.join(['%s'] * len(chunk))})", chunk) for chunk in
+                   (ids[start:start + BULK_CHUNK_SIZE] for start in range(0, len(ids), BULK_CHUNK_SIZE))]
+    else:
+        batches = [(where_sql, params)]
+    
+    affected = []
+    try:
+        for shard in data_shards():
+            for batch_where, batch_params in batches:
+                after_id = 0
+                while True:
+                    devices = bulk_device_chunk(operation, batch_where, list(batch_params), after_id, user_id, days, shard)
+                    if not devices:
+                        break
+                    affected.extend(device["id"] for device in devices)
+                    apply_bulk_counters(operation, devices)
+                    event_broker.publish("device", {"op": operation, "ids": [device["id"] for device in devices]})
+                    for device in devices:
+                        activation_waiters.notify(("id", device["id"]), device_waiter_key(device["mac"], device["hostname"]))
+                    after_id = devices[-1]["id"]
+                    if len(devices) < BULK_CHUNK_SIZE:
+                        break
+    finally:
+        if affected:
+            notify_table_write(table="devices")
+            notify_table_write(table="logs")
+            notify_table_write(table="change_log")
+    return affected
+
+# Thao tác hàng loạt trên thiết bị theo danh sách ID hoặc filter, kiểm tra quyền một lần
+@app.post("/api/devices/bulk")
+async def bulk_device_operation(request: DeviceBulkRequest, user_id: int = Query(..., description="User ID performing the action")):
+    try:
+        if request.operation not in BULK_OPERATIONS:
+            raise HTTPException(status_code=400, detail=f"operation must be one of: {', '.join(BULK_OPERATIONS)}")
+        if (request.ids is None) == (request.filter is None):
+            raise HTTPException(status_code=400, detail="Provide either ids or filter")
+        if request.operation == "extend" and (request.days is None or not 1 <= request.days <= 3650):
+            raise HTTPException(status_code=400, detail="extend requires days between 1 and 3650")
+        
+        permission, _ = BULK_OPERATIONS[request.operation]
+        require_permission(
+            user_id,
+            permission,
+            "Bạn không có quyền thực hiện thao tác hàng loạt này. Chỉ người có quyền 'Quản lý thiết bị' (hoặc 'Quản lý key' với gia hạn) mới có thể thực hiện."
+        )
+        
+        ids = None
+        where_sql, params = None, None
+        if request.ids is not None:
+            ids = sorted(set(request.ids))
+            if not ids:
+                raise HTTPException(status_code=400, detail="ids must not be empty")
+            if len(ids) > BULK_MAX_IDS:
+                raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_IDS} ids per request")
+        else:
+            where_sql, params = bulk_filter_sql(request.filter)
+        
+        print(f"[API] Thao tác hàng loạt '{request.operation}' bởi người dùng ID={user_id}")
+        affected = await run_in_threadpool(run_bulk_device_operation, request.operation, ids, where_sql, params, user_id, request.days)
+        response = {
+            "success": True,
+            "operation": request.operation,
+            "affected": len(affected)
+        }
+        if ids is not None:
+            affected_ids = set(affected)
+            response["not_found"] = [device_id for device_id in ids if device_id not in affected_ids]
+        return response
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error running bulk device operation: {str(e)}"
+        )
+
 # ==== LOGS ENDPOINTS ====
 
 # Get all logs
 @app.get("/api/logs")
-async def get_all_logs():
+async def get_all_logs(
+    request: Request,
+    fields: Optional[str] = Query(None, description="Các cột cần lấy, ví dụ id,action,timestamp"),
+    format: str = Query("objects", description="objects (mảng object) hoặc compact (columns + rows dạng mảng)")
+):
     try:
-        logs = execute_query(
-            "SELECT * FROM logs ORDER BY timestamp DESC",
-            fetch=True,
-            many=True
-        )
-        return {"success": True, "data": logs}
+        compact = check_row_format(format)
+        columns = select_columns("logs", fields)
+        headers, not_modified = check_not_modified(request, ["logs"], variant=f"{columns}|{format}")
+        if not_modified:
+            return not_modified
+        
+        logs = await run_in_threadpool(execute_rows, f"SELECT {columns} FROM logs ORDER BY timestamp DESC")
+        return RowSetResponse(logs, {"success": True}, compact=compact, headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -840,16 +2987,12 @@ async def get_all_logs():
 @app.post("/api/logs")
 async def create_log(log: LogCreate):
     try:
-        result = execute_query(
-            "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES (%s, %s, %s, %s, NOW())",
-            [log.mac, log.hostname, log.action, log.performed_by],
-            fetch=False
-        )
+        log_id = write_log(log.mac, log.hostname, log.action, log.performed_by)
         
         return {
             "success": True,
             "message": "Log created successfully",
-            "logId": result["last_insert_id"]
+            "logId": log_id
         }
     except Exception as e:
         raise HTTPException(
@@ -865,7 +3008,9 @@ async def delete_log(log_id: int, user_id: int = Query(..., description="User ID
         # Lấy thông tin người dùng
         users = execute_query(
             "SELECT id, role FROM users WHERE id = %s",
-            [user_id]
+            [user_id],
+            fetch=True,
+            many=True
         )
         
         if not users:
@@ -878,7 +3023,9 @@ async def delete_log(log_id: int, user_id: int = Query(..., description="User ID
             # Kiểm tra quyền cụ thể
             permissions = execute_query(
                 "SELECT id FROM user_permissions WHERE user_id = %s AND permission = %s",
-                [user_id, Permissions.MANAGE_LOGS]
+                [user_id, Permissions.MANAGE_LOGS],
+                fetch=True,
+                many=True
             )
             
             if not permissions:
@@ -897,6 +3044,9 @@ async def delete_log(log_id: int, user_id: int = Query(..., description="User ID
         if result["affected_rows"] == 0:
             raise HTTPException(status_code=404, detail="Log not found")
         
+        record_change("logs", log_id, "delete")
+        summary_counters.mark_dirty()
+        
         return {"success": True, "message": "Log deleted successfully"}
     except HTTPException:
         raise
@@ -908,13 +3058,18 @@ async def delete_log(log_id: int, user_id: int = Query(..., description="User ID
 
 # Delete all logs
 @app.delete("/api/logs")
-async def delete_all_logs(user_id: int = Query(..., description="User ID performing the action")):
+async def delete_all_logs(
+    user_id: int = Query(..., description="User ID performing the action"),
+    archive: bool = Query(False, description="Lưu các log bị xóa vào archive")
+):
     try:
         # Kiểm tra quyền người dùng
         # Lấy thông tin người dùng
         users = execute_query(
             "SELECT id, role FROM users WHERE id = %s",
-            [user_id]
+            [user_id],
+            fetch=True,
+            many=True
         )
         
         if not users:
@@ -927,7 +3082,9 @@ async def delete_all_logs(user_id: int = Query(..., description="User ID perform
             # Kiểm tra quyền cụ thể
             permissions = execute_query(
                 "SELECT id FROM user_permissions WHERE user_id = %s AND permission = %s",
-                [user_id, Permissions.MANAGE_LOGS]
+                [user_id, Permissions.MANAGE_LOGS],
+                fetch=True,
+                many=True
             )
             
             if not permissions:
@@ -936,13 +3093,23 @@ async def delete_all_logs(user_id: int = Query(..., description="User ID perform
                     detail="Bạn không có quyền xóa nhật ký. Chỉ người có quyền 'Quản lý nhật ký' mới có thể thực hiện thao tác này."
                 )
         
-        # Thực hiện xóa tất cả logs
-        result = execute_query("DELETE FROM logs", fetch=False)
+        # Xóa tất cả logs hiện có theo từng lô (không chặn các thao tác ghi log mới)
+        last_log = execute_query("SELECT MAX(id) AS max_id FROM logs")
+        count = 0
+        if last_log and last_log["max_id"] is not None:
+            if ROLLUP_ENABLED:
+                await run_in_threadpool(run_log_rollups, None)
+            count = await run_in_threadpool(
+                purge_logs, max_id=last_log["max_id"], max_chunks=None, record_changes=False, archive=archive, wait_locked=True
+            )
+        record_change("logs", None, "reset")
+        summary_counters.logs_cleared()
+        summary_counters.mark_dirty()
         
         return {
             "success": True,
             "message": "All logs deleted successfully",
-            "count": result["affected_rows"]
+            "count": count
         }
     except HTTPException:
         raise
@@ -956,14 +3123,21 @@ async def delete_all_logs(user_id: int = Query(..., description="User ID perform
 
 # Get all users
 @app.get("/api/users")
-async def get_all_users():
+async def get_all_users(request: Request, fields: Optional[str] = Query(None, description="Các cột cần lấy, ví dụ id,username")):
     try:
+        columns = select_columns("users", fields, default=", ".join(READ_COLUMNS["users"]))
+        headers, not_modified = check_not_modified(request, ["users"], variant=columns)
+        if not_modified:
+            return not_modified
+        
         users = execute_query(
-            "SELECT id, username, role, created_at FROM users ORDER BY id",
+            f"SELECT {columns} FROM users ORDER BY id",
             fetch=True,
             many=True
         )
-        return {"success": True, "data": users}
+        return FastJSONResponse({"success": True, "data": users}, headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -976,10 +3150,10 @@ async def create_user(user: UserCreate):
     try:
         print(f"[API] Nhận yêu cầu tạo người dùng mới: {user.dict()}")
         
-        # Kết nối trực tiếp MySQL để tránh lỗi
-        connection = mysql.connector.connect(**db_config)
+        # Kết nối trực tiếp database để tránh lỗi
+        connection = get_db_connection()
         if not connection.is_connected():
-            raise Exception("Không thể kết nối MySQL")
+            raise Exception("Không thể kết nối database")
             
         cursor = connection.cursor(dictionary=True)
         
@@ -1001,19 +3175,22 @@ async def create_user(user: UserCreate):
         print(f"[Direct SQL] Thêm người dùng mới: {user.username}")
         insert_sql = "INSERT INTO users (username, password_hash, role, created_at) VALUES (%s, %s, %s, NOW())"
         cursor.execute(insert_sql, [user.username, user.password_hash, user.role])
+        last_insert_id = cursor.lastrowid
         
         # Nếu là staff, gán quyền xem bảng điều khiển mặc định
         if user.role == 'staff':
             try:
                 insert_permission_sql = "INSERT INTO user_permissions (user_id, permission, granted_by, granted_at) VALUES (%s, %s, %s, NOW())"
-                cursor.execute(insert_permission_sql, [cursor.lastrowid, Permissions.VIEW_DASHBOARD, 1])  # Admin ID 1 as default granter
+                cursor.execute(insert_permission_sql, [last_insert_id, Permissions.VIEW_DASHBOARD, 1])  # Admin ID 1 as default granter
             except Exception as e:
                 print(f"[Warning] Không thể gán quyền mặc định cho người dùng mới: {e}")
         
         # Đảm bảo commit dữ liệu
         print("[Direct SQL] Đang commit thay đổi...")
+        bump_shared_versions(cursor, ["users"])
         connection.commit()
-        last_insert_id = cursor.lastrowid
+        notify_table_write(table="users")
+        notify_table_write(table="user_permissions")
         
         # Kiểm tra xem người dùng đã được thêm chưa
         cursor.execute("SELECT id FROM users WHERE id = %s", [last_insert_id])
@@ -1261,30 +3438,7 @@ if __name__ == "__main__":
     load_dotenv()
     port = int(os.getenv("PORT", 3001))
     
-    # Khởi tạo bảng user_permissions nếu chưa tồn tại
-    try:
-        connection = mysql.connector.connect(**db_config)
-        cursor = connection.cursor()
-        
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_permissions (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            user_id INT NOT NULL,
-            permission VARCHAR(50) NOT NULL,
-            granted_by INT NOT NULL,
-            granted_at DATETIME NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (granted_by) REFERENCES users(id),
-            UNIQUE KEY unique_user_permission (user_id, permission)
-        )
-        """)
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
-        print("[Server] Bang user_permissions da duoc kiem tra/tao")
-    except Exception as e:
-        print(f"[Server Warning] Khong the khoi tao bang permissions: {e}")
+    # Schema (bảng user_permissions, hoặc toàn bộ bảng với SQLite) được tạo trong sự kiện startup
     
     # Lấy địa chỉ IP của máy tính này trên mạng
     hostname = socket.gethostname()
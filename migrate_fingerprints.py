@@ -0,0 +1,155 @@
+"""
+Migration: chuẩn hóa MAC, back-fill cột devices.fingerprint và gộp thiết bị trùng
+
+Chạy một lần sau khi cập nhật server (an toàn khi chạy lại):
+
+    python migrate_fingerprints.py --dry-run   # chỉ báo cáo; nhóm trùng được tính trên các dòng đã back-fill
+    python migrate_fingerprints.py --batch-size 1000
+
+Các bước:
+1. Tạo cột fingerprint và index nếu chưa có (init_schema của backend).
+2. Back-fill theo từng lô: MAC được chuẩn hóa về AA:BB:CC:DD:EE:FF, hostname bỏ khoảng trắng thừa.
+3. Gộp các thiết bị có cùng fingerprint: giữ một dòng (ưu tiên đang kích hoạt, có key,
+   hạn dùng xa nhất, rồi ID nhỏ nhất), xóa các dòng còn lại và ghi log "dedupe".
+4. Đổi index fingerprint thành UNIQUE để các worker không thể cùng thêm một thiết bị lần nữa.
+"""
+import os
+import sys
+import argparse
+import datetime
+
+from dotenv import load_dotenv
+
+import storage
+from fingerprint import normalize_mac, normalize_hostname, device_fingerprint
+
+load_dotenv()
+
+db_config = {
+    "host": os.getenv("DB_HOST", "127.0.0.1"),
+    "port": int(os.getenv("DB_PORT", "3308")),
+    "user": os.getenv("DB_USER", "KingAutoColony"),
+    "password": os.getenv("DB_PASSWORD", "StrongPass123"),
+    "database": os.getenv("DB_NAME", "license_system"),
+}
+
+
+def backfill(connection, batch_size, dry_run):
+    cursor = connection.cursor(dictionary=True)
+    total = 0
+    last_id = 0
+    while True:
+        cursor.execute(
+            "SELECT id, mac, hostname FROM devices WHERE fingerprint IS NULL AND id > %s ORDER BY id LIMIT %s",
+            [last_id, batch_size]
+        )
+        devices = cursor.fetchall()
+        if not devices:
+            break
+        updates = []
+        for device in devices:
+            mac = normalize_mac(device["mac"])
+            hostname = normalize_hostname(device["hostname"])
+            updates.append((mac, hostname, device_fingerprint(mac, hostname), device["id"]))
+        if not dry_run:
+            cursor.executemany("UPDATE devices SET mac = %s, hostname = %s, fingerprint = %s WHERE id = %s", updates)
+            connection.commit()
+        total += len(devices)
+        last_id = devices[-1]["id"]
+        print(f"[Migrate] Back-fill {total} thiết bị (tới ID={last_id})")
+    cursor.close()
+    return total
+
+
+# Dòng được giữ lại trong nhóm trùng
+def survivor_rank(device):
+    expires_at = device["expires_at"]
+    if isinstance(expires_at, str):
+        expires_at = datetime.datetime.fromisoformat(expires_at)
+    return (
+        bool(device["active"]),
+        bool(device["key_code"]),
+        expires_at or datetime.datetime.min,
+        -device["id"],
+    )
+
+
+def deduplicate(connection, dry_run):
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute(
+        "SELECT fingerprint FROM devices WHERE fingerprint IS NOT NULL GROUP BY fingerprint HAVING COUNT(*) > 1"
+    )
+    groups = [row["fingerprint"] for row in cursor.fetchall()]
+    removed = 0
+    for fingerprint in groups:
+        cursor.execute(
+            "SELECT id, mac, hostname, active, key_code, expires_at FROM devices WHERE fingerprint = %s ORDER BY id",
+            [fingerprint]
+        )
+        devices = cursor.fetchall()
+        keep = max(devices, key=survivor_rank)
+        duplicates = [device for device in devices if device["id"] != keep["id"]]
+        print(f"[Migrate] {keep['mac']} / {keep['hostname']}: giữ ID={keep['id']}, xóa {[device['id'] for device in duplicates]}")
+        if dry_run:
+            removed += len(duplicates)
+            continue
+
+        now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        ids = [device["id"] for device in duplicates]
+        connection.start_transaction()
+        cursor.execute(f"DELETE FROM devices WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+        cursor.executemany(
+            "INSERT INTO logs (mac, hostname, action, performed_by, timestamp) VALUES (%s, %s, %s, %s, %s)",
+            [(device["mac"], device["hostname"], "dedupe", 1, now_str) for device in duplicates]
+        )
+        cursor.executemany(
+            "INSERT INTO change_log (table_name, row_id, op, changed_at) VALUES (%s, %s, %s, %s)",
+            [("devices", device_id, "delete", now_str) for device_id in ids]
+        )
+        connection.commit()
+        removed += len(duplicates)
+    cursor.close()
+    return len(groups), removed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Back-fill fingerprint và gộp thiết bị trùng")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Số thiết bị mỗi lô back-fill")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ báo cáo, không ghi vào database")
+    parser.add_argument("--skip-dedupe", action="store_true", help="Không gộp thiết bị trùng")
+    args = parser.parse_args()
+
+    backend = storage.create_backend(db_config)
+    print(f"[Migrate] Backend: {backend.label} {backend.describe()}")
+    backend.init_schema()
+
+    connection = backend.connect()
+    try:
+        filled = backfill(connection, args.batch_size, args.dry_run)
+        groups, removed = (0, 0) if args.skip_dedupe else deduplicate(connection, args.dry_run)
+        if not args.dry_run and (filled or removed):
+            # ETag của GET /api/devices trên các worker đang chạy phải đổi theo
+            cursor = connection.cursor()
+            storage.bump_table_version(backend, cursor, "devices")
+            connection.commit()
+            cursor.close()
+        if not args.dry_run:
+            cursor = connection.cursor()
+            unique = backend.ensure_fingerprint_index(cursor)
+            connection.commit()
+            cursor.close()
+            if unique:
+                print("[Migrate] Index fingerprint là UNIQUE")
+            else:
+                print("[Migrate Warning] Còn thiết bị trùng hoặc chưa back-fill, index fingerprint chưa thể là UNIQUE")
+    finally:
+        connection.close()
+
+    mode = " (dry run)" if args.dry_run else ""
+    print(f"[Migrate] Hoàn tất{mode}: back-fill {filled} thiết bị, {groups} nhóm trùng, xóa {removed} dòng")
+    print("[Migrate] Khởi động lại server để tắt tra cứu dự phòng theo mac/hostname")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,172 @@
+"""
+Migration: chuyển devices/logs về đúng shard theo fingerprint (DB_SHARDS)
+
+Chạy sau khi cấu hình DB_SHARDS (server nên dừng ghi trong lúc chạy; an toàn khi chạy lại):
+
+    python migrate_shards.py --from-primary --dry-run   # chỉ đếm số dòng cần chuyển
+    python migrate_shards.py --from-primary --batch-size 1000
+
+Các bước:
+1. Tạo schema trên các shard (init_schema của backend).
+2. Duyệt devices rồi logs trên từng database nguồn (các shard, và database chính nếu có
+   --from-primary): dòng nằm sai shard được chép sang shard đích (giữ nguyên ID) rồi xóa ở nguồn.
+3. Đặt ID tiếp theo của devices/logs trên từng shard lớn hơn ID lớn nhất hiện có trong dải ID
+   của shard đó (MySQL cấp ID xen kẽ nên dải là toàn bộ; SQLite mỗi shard một dải riêng), để ID
+   mới không trùng ID cũ đã được chuyển sang shard khác và vẫn suy ra đúng shard từ ID.
+
+Sau khi chạy nên tổng hợp lại thống kê: POST /api/admin/rollups/backfill?rebuild=true
+"""
+import os
+import sys
+import argparse
+
+from dotenv import load_dotenv
+
+import storage
+from shards import Shard, ShardMap
+from fingerprint import device_fingerprint
+
+load_dotenv()
+
+db_config = {
+    "host": os.getenv("DB_HOST", "127.0.0.1"),
+    "port": int(os.getenv("DB_PORT", "3308")),
+    "user": os.getenv("DB_USER", "KingAutoColony"),
+    "password": os.getenv("DB_PASSWORD", "StrongPass123"),
+    "database": os.getenv("DB_NAME", "license_system"),
+}
+
+
+def copy_rows(target, table, rows):
+    connection = target.backend.connect()
+    cursor = connection.cursor(dictionary=True)
+    try:
+        ids = [row["id"] for row in rows]
+        cursor.execute(f"SELECT id FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+        # Dòng đã được chép ở lần chạy trước (bị dừng trước khi xóa ở nguồn)
+        existing = {row["id"] for row in cursor.fetchall()}
+        rows = [row for row in rows if row["id"] not in existing]
+        if rows:
+            columns = list(rows[0].keys())
+            cursor.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+                [tuple(row[column] for column in columns) for row in rows]
+            )
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def rebalance_table(source_name, source_backend, source_index, shard_map, table, batch_size, dry_run):
+    connection = source_backend.connect()
+    cursor = connection.cursor(dictionary=True)
+    moved = 0
+    last_id = 0
+    try:
+        while True:
+            cursor.execute(f"SELECT * FROM {table} WHERE id > %s ORDER BY id LIMIT %s", [last_id, batch_size])
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            by_target = {}
+            for row in rows:
+                fingerprint = row.get("fingerprint") or device_fingerprint(row["mac"], row["hostname"])
+                if table == "devices":
+                    row["fingerprint"] = fingerprint
+                target = shard_map.for_fingerprint(fingerprint)
+                if target.index != source_index:
+                    by_target.setdefault(target.index, []).append(row)
+            count = sum(len(group) for group in by_target.values())
+            if not count:
+                continue
+            moved += count
+            print(f"[Migrate] {source_name}.{table}: chuyển {count} dòng (tới ID={last_id})")
+            if dry_run:
+                continue
+            for index, group in by_target.items():
+                copy_rows(shard_map.shards[index], table, group)
+            ids = [row["id"] for group in by_target.values() for row in group]
+            cursor.execute(f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+            connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+    return moved
+
+
+# ID lớn nhất trong dải [low, high] (high = None: không giới hạn trên)
+def max_id(backend, table, low, high):
+    connection = backend.connect()
+    cursor = connection.cursor()
+    if high is None:
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table} WHERE id >= %s", [low])
+    else:
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table} WHERE id BETWEEN %s AND %s", [low, high])
+    value = cursor.fetchone()[0]
+    cursor.close()
+    connection.close()
+    return value
+
+
+def raise_id_floors(shard_map, sources):
+    for table in storage.SHARDED_ID_TABLES:
+        for shard in shard_map.shards:
+            low, high = shard.backend.id_range(shard.index, len(shard_map))
+            floor = max(max(max_id(backend, table, low, high) for _, backend, _ in sources) + 1, low)
+            connection = shard.backend.connect()
+            cursor = connection.cursor()
+            shard.backend.set_id_floor(cursor, table, floor)
+            connection.commit()
+            cursor.close()
+            connection.close()
+            print(f"[Migrate] {table}: ID mới trên shard {shard.index} bắt đầu từ {floor}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Chuyển devices/logs về đúng shard theo fingerprint")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Số dòng đọc mỗi lô")
+    parser.add_argument("--from-primary", action="store_true", help="Chuyển cả dữ liệu đang nằm ở database chính (trước khi chia shard)")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ báo cáo, không ghi vào database")
+    args = parser.parse_args()
+
+    shard_map = ShardMap(Shard(index, name, backend) for index, (name, backend) in enumerate(storage.create_shard_backends(db_config)))
+    if not shard_map:
+        print("[Migrate] DB_SHARDS chưa được cấu hình")
+        return 1
+    for shard in shard_map.shards:
+        print(f"[Migrate] Shard {shard.index}: {shard.name}")
+        shard.backend.init_schema()
+
+    # (tên, backend, chỉ số shard; -1 = database chính không phải shard)
+    sources = [(shard.name, shard.backend, shard.index) for shard in shard_map.shards]
+    if args.from_primary:
+        primary = storage.create_backend(db_config)
+        sources.insert(0, ("primary", primary, -1))
+
+    total = 0
+    for table in storage.SHARDED_ID_TABLES:
+        for name, backend, index in sources:
+            total += rebalance_table(name, backend, index, shard_map, table, args.batch_size, args.dry_run)
+    if not args.dry_run:
+        raise_id_floors(shard_map, sources)
+        if total:
+            # ETag của danh sách devices/logs lưu ở database chính (global)
+            primary = storage.create_backend(db_config)
+            connection = primary.connect()
+            cursor = connection.cursor()
+            for table in storage.SHARDED_ID_TABLES:
+                storage.bump_table_version(primary, cursor, table)
+            connection.commit()
+            cursor.close()
+            connection.close()
+
+    mode = " (dry run)" if args.dry_run else ""
+    print(f"[Migrate] Hoàn tất{mode}: chuyển {total} dòng")
+    print("[Migrate] Tổng hợp lại thống kê: POST /api/admin/rollups/backfill?rebuild=true")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
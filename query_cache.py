@@ -0,0 +1,193 @@
+"""
+Cache kết quả SELECT cho /api/query, giới hạn theo dung lượng bộ nhớ
+
+Mỗi entry được gắn tag là các bảng mà câu SELECT đọc; khi có câu lệnh ghi
+vào bảng nào thì toàn bộ entry đọc bảng đó bị xóa.
+"""
+import re
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+
+_JOIN_TABLE_RE = re.compile(r"\bjoin\s+`?(\w+)`?", re.IGNORECASE)
+_FROM_LIST_RE = re.compile(r"\bfrom\s+([`\w\s,]+?)(?:\bwhere\b|\bgroup\b|\border\b|\blimit\b|\bhaving\b|\bjoin\b|\binner\b|\bleft\b|\bright\b|\bcross\b|\bunion\b|\)|;|$)", re.IGNORECASE)
+_WRITE_TABLE_RE = re.compile(
+    r"^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from|truncate\s+(?:table\s+)?|alter\s+table|drop\s+table\s+(?:if\s+exists\s+)?)\s*`?(\w+)`?",
+    re.IGNORECASE,
+)
+_STRING_LITERAL_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_WHITESPACE_RE = re.compile(r"\s+")
+# Các hàm cho kết quả thay đổi theo thời điểm gọi, không được cache
+_VOLATILE_RE = re.compile(r"\b(?:now|rand|uuid|sysdate|curdate|curtime|current_timestamp|current_date|last_insert_id|unix_timestamp)\b|\bfor\s+update\b", re.IGNORECASE)
+
+
+# Chuẩn hóa câu SQL: gộp khoảng trắng, bỏ dấu ; cuối, giữ nguyên chuỗi literal
+def normalize_sql(sql):
+    parts = []
+    last = 0
+    for match in _STRING_LITERAL_RE.finditer(sql):
+        parts.append(_WHITESPACE_RE.sub(" ", sql[last:match.start()]).lower())
+        parts.append(match.group(0))
+        last = match.end()
+    parts.append(_WHITESPACE_RE.sub(" ", sql[last:]).lower())
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+# Các bảng mà một câu SELECT đọc (FROM a, b / JOIN c)
+def read_tables(sql):
+    stripped = _STRING_LITERAL_RE.sub("''", sql)
+    tables = set()
+    for match in _FROM_LIST_RE.finditer(stripped):
+        for name in match.group(1).split(","):
+            words = name.split()
+            if words:
+                tables.add(words[0].strip("`").lower())
+    for match in _JOIN_TABLE_RE.finditer(stripped):
+        tables.add(match.group(1).lower())
+    return tables
+
+
+# Bảng bị thay đổi bởi một câu lệnh ghi, None nếu không xác định được
+def write_table(sql):
+    match = _WRITE_TABLE_RE.match(sql)
+    return match.group(1).lower() if match else None
+
+
+def _estimate_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += sys.getsizeof(key) + _estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += _estimate_size(item)
+    return size
+
+
+class QueryCache:
+    def __init__(self, enabled=False, max_bytes=64 * 1024 * 1024, ttl=60.0):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (result, tables, size, expires)
+        self._by_table = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Tăng mỗi lần invalidate, để bỏ qua kết quả đọc chồng lên một câu lệnh ghi
+        self.generation = 0
+
+    @staticmethod
+    def make_key(sql, params):
+        return normalize_sql(sql) + "\x00" + json.dumps(list(params or []), default=str)
+
+    # Chỉ cache SELECT có bảng xác định và không dùng hàm phụ thuộc thời gian
+    @staticmethod
+    def cacheable(sql):
+        return not _VOLATILE_RE.search(_STRING_LITERAL_RE.sub("''", sql)) and bool(read_tables(sql))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[3] < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, sql, result, generation=None):
+        size = _estimate_size(result) + sys.getsizeof(key)
+        if size > self.max_bytes:
+            return
+        tables = read_tables(sql)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, tables, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, tables, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+    # Xóa các entry đọc bảng vừa bị ghi; table=None nghĩa là xóa toàn bộ
+    def invalidate(self, table=None):
+        with self._lock:
+            self.generation += 1
+            if table is None:
+                keys = list(self._entries)
+            else:
+                keys = list(self._by_table.get(table, ()))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class TableVersions:
+    """Bộ đếm phiên bản theo bảng trong process này, tăng mỗi khi bảng bị ghi
+
+    Chỉ thấy các lần ghi của chính process; validator ETag/Last-Modified dùng phiên bản
+    lưu trong database (bảng table_versions) để thấy cả ghi của worker/process khác.
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._modified = {}
+        self._global = 0
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+    # table=None: câu lệnh ghi không xác định được bảng, coi như mọi bảng đều đổi
+    def bump(self, table=None):
+        now = time.time()
+        with self._lock:
+            if table is None:
+                self._global += 1
+                self._modified[None] = now
+            else:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                self._modified[table] = now
+
+    # Thời điểm ghi gần nhất (epoch seconds) của các bảng, mặc định là lúc process khởi động
+    def last_modified(self, tables):
+        with self._lock:
+            return max([self._started, self._modified.get(None, 0)] + [self._modified.get(table, 0) for table in tables])
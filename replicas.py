@@ -0,0 +1,183 @@
+"""
+Tách đọc/ghi: chuyển các câu SELECT sang read replica (DB_REPLICAS)
+
+- Chỉ câu SELECT thuần (không FOR UPDATE, LAST_INSERT_ID()...) được gửi sang replica.
+- Replica được health check định kỳ: kết nối được và lag (Seconds_Behind_Source)
+  không quá max_lag. Replica lỗi khi đọc bị loại ngay tới lần check sau; không còn
+  replica khỏe thì đọc trên primary.
+- Read-your-writes: mỗi request HTTP có một RequestWrites (contextvar). Sau khi
+  request đã ghi, mọi lần đọc còn lại của request đó đều chạy trên primary.
+- Chỉ request đọc thuần (GET/HEAD và các đường dẫn POST chỉ đọc được khai báo) dùng replica.
+  Request ghi (POST/PUT/DELETE...) đọc trên primary từ đầu, vì dữ liệu đọc được dùng để quyết
+  định ghi gì (tra cứu rồi đăng ký thiết bị, kiểm tra key rồi kích hoạt...). Đọc để ghi trong
+  request GET phải gọi use_primary().
+"""
+import re
+import time
+import threading
+import itertools
+import contextvars
+
+_READ_ONLY_RE = re.compile(r"^\s*\(?\s*select\b", re.IGNORECASE)
+# SELECT vẫn phải chạy trên primary: khóa dòng, hàm theo phiên kết nối
+_PRIMARY_ONLY_RE = re.compile(
+    r"\bfor\s+(?:update|share)\b|\block\s+in\s+share\s+mode\b|\binto\s+(?:@|outfile\b|dumpfile\b)"
+    r"|\b(?:last_insert_id|found_rows|row_count|get_lock|release_lock|is_used_lock)\s*\(",
+    re.IGNORECASE,
+)
+
+
+def is_read_only(sql):
+    return bool(_READ_ONLY_RE.match(sql)) and not _PRIMARY_ONLY_RE.search(sql)
+
+
+class RequestWrites:
+    """Trạng thái ghi của một request; là object dùng chung nên ghi trong threadpool vẫn thấy được"""
+
+    __slots__ = ("wrote", "primary")
+
+    def __init__(self, primary=False):
+        self.wrote = False
+        self.primary = primary
+
+
+_request_writes = contextvars.ContextVar("request_writes", default=None)
+
+
+def begin_request(primary=False):
+    return _request_writes.set(RequestWrites(primary))
+
+
+def end_request(token):
+    _request_writes.reset(token)
+
+
+def mark_written():
+    state = _request_writes.get()
+    if state is not None:
+        state.wrote = True
+
+
+# Các lần đọc còn lại của request sẽ dẫn tới ghi: đọc trên primary
+def use_primary():
+    state = _request_writes.get()
+    if state is not None:
+        state.primary = True
+
+
+# Chỉ đọc từ replica trong request HTTP đọc thuần chưa ghi gì; tác vụ nền luôn dùng primary
+def replica_allowed():
+    state = _request_writes.get()
+    return state is not None and not state.wrote and not state.primary
+
+
+class ReadYourWritesMiddleware:
+    READ_METHODS = ("GET", "HEAD")
+
+    # read_only_paths: đường dẫn không phải GET nhưng chỉ đọc (ví dụ POST có body là truy vấn)
+    def __init__(self, app, read_only_paths=()):
+        self.app = app
+        self.read_only_paths = tuple(read_only_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        primary = scope["method"] not in self.READ_METHODS and scope["path"] not in self.read_only_paths
+        token = begin_request(primary)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            end_request(token)
+
+
+class Replica:
+    def __init__(self, name, backend):
+        self.name = name
+        self.backend = backend
+        self.healthy = False
+        self.lag = None
+        self.checked_at = 0.0
+        self.error = None
+        self.reads = 0
+        self.failures = 0
+
+
+class ReplicaSet:
+    """Danh sách replica, chọn replica khỏe theo vòng tròn
+
+    max_lag: lag tối đa (giây) còn được đọc; stale_after: kết quả health check cũ hơn
+    thời gian này không còn được tin (bộ check bị treo) và replica bị bỏ qua.
+    """
+
+    def __init__(self, replicas, max_lag=5.0, stale_after=30.0):
+        self.replicas = list(replicas)
+        self.max_lag = float(max_lag)
+        self.stale_after = float(stale_after)
+        self.fallbacks = 0
+        self._cycle = itertools.count()
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    # Health check tất cả replica (chạy định kỳ trong threadpool)
+    def check(self):
+        for replica in self.replicas:
+            try:
+                connection = replica.backend.connect()
+                try:
+                    lag = replica.backend.replica_lag(connection)
+                finally:
+                    connection.close()
+                error = None if lag is not None else "replication stopped"
+            except Exception as e:
+                lag, error = None, str(e)
+            with self._lock:
+                replica.lag = lag
+                replica.error = error
+                replica.healthy = lag is not None and lag <= self.max_lag
+                replica.checked_at = time.time()
+            if error or not replica.healthy:
+                print(f"[Replica] {replica.name} không dùng được: lag={lag}, lỗi={error}")
+
+    def choose(self):
+        now = time.time()
+        with self._lock:
+            candidates = [
+                replica for replica in self.replicas
+                if replica.healthy and now - replica.checked_at <= self.stale_after
+            ]
+            if not candidates:
+                self.fallbacks += 1
+                return None
+            replica = candidates[next(self._cycle) % len(candidates)]
+            replica.reads += 1
+            return replica
+
+    # Replica lỗi khi đọc: loại khỏi vòng chọn tới lần health check sau
+    def mark_failed(self, replica, error):
+        with self._lock:
+            replica.healthy = False
+            replica.error = str(error)
+            replica.failures += 1
+            self.fallbacks += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_lag_seconds": self.max_lag,
+                "fallbacks": self.fallbacks,
+                "replicas": [
+                    {
+                        "name": replica.name,
+                        "healthy": replica.healthy,
+                        "lag_seconds": replica.lag,
+                        "checked_at": replica.checked_at or None,
+                        "error": replica.error,
+                        "reads": replica.reads,
+                        "failures": replica.failures,
+                    }
+                    for replica in self.replicas
+                ],
+            }
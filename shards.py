@@ -0,0 +1,400 @@
+"""
+Chia shard các bảng thiết bị/log theo fingerprint (DB_SHARDS)
+
+- devices, logs và các bảng tổng hợp của logs (log_rollups, rollup_state) nằm trên
+  N shard; users, user_permissions, change_log ở database global (db_config).
+- Thiết bị và log của nó nằm cùng shard: shard = hash(fingerprint(mac, hostname)) % N.
+- ID không trùng giữa các shard: backend cấp ID xen kẽ (MySQL) hoặc theo dải (SQLite),
+  backend.shard_of_id() suy ra shard từ ID.
+- Câu lệnh có khóa định tuyến (INSERT có mac/hostname/fingerprint, WHERE fingerprint = %s,
+  mac = %s AND hostname = %s, id = %s) chạy trên đúng một shard. SELECT không có khóa được
+  scatter-gather: gửi tới mọi shard rồi gộp theo ORDER BY/LIMIT, các cột COUNT/SUM/MIN/MAX
+  được gộp lại theo GROUP BY. SELECT không gộp đúng được (AVG, DISTINCT, HAVING, JOIN với
+  bảng global, tổng hợp kèm LIMIT...) bị từ chối bằng UnsupportedScatter thay vì trả kết quả sai.
+"""
+import re
+import heapq
+import hashlib
+
+from fingerprint import device_fingerprint
+from query_cache import read_tables, write_table
+
+SHARDED_TABLES = frozenset(("devices", "logs", "log_rollups", "rollup_state"))
+# Bảng có khóa định tuyến theo thiết bị
+DEVICE_TABLES = ("devices", "logs")
+
+_INSERT_RE = re.compile(
+    r"^\s*insert\s+(?:ignore\s+)?into\s+`?(\w+)`?\s*\(([^)]*)\)\s*values\s*\((.*)\)\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_WHERE_RE = re.compile(r"\bwhere\b", re.IGNORECASE)
+_OR_RE = re.compile(r"\bor\b", re.IGNORECASE)
+_FINGERPRINT_KEY_RE = re.compile(r"\bfingerprint\s*=\s*%s", re.IGNORECASE)
+_MAC_KEY_RE = re.compile(r"\bmac\s*(?:=|\bin\s*\()\s*%s", re.IGNORECASE)
+_HOSTNAME_KEY_RE = re.compile(r"\bhostname\s*=\s*%s", re.IGNORECASE)
+_ID_KEY_RE = re.compile(r"(?<![\w.])(?:\w+\.)?id\s*=\s*%s", re.IGNORECASE)
+
+_SELECT_RE = re.compile(r"^\s*select\s+", re.IGNORECASE)
+_FROM_RE = re.compile(r"\bfrom\b", re.IGNORECASE)
+_AGGREGATE_RE = re.compile(r"^(?:coalesce\s*\(\s*)?(count|sum|min|max)\s*\(", re.IGNORECASE)
+_ALIAS_RE = re.compile(r"(?:\bas\s+)?`?(\w+)`?\s*$", re.IGNORECASE)
+# Phải chạy trên toàn bộ dữ liệu cùng lúc, không gộp được từ kết quả từng shard
+_UNMERGEABLE_RE = re.compile(
+    r"\bdistinct\b|\bhaving\b|\bunion\b|\b(?:avg|group_concat|std|stddev\w*|var_\w+|variance"
+    r"|bit_and|bit_or|bit_xor|json_arrayagg|json_objectagg)\s*\(",
+    re.IGNORECASE,
+)
+_AGGREGATE_CALL_RE = re.compile(r"\b(?:count|sum|min|max)\s*\(", re.IGNORECASE)
+_ALIAS_SUFFIX = r"(?:\s+(?:as\s+)?`?\w+`?)?\s*$"
+_AGGREGATE_TAIL_RE = re.compile(r"^" + _ALIAS_SUFFIX, re.IGNORECASE)
+_COALESCE_TAIL_RE = re.compile(r"^\s*(?:,[^()]*)?\)" + _ALIAS_SUFFIX, re.IGNORECASE)
+_GROUP_BY_RE = re.compile(r"\bgroup\s+by\s+(.+?)\s*(?:\border\s+by\b.*|\blimit\b.*)?;?\s*$", re.IGNORECASE | re.DOTALL)
+_ORDER_BY_RE = re.compile(r"\border\s+by\s+(.+?)\s*(?:\blimit\b.*)?;?\s*$", re.IGNORECASE | re.DOTALL)
+_LIMIT_RE = re.compile(
+    r"\blimit\s+(\d+|%s)(?:\s*,\s*(\d+|%s))?(?:\s+offset\s+(\d+|%s))?\s*;?\s*$",
+    re.IGNORECASE,
+)
+
+
+def shard_hash(fingerprint):
+    return int(hashlib.blake2b(fingerprint.encode("utf-8"), digest_size=8).hexdigest(), 16)
+
+
+# Các bảng mà câu lệnh đọc/ghi
+def statement_tables(sql):
+    table = write_table(sql)
+    return {table} if table else read_tables(sql)
+
+
+def is_sharded(sql):
+    return bool(statement_tables(sql) & SHARDED_TABLES)
+
+
+# Tách theo dấu phẩy ở cấp ngoài cùng (bỏ qua dấu phẩy trong ngoặc)
+def _split_top_level(text):
+    parts = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(text[start:index].strip())
+            start = index + 1
+    parts.append(text[start:].strip())
+    return parts
+
+
+# Cột tổng hợp gộp lại được giữa các shard: func(...) hoặc COALESCE(func(...), giá trị), có thể kèm alias
+def _is_mergeable_aggregate(item):
+    match = _AGGREGATE_RE.match(item)
+    if not match:
+        return False
+    depth = 1
+    index = match.end()
+    while index < len(item) and depth:
+        if item[index] == "(":
+            depth += 1
+        elif item[index] == ")":
+            depth -= 1
+        index += 1
+    tail = _COALESCE_TAIL_RE if item[:8].lower().startswith("coalesce") else _AGGREGATE_TAIL_RE
+    return not depth and bool(tail.match(item[index:]))
+
+
+def _param_index(sql, position):
+    return sql.count("%s", 0, position)
+
+
+# Khóa định tuyến của câu lệnh: ("fingerprint", fp), ("id", id) hoặc None (không có)
+def route_key(sql, params):
+    params = params or []
+    match = _INSERT_RE.match(sql)
+    if match:
+        columns = [column.strip().strip("`").lower() for column in match.group(2).split(",")]
+        values = _split_top_level(match.group(3))
+        if len(values) != len(columns):
+            return None  # INSERT nhiều dòng
+        position = match.start(3)
+        by_column = {}
+        for column, value in zip(columns, values):
+            start = sql.index(value, position)
+            if value == "%s":
+                by_column[column] = params[_param_index(sql, start)]
+            position = start + len(value)
+        if by_column.get("fingerprint"):
+            return "fingerprint", by_column["fingerprint"]
+        if "mac" in by_column and "hostname" in by_column:
+            return "fingerprint", device_fingerprint(by_column["mac"], by_column["hostname"])
+        return None
+
+    where = _WHERE_RE.search(sql)
+    if not where or _OR_RE.search(sql, where.end()):
+        return None
+    match = _FINGERPRINT_KEY_RE.search(sql, where.end())
+    if match:
+        return "fingerprint", params[_param_index(sql, match.end() - 2)]
+    mac = _MAC_KEY_RE.search(sql, where.end())
+    hostname = _HOSTNAME_KEY_RE.search(sql, where.end())
+    if mac and hostname:
+        return "fingerprint", device_fingerprint(
+            params[_param_index(sql, mac.end() - 2)],
+            params[_param_index(sql, hostname.end() - 2)]
+        )
+    match = _ID_KEY_RE.search(sql, where.end())
+    if match:
+        return "id", params[_param_index(sql, match.end() - 2)]
+    return None
+
+
+class Shard:
+    def __init__(self, index, name, backend):
+        self.index = index
+        self.name = name
+        self.backend = backend
+
+
+class ShardMap:
+    def __init__(self, shards):
+        self.shards = list(shards)
+
+    def __bool__(self):
+        return bool(self.shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def for_fingerprint(self, fingerprint):
+        return self.shards[shard_hash(fingerprint) % len(self.shards)]
+
+    def for_device(self, mac, hostname):
+        return self.for_fingerprint(device_fingerprint(mac, hostname))
+
+    # None nếu ID không thuộc dải/chuỗi của shard nào (dữ liệu có từ trước khi chia shard)
+    def for_id(self, row_id):
+        try:
+            index = self.shards[0].backend.shard_of_id(int(row_id), len(self.shards))
+        except (TypeError, ValueError):
+            return None
+        return self.shards[index] if index is not None and 0 <= index < len(self.shards) else None
+
+    # (shard, by_id) cho câu lệnh có khóa định tuyến, (None, False) nếu phải chạy trên mọi shard
+    def route(self, sql, params):
+        if not statement_tables(sql) & set(DEVICE_TABLES):
+            return None, False
+        key = route_key(sql, params)
+        if key is None:
+            return None, False
+        kind, value = key
+        if kind == "id":
+            return self.for_id(value), True
+        return self.for_fingerprint(value), False
+
+    # Chia danh sách theo shard: [(shard, items)]
+    def group(self, items, fingerprint_of):
+        groups = {}
+        for item in items:
+            groups.setdefault(self.for_fingerprint(fingerprint_of(item)).index, []).append(item)
+        return [(self.shards[index], group) for index, group in sorted(groups.items())]
+
+
+class UnsupportedScatter(ValueError):
+    """SELECT trên bảng đã chia shard không gộp đúng được từ kết quả từng shard"""
+
+
+def _order_key(value):
+    # NULL đứng trước khi sắp tăng dần như MySQL
+    return (value is not None, value)
+
+
+class ScatterPlan:
+    """Câu SELECT gửi tới mọi shard và cách gộp kết quả
+
+    LIMIT n OFFSET m được gửi tới từng shard thành LIMIT m + n rồi cắt lại sau khi gộp.
+    Cột ORDER BY không có trong danh sách cột được thêm tạm (_shard_order_i) và bỏ đi sau khi gộp.
+    """
+
+    def __init__(self, sql, params):
+        self.sql = sql.strip().rstrip(";")
+        self.params = list(params or [])
+        self.offset = 0
+        self.limit = None
+        self.items = self._select_items()
+        self.aggregates = {name: func for name, func in self.items if func}
+        self.order = self._order_by()
+        self._check_mergeable()
+        self.hidden = []
+        self._rewrite_limit()
+        self._add_order_columns()
+
+    def _select_items(self):
+        match = _SELECT_RE.match(self.sql)
+        if not match:
+            return []
+        depth = 0
+        end = None
+        for index in range(match.end(), len(self.sql)):
+            char = self.sql[index]
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif depth == 0 and _FROM_RE.match(self.sql, index) and self.sql[index - 1].isspace():
+                end = index
+                break
+        if end is None:
+            return []
+        self._from_position = end
+        items = []
+        for item in _split_top_level(self.sql[match.end():end]):
+            aggregate = _AGGREGATE_RE.match(item)
+            alias = _ALIAS_RE.search(item)
+            name = alias.group(1) if alias and item != "*" else item
+            items.append((name, aggregate.group(1).lower() if aggregate else None))
+        return items
+
+    def _check_mergeable(self):
+        if _UNMERGEABLE_RE.search(self.sql):
+            raise UnsupportedScatter("DISTINCT, HAVING, UNION và AVG/GROUP_CONCAT... không chạy được trên bảng đã chia shard")
+        global_tables = statement_tables(self.sql) - SHARDED_TABLES
+        if global_tables:
+            raise UnsupportedScatter(f"Không JOIN được bảng đã chia shard với bảng global: {', '.join(sorted(global_tables))}")
+        group_by = _GROUP_BY_RE.search(self.sql)
+        if not self.aggregates and not group_by:
+            return
+        if not self.items:
+            raise UnsupportedScatter("Không phân tích được danh sách cột của câu SELECT tổng hợp")
+        for item in _split_top_level(self.sql[_SELECT_RE.match(self.sql).end():self._from_position]):
+            if _AGGREGATE_CALL_RE.search(item) and not _is_mergeable_aggregate(item):
+                raise UnsupportedScatter(f"Biểu thức tổng hợp không gộp được giữa các shard: {item}")
+        if _LIMIT_RE.search(self.sql):
+            raise UnsupportedScatter("Câu SELECT tổng hợp kèm LIMIT không chạy được trên bảng đã chia shard")
+        names = {name for name, func in self.items if not func}
+        columns = [item.split(".")[-1].strip("`") for item in _split_top_level(group_by.group(1))] if group_by else []
+        missing = [column for column in columns if column not in names]
+        if missing:
+            raise UnsupportedScatter(f"Cột GROUP BY phải có trong danh sách cột: {', '.join(missing)}")
+        unordered = [column for column, _ in self.order if column not in names and column not in self.aggregates]
+        if unordered:
+            raise UnsupportedScatter(f"ORDER BY của câu SELECT tổng hợp chỉ dùng được cột đã chọn: {', '.join(unordered)}")
+
+    def _order_by(self):
+        match = _ORDER_BY_RE.search(self.sql)
+        if not match:
+            return []
+        order = []
+        for item in _split_top_level(match.group(1)):
+            words = item.split()
+            descending = len(words) > 1 and words[-1].lower() == "desc"
+            order.append((words[0].split(".")[-1].strip("`"), descending))
+        return order
+
+    def _rewrite_limit(self):
+        match = _LIMIT_RE.search(self.sql)
+        if not match:
+            return
+        values = []
+        params_used = 0
+        for token in match.groups():
+            if token == "%s":
+                values.append(int(self.params[len(self.params) - match.group(0).count("%s") + params_used]))
+                params_used += 1
+            else:
+                values.append(None if token is None else int(token))
+        first, second, offset = values
+        if second is not None:
+            # LIMIT offset, count
+            self.offset, self.limit = first, second
+        else:
+            self.limit, self.offset = first, offset or 0
+        if params_used:
+            self.params = self.params[:-params_used]
+        self.sql = self.sql[:match.start()] + f"LIMIT {self.offset + self.limit}"
+
+    def _add_order_columns(self):
+        if not self.order or not self.items or any(name == "*" for name, _ in self.items):
+            return
+        names = {name for name, _ in self.items}
+        extra = []
+        for index, (column, descending) in enumerate(self.order):
+            if column not in names:
+                hidden = f"_shard_order_{index}"
+                extra.append(f"{column} AS {hidden}")
+                self.hidden.append(hidden)
+                self.order[index] = (hidden, descending)
+        if extra:
+            position = self._from_position
+            self.sql = self.sql[:position].rstrip() + ", " + ", ".join(extra) + " " + self.sql[position:]
+
+    # Gộp kết quả các shard. results: list dòng dict (columns=None) hoặc tuple (columns = tên cột)
+    def merge(self, results, columns=None):
+        lists = [rows for rows in results if rows]
+        if columns is None:
+            get = lambda row, name: row[name]
+        else:
+            positions = {name: index for index, name in enumerate(columns)}
+            get = lambda row, name: row[positions[name]]
+
+        if self.aggregates:
+            rows = [row for rows in lists for row in rows]
+            if columns is None:
+                rows = self._regroup(rows)
+            else:
+                rows = [tuple(row.values()) for row in self._regroup([dict(zip(columns, row)) for row in rows])]
+            rows = self._sorted(rows, get)
+        elif self.order and len(self.order) > 1 and len({descending for _, descending in self.order}) > 1:
+            rows = self._sorted([row for rows in lists for row in rows], get)
+        elif self.order:
+            descending = self.order[0][1]
+            key = lambda row: tuple(_order_key(get(row, name)) for name, _ in self.order)
+            rows = list(heapq.merge(*lists, key=key, reverse=descending))
+        else:
+            rows = [row for rows in lists for row in rows]
+
+        if self.limit is not None or self.offset:
+            end = None if self.limit is None else self.offset + self.limit
+            rows = rows[self.offset:end]
+        if self.hidden:
+            rows = self._strip_hidden(rows, columns)
+        return rows
+
+    def output_columns(self, columns):
+        return [name for name in columns if name not in self.hidden]
+
+    def _strip_hidden(self, rows, columns):
+        if columns is None:
+            for row in rows:
+                for name in self.hidden:
+                    row.pop(name, None)
+            return rows
+        keep = [index for index, name in enumerate(columns) if name not in self.hidden]
+        return [tuple(row[index] for index in keep) for row in rows]
+
+    def _sorted(self, rows, get):
+        for name, descending in reversed(self.order):
+            rows.sort(key=lambda row: _order_key(get(row, name)), reverse=descending)
+        return rows
+
+    # Gộp lại các cột COUNT/SUM/MIN/MAX theo các cột còn lại (GROUP BY)
+    def _regroup(self, rows):
+        group_columns = [name for name, func in self.items if not func]
+        groups = {}
+        for row in rows:
+            key = tuple(row[name] for name in group_columns)
+            merged = groups.get(key)
+            if merged is None:
+                groups[key] = dict(row)
+                continue
+            for name, func in self.aggregates.items():
+                values = [value for value in (merged[name], row[name]) if value is not None]
+                if not values:
+                    continue
+                if func in ("count", "sum"):
+                    merged[name] = sum(values)
+                elif func == "min":
+                    merged[name] = min(values)
+                else:
+                    merged[name] = max(values)
+        return list(groups.values())
@@ -0,0 +1,63 @@
+"""
+Bộ đếm tổng hợp cho dashboard, cập nhật tăng dần từ các thao tác ghi
+
+Mỗi worker giữ bộ đếm riêng trong bộ nhớ; thay đổi từ worker khác hoặc những
+thao tác không biết trạng thái trước đó được sửa lại bằng reconcile() định kỳ
+từ database.
+"""
+import time
+import threading
+
+
+class SummaryCounters:
+    DEVICE_FIELDS = ("devices_total", "devices_active", "devices_inactive", "keys_issued", "expiring_soon")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = dict.fromkeys(self.DEVICE_FIELDS, 0)
+        self._logs_by_action = {}
+        self._logs_total = 0
+        self.reconciled_at = None  # time.time() của lần reconcile gần nhất
+        self.dirty = True
+        self.updates = 0
+
+    # Cộng dồn thay đổi đã biết chắc, ví dụ apply(devices_active=1, devices_inactive=-1)
+    def apply(self, **deltas):
+        with self._lock:
+            for field, delta in deltas.items():
+                self._devices[field] = self._devices.get(field, 0) + delta
+            self.updates += 1
+
+    def log_added(self, action, count=1):
+        with self._lock:
+            self._logs_by_action[action] = self._logs_by_action.get(action, 0) + count
+            self._logs_total += count
+            self.updates += 1
+
+    def logs_cleared(self):
+        with self._lock:
+            self._logs_by_action = {}
+            self._logs_total = 0
+            self.updates += 1
+
+    # Không xác định được thay đổi chính xác: đánh dấu để reconcile sớm
+    def mark_dirty(self):
+        self.dirty = True
+
+    def reconcile(self, devices, logs_by_action):
+        with self._lock:
+            self._devices = {field: int(devices.get(field) or 0) for field in self.DEVICE_FIELDS}
+            self._logs_by_action = {action: int(count) for action, count in logs_by_action.items()}
+            self._logs_total = sum(self._logs_by_action.values())
+            self.reconciled_at = time.time()
+            self.dirty = False
+
+    def needs_reconcile(self, max_age):
+        return self.dirty or self.reconciled_at is None or time.time() - self.reconciled_at >= max_age
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "devices": {field: max(0, value) for field, value in self._devices.items()},
+                "logs": {"total": max(0, self._logs_total), "by_action": dict(self._logs_by_action)},
+            }
@@ -0,0 +1,640 @@
+"""
+Lớp lưu trữ (storage backend) cho API: MySQL hoặc SQLite nhúng
+
+Chọn backend bằng biến môi trường DB_BACKEND=mysql|sqlite.
+Cả hai backend trả về connection có cùng giao diện với mysql.connector
+(cursor(dictionary=True), commit, rollback, lastrowid, rowcount...) nên
+execute_query và các handler trong main.py không cần biết đang chạy engine nào.
+"""
+import os
+import re
+import time
+import sqlite3
+import datetime
+import mysql.connector
+
+import replicas
+
+# Lỗi database của cả hai engine, dùng trong các khối except
+DatabaseError = (mysql.connector.Error, sqlite3.Error)
+
+# Lỗi MySQL tạm thời, thử lại được: chờ khóa quá lâu, deadlock, không kết nối được/mất kết nối
+MYSQL_CONNECTION_ERRNOS = {2003, 2006, 2013, 2055}
+MYSQL_TRANSIENT_ERRNOS = {1205, 1213} | MYSQL_CONNECTION_ERRNOS
+MYSQL_DUPLICATE_KEY_ERRNO = 1062
+
+
+# Lỗi do database tạm thời không phục vụ được (không phải lỗi của câu lệnh)
+def is_transient_error(error):
+    if isinstance(error, mysql.connector.Error):
+        return error.errno in MYSQL_TRANSIENT_ERRNOS
+    if isinstance(error, sqlite3.OperationalError):
+        message = str(error)
+        return "locked" in message or "busy" in message
+    return False
+
+
+# Vi phạm khóa UNIQUE (ví dụ hai worker cùng thêm một thiết bị); lỗi đã bị bọc lại (execute_query) thì xét lỗi gốc
+def is_duplicate_key_error(error):
+    while error is not None:
+        if isinstance(error, mysql.connector.IntegrityError) and error.errno == MYSQL_DUPLICATE_KEY_ERRNO:
+            return True
+        if isinstance(error, sqlite3.IntegrityError) and "UNIQUE" in str(error):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+# Lỗi cho thấy database không phục vụ được (tính vào circuit breaker), khác với lỗi khóa/deadlock
+def is_connection_error(error):
+    if isinstance(error, mysql.connector.Error):
+        return error.errno in MYSQL_CONNECTION_ERRNOS
+    if isinstance(error, sqlite3.OperationalError):
+        message = str(error)
+        return "unable to open" in message or "disk I/O error" in message
+    return False
+
+
+# Thời gian tối đa của một câu lệnh (ms), 0 = không giới hạn
+def statement_timeout_ms():
+    return int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "10000"))
+
+# Mật khẩu mặc định của admin (giống /update-admin-password) cho SQLite mới tạo
+DEFAULT_ADMIN_HASH = '57d5243f8cc6f65efc289152304ce70477110894b24021306f0bf77e019de06f'
+
+# Bảng có ID được cấp riêng trên mỗi shard (xem shards.py)
+SHARDED_ID_TABLES = ("devices", "logs")
+# Độ rộng dải ID của mỗi shard SQLite: shard i cấp ID từ i * SQLITE_SHARD_ID_SPAN + 1
+SQLITE_SHARD_ID_SPAN = 10 ** 12
+
+
+# Phiên bản dùng chung của bảng trong database global, là validator ETag/Last-Modified của mọi worker.
+# Script ghi thẳng vào database (migration, import) cũng phải gọi hàm này sau khi ghi
+def bump_table_version(backend, cursor, table):
+    cursor.execute(
+        backend.upsert_increment_sql("table_versions", ["name", "version", "modified_at"], ["name"], "version", replace=["modified_at"]),
+        [table, 1, time.time()]
+    )
+
+
+# ==== MYSQL ====
+
+MYSQL_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS user_permissions (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id INT NOT NULL,
+        permission VARCHAR(50) NOT NULL,
+        granted_by INT NOT NULL,
+        granted_at DATETIME NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY (granted_by) REFERENCES users(id),
+        UNIQUE KEY unique_user_permission (user_id, permission)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS change_log (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        table_name VARCHAR(32) NOT NULL,
+        row_id BIGINT NULL,
+        op VARCHAR(16) NOT NULL,
+        changed_at DATETIME NOT NULL,
+        INDEX idx_change_log_table (table_name, id),
+        INDEX idx_change_log_changed_at (changed_at)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS log_rollups (
+        granularity VARCHAR(8) NOT NULL,
+        bucket_start DATETIME NOT NULL,
+        action VARCHAR(50) NOT NULL,
+        performed_by INT NOT NULL DEFAULT 0,
+        count INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (granularity, bucket_start, action, performed_by)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        name VARCHAR(32) PRIMARY KEY,
+        last_id BIGINT NOT NULL DEFAULT 0,
+        updated_at DATETIME NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS table_versions (
+        name VARCHAR(64) PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0,
+        modified_at DOUBLE NOT NULL DEFAULT 0
+    )
+    """,
+]
+
+
+# Cột thêm vào các bảng có sẵn: (bảng, cột, kiểu). Dữ liệu cũ được back-fill bằng migrate_fingerprints.py
+ADDED_COLUMNS = [
+    ("devices", "fingerprint", "CHAR(28) NULL"),
+]
+
+# Index trên các bảng có sẵn: (bảng, tên index, cột). MySQL không có CREATE INDEX IF NOT EXISTS
+MYSQL_INDEXES = [
+    ("devices", "idx_devices_active_expires", "active, expires_at"),
+    ("logs", "idx_logs_timestamp", "timestamp"),
+]
+
+# devices.fingerprint: index UNIQUE khi mọi dòng đã được back-fill và không còn thiết bị trùng (sau
+# migrate_fingerprints.py), trước đó là index thường. NULL (dòng chưa back-fill) không bị ràng buộc UNIQUE
+FINGERPRINT_INDEX = "idx_devices_fingerprint"
+FINGERPRINT_UNIQUE_INDEX = "uniq_devices_fingerprint"
+FINGERPRINT_UNIQUE_BLOCKERS = [
+    "SELECT 1 FROM devices WHERE fingerprint IS NULL LIMIT 1",
+    "SELECT fingerprint FROM devices WHERE fingerprint IS NOT NULL GROUP BY fingerprint HAVING COUNT(*) > 1 LIMIT 1",
+]
+
+
+# Chưa tạo được index UNIQUE trên fingerprint: còn dòng chưa back-fill (back-fill có thể va vào dòng trùng) hoặc dòng trùng
+def fingerprint_unique_blocked(cursor):
+    for sql in FINGERPRINT_UNIQUE_BLOCKERS:
+        cursor.execute(sql)
+        blocked = cursor.fetchall()
+        if blocked:
+            return True
+    return False
+
+
+class MySQLBackend:
+    name = "mysql"
+    label = "MySQL"
+    explain_prefix = "EXPLAIN "
+    # Khóa các dòng được chọn trong transaction, bỏ qua dòng worker khác đang khóa
+    lock_rows_suffix = " FOR UPDATE SKIP LOCKED"
+    # Khóa các dòng được chọn, chờ dòng đang bị khóa (thao tác người dùng yêu cầu không được bỏ sót dòng)
+    lock_rows_wait_suffix = " FOR UPDATE"
+
+    # shard: (số shard, chỉ số) khi backend là một shard dữ liệu, None với database global
+    def __init__(self, config, shard=None):
+        self.config = config
+        self.shard = shard
+        self.statement_timeout_ms = statement_timeout_ms()
+
+    def describe(self):
+        return self.config
+
+    def connect(self):
+        connection = mysql.connector.connect(**self.config)
+        settings = []
+        if self.shard:
+            # ID xen kẽ giữa các shard: shard i cấp i+1, i+1+N, i+1+2N...
+            count, index = self.shard
+            settings += [("auto_increment_increment", count), ("auto_increment_offset", index + 1)]
+        if self.statement_timeout_ms:
+            # SELECT chạy quá thời gian bị server hủy (lỗi 3024); câu lệnh ghi chờ khóa tối đa bấy nhiêu giây
+            settings += [
+                ("max_execution_time", self.statement_timeout_ms),
+                ("innodb_lock_wait_timeout", max(1, -(-self.statement_timeout_ms // 1000))),
+            ]
+        if settings:
+            cursor = connection.cursor()
+            cursor.execute("SET SESSION " + ", ".join(f"{name} = %s" for name, _ in settings), [value for _, value in settings])
+            cursor.close()
+        return connection
+
+    # Shard sở hữu một ID (cấp theo auto_increment_increment/offset)
+    def shard_of_id(self, row_id, count):
+        return (row_id - 1) % count
+
+    # Dải ID (thấp, cao; None = không giới hạn) mà shard index cấp: ID xen kẽ nên là toàn bộ dải
+    def id_range(self, index, count):
+        return 1, None
+
+    # ID cấp tiếp theo của bảng không nhỏ hơn floor (sau khi chuyển dữ liệu giữa các shard)
+    def set_id_floor(self, cursor, table, floor):
+        cursor.execute(f"ALTER TABLE {table} AUTO_INCREMENT = {int(floor)}")
+
+    # INSERT cộng dồn: dòng đã tồn tại (trùng khóa) thì cộng thêm vào cột counter, các cột replace lấy giá trị mới
+    def upsert_increment_sql(self, table, columns, key_columns, counter, replace=()):
+        placeholders = ", ".join(["%s"] * len(columns))
+        updates = [f"{counter} = {counter} + VALUES({counter})"] + [f"{column} = VALUES({column})" for column in replace]
+        return (
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON DUPLICATE KEY UPDATE {', '.join(updates)}"
+        )
+
+    # Biểu thức cộng số ngày (một tham số %s) vào cột DATETIME
+    def add_days_sql(self, column):
+        return f"DATE_ADD({column}, INTERVAL %s DAY)"
+
+    # Độ trễ replication (giây) của server này; 0 nếu không phải replica, None nếu replication đã dừng
+    def replica_lag(self, connection):
+        cursor = connection.cursor(dictionary=True)
+        try:
+            cursor.execute("SHOW REPLICA STATUS")
+        except mysql.connector.Error:
+            # MySQL < 8.0.22
+            cursor.execute("SHOW SLAVE STATUS")
+        status = cursor.fetchone()
+        cursor.fetchall()
+        cursor.close()
+        if not status:
+            return 0.0
+        lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+        return None if lag is None else float(lag)
+
+    # Tạo các bảng phụ nếu chưa tồn tại (devices, logs, users đã có sẵn trên server)
+    def init_schema(self):
+        connection = self.connect()
+        cursor = connection.cursor()
+        for ddl in MYSQL_SCHEMA:
+            # user_permissions tham chiếu users, chỉ có ở database global
+            if self.shard and "user_permissions" in ddl:
+                continue
+            cursor.execute(ddl)
+        for table, column, column_type in ADDED_COLUMNS:
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s",
+                [table, column]
+            )
+            if cursor.fetchone()[0] == 0:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        for table, name, columns in MYSQL_INDEXES:
+            if not self._has_index(cursor, table, name):
+                cursor.execute(f"CREATE INDEX {name} ON {table} ({columns})")
+        self.ensure_fingerprint_index(cursor)
+        connection.commit()
+        cursor.close()
+        connection.close()
+
+    def _has_index(self, cursor, table, name):
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+            [table, name]
+        )
+        return cursor.fetchone()[0] > 0
+
+    # Index UNIQUE trên devices.fingerprint nếu đã tạo được (bỏ index thường khi đó), không thì index thường;
+    # trả về True nếu đã có index UNIQUE
+    def ensure_fingerprint_index(self, cursor):
+        if not self._has_index(cursor, "devices", FINGERPRINT_UNIQUE_INDEX):
+            if fingerprint_unique_blocked(cursor):
+                if not self._has_index(cursor, "devices", FINGERPRINT_INDEX):
+                    cursor.execute(f"CREATE INDEX {FINGERPRINT_INDEX} ON devices (fingerprint)")
+                return False
+            cursor.execute(f"CREATE UNIQUE INDEX {FINGERPRINT_UNIQUE_INDEX} ON devices (fingerprint)")
+        if self._has_index(cursor, "devices", FINGERPRINT_INDEX):
+            cursor.execute(f"DROP INDEX {FINGERPRINT_INDEX} ON devices")
+        return True
+
+
+# ==== SQLITE ====
+
+SQLITE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(50) UNIQUE NOT NULL,
+        password_hash VARCHAR(255) NOT NULL,
+        role VARCHAR(20) NOT NULL DEFAULT 'user',
+        created_at DATETIME NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS devices (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        mac VARCHAR(50) NOT NULL,
+        hostname VARCHAR(255) NOT NULL,
+        key_code VARCHAR(64),
+        active INTEGER NOT NULL DEFAULT 0,
+        added_by INTEGER,
+        created_at DATETIME,
+        activated_at DATETIME,
+        expires_at DATETIME,
+        fingerprint CHAR(28)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_devices_mac_hostname ON devices (mac, hostname)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_key_code ON devices (key_code)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_active_expires ON devices (active, expires_at)",
+    """
+    CREATE TABLE IF NOT EXISTS logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        mac VARCHAR(50),
+        hostname VARCHAR(255),
+        action VARCHAR(50) NOT NULL,
+        performed_by INTEGER,
+        timestamp DATETIME NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs (timestamp)",
+    """
+    CREATE TABLE IF NOT EXISTS user_permissions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        permission VARCHAR(50) NOT NULL,
+        granted_by INTEGER NOT NULL,
+        granted_at DATETIME NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY (granted_by) REFERENCES users(id),
+        UNIQUE (user_id, permission)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS change_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name VARCHAR(32) NOT NULL,
+        row_id INTEGER,
+        op VARCHAR(16) NOT NULL,
+        changed_at DATETIME NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_change_log_table ON change_log (table_name, id)",
+    "CREATE INDEX IF NOT EXISTS idx_change_log_changed_at ON change_log (changed_at)",
+    """
+    CREATE TABLE IF NOT EXISTS log_rollups (
+        granularity VARCHAR(8) NOT NULL,
+        bucket_start DATETIME NOT NULL,
+        action VARCHAR(50) NOT NULL,
+        performed_by INTEGER NOT NULL DEFAULT 0,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (granularity, bucket_start, action, performed_by)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        name VARCHAR(32) PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        updated_at DATETIME
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS table_versions (
+        name VARCHAR(64) PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0,
+        modified_at REAL NOT NULL DEFAULT 0
+    )
+    """,
+]
+
+_PLACEHOLDER_RE = re.compile(r"%s")
+_NOW_RE = re.compile(r"\bNOW\(\)", re.IGNORECASE)
+
+
+# Chuyển câu lệnh viết cho MySQL sang cú pháp SQLite
+def translate_sql(sql):
+    sql = _PLACEHOLDER_RE.sub("?", sql)
+    return _NOW_RE.sub("datetime('now', 'localtime')", sql)
+
+
+# SQLite lưu DATETIME dạng chuỗi, chuyển lại thành datetime giống mysql.connector
+def _convert_datetime(value):
+    text = value.decode()
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return text
+
+
+sqlite3.register_converter("DATETIME", _convert_datetime)
+
+
+class SQLiteCursor:
+    def __init__(self, cursor, dictionary=False, connection=None):
+        self._cursor = cursor
+        self._dictionary = dictionary
+        self._connection = connection
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def column_names(self):
+        return tuple(column[0] for column in self._cursor.description or ())
+
+    def _convert(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return dict(row)
+
+    def execute(self, sql, params=None):
+        if self._connection:
+            self._connection.start_statement(sql)
+        self._cursor.execute(translate_sql(sql), params or [])
+
+    def executemany(self, sql, seq_params):
+        if self._connection:
+            self._connection.start_statement(sql)
+        self._cursor.executemany(translate_sql(sql), seq_params)
+
+    def fetchone(self):
+        return self._convert(self._cursor.fetchone())
+
+    # Duyệt cursor thay vì fetchall() để không giữ cùng lúc hai danh sách dòng
+    def fetchall(self):
+        if not self._dictionary:
+            return self._cursor.fetchall()
+        return [dict(row) for row in self._cursor]
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    def __init__(self, connection, statement_timeout_ms=0):
+        self._connection = connection
+        self._timeout = statement_timeout_ms / 1000
+        self._deadline = None
+        if statement_timeout_ms:
+            # Câu lệnh chạy quá hạn bị hủy (sqlite3.OperationalError: interrupted)
+            connection.set_progress_handler(self._past_deadline, 10000)
+
+    def _past_deadline(self):
+        return 1 if self._deadline is not None and time.monotonic() > self._deadline else 0
+
+    # Giống max_execution_time của MySQL: chỉ giới hạn câu đọc, câu ghi (DELETE/UPDATE/INSERT theo lô) chạy hết
+    def start_statement(self, sql):
+        if self._timeout and replicas.is_read_only(sql):
+            self._deadline = time.monotonic() + self._timeout
+        else:
+            self._deadline = None
+
+    def is_connected(self):
+        return True
+
+    def cursor(self, dictionary=False):
+        cursor = self._connection.cursor()
+        if not dictionary:
+            cursor.row_factory = None  # tuple gốc của sqlite3, giống cursor thường của mysql.connector
+        return SQLiteCursor(cursor, dictionary=dictionary, connection=self)
+
+    # Hạn chỉ áp cho từng câu lệnh, không cho BEGIN/COMMIT/ROLLBACK chạy sau đó
+    def start_transaction(self):
+        self._deadline = None
+        self._connection.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        self._deadline = None
+        self._connection.commit()
+
+    def rollback(self):
+        self._deadline = None
+        self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+
+
+class SQLiteBackend:
+    name = "sqlite"
+    label = "SQLite"
+    explain_prefix = "EXPLAIN QUERY PLAN "
+    # SQLite chỉ có một writer; start_transaction() đã lấy khóa ghi (BEGIN IMMEDIATE)
+    lock_rows_suffix = ""
+    lock_rows_wait_suffix = ""
+
+    # shard: (số shard, chỉ số) khi backend là một shard dữ liệu, None với database global
+    def __init__(self, path, shard=None):
+        self.path = path
+        self.shard = shard
+        self.statement_timeout_ms = statement_timeout_ms()
+
+    def describe(self):
+        return {"path": self.path}
+
+    def connect(self):
+        connection = sqlite3.connect(
+            self.path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            timeout=5.0,
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        return SQLiteConnection(connection, self.statement_timeout_ms)
+
+    # File SQLite không có replication: replica SQLite chỉ dùng để thử nghiệm định tuyến đọc
+    def replica_lag(self, connection):
+        return 0.0
+
+    # SQLite không có auto_increment_increment: mỗi shard cấp ID trong dải riêng SQLITE_SHARD_ID_SPAN
+    def shard_of_id(self, row_id, count):
+        return (row_id - 1) // SQLITE_SHARD_ID_SPAN
+
+    def id_range(self, index, count):
+        return index * SQLITE_SHARD_ID_SPAN + 1, (index + 1) * SQLITE_SHARD_ID_SPAN
+
+    def set_id_floor(self, cursor, table, floor):
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, int(floor) - 1])
+        elif row[0] < floor - 1:
+            cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [int(floor) - 1, table])
+
+    def upsert_increment_sql(self, table, columns, key_columns, counter, replace=()):
+        placeholders = ", ".join(["%s"] * len(columns))
+        updates = [f"{counter} = {counter} + excluded.{counter}"] + [f"{column} = excluded.{column}" for column in replace]
+        return (
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {', '.join(updates)}"
+        )
+
+    # Biểu thức cộng số ngày (một tham số %s) vào cột DATETIME
+    def add_days_sql(self, column):
+        return f"datetime({column}, '+' || %s || ' days')"
+
+    # Index UNIQUE trên devices.fingerprint nếu đã tạo được (bỏ index thường khi đó), không thì index thường;
+    # trả về True nếu đã có index UNIQUE
+    def ensure_fingerprint_index(self, cursor):
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name = %s", [FINGERPRINT_UNIQUE_INDEX])
+        if cursor.fetchone()[0] == 0:
+            if fingerprint_unique_blocked(cursor):
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {FINGERPRINT_INDEX} ON devices (fingerprint)")
+                return False
+            cursor.execute(f"CREATE UNIQUE INDEX {FINGERPRINT_UNIQUE_INDEX} ON devices (fingerprint)")
+        cursor.execute(f"DROP INDEX IF EXISTS {FINGERPRINT_INDEX}")
+        return True
+
+    # Tạo toàn bộ schema, bật WAL và tạo tài khoản admin nếu database còn trống
+    def init_schema(self):
+        connection = self.connect()
+        raw = connection._connection
+        raw.execute("PRAGMA journal_mode = WAL")
+        for ddl in SQLITE_SCHEMA:
+            raw.execute(ddl)
+        for table, column, column_type in ADDED_COLUMNS:
+            existing = [row[1] for row in raw.execute(f"PRAGMA table_info({table})")]
+            if column not in existing:
+                raw.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        cursor = connection.cursor()
+        self.ensure_fingerprint_index(cursor)
+        cursor.close()
+        if self.shard:
+            _, index = self.shard
+            cursor = connection.cursor()
+            for table in SHARDED_ID_TABLES:
+                self.set_id_floor(cursor, table, index * SQLITE_SHARD_ID_SPAN + 1)
+            cursor.close()
+        elif raw.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
+            raw.execute(
+                "INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, datetime('now', 'localtime'))",
+                ["admin", DEFAULT_ADMIN_HASH, "admin"]
+            )
+        connection.commit()
+        connection.close()
+
+
+# Tạo backend theo biến môi trường DB_BACKEND (mặc định: mysql)
+def create_backend(mysql_config):
+    backend = os.getenv("DB_BACKEND", "mysql").strip().lower()
+    if backend == "sqlite":
+        return SQLiteBackend(os.getenv("SQLITE_PATH", "license_system.db"))
+    if backend != "mysql":
+        raise ValueError(f"DB_BACKEND không hợp lệ: {backend}")
+    return MySQLBackend(mysql_config)
+
+
+# Backend của các read replica trong DB_REPLICAS (phân tách bằng dấu phẩy):
+# MySQL: host hoặc host:port, dùng chung user/password/database với primary; SQLite: đường dẫn file
+def create_replica_backends(mysql_config):
+    names = [name.strip() for name in os.getenv("DB_REPLICAS", "").split(",") if name.strip()]
+    backend = os.getenv("DB_BACKEND", "mysql").strip().lower()
+    replicas = []
+    for name in names:
+        if backend == "sqlite":
+            replicas.append((name, SQLiteBackend(name)))
+            continue
+        host, _, port = name.partition(":")
+        config = dict(mysql_config, host=host, port=int(port) if port else mysql_config.get("port", 3306))
+        replicas.append((f"{host}:{config['port']}", MySQLBackend(config)))
+    return replicas
+
+
+# Backend của các shard dữ liệu trong DB_SHARDS (phân tách bằng dấu phẩy, thứ tự cố định):
+# MySQL: host[:port][/database], dùng chung user/password với primary; SQLite: đường dẫn file
+def create_shard_backends(mysql_config):
+    names = [name.strip() for name in os.getenv("DB_SHARDS", "").split(",") if name.strip()]
+    backend = os.getenv("DB_BACKEND", "mysql").strip().lower()
+    shards = []
+    for index, name in enumerate(names):
+        shard = (len(names), index)
+        if backend == "sqlite":
+            shards.append((name, SQLiteBackend(name, shard=shard)))
+            continue
+        address, _, database = name.partition("/")
+        host, _, port = address.partition(":")
+        config = dict(
+            mysql_config,
+            host=host,
+            port=int(port) if port else mysql_config.get("port", 3306),
+            database=database or mysql_config.get("database"),
+        )
+        shards.append((f"{host}:{config['port']}/{config['database']}", MySQLBackend(config, shard=shard)))
+    return shards